@@ -3,11 +3,16 @@
 import argparse
 import logging
 import sys
+import time
 
-from docker_squash import squash
+from docker_squash import constants
 from docker_squash.errors import SquashError
+from docker_squash.lib import path_filter
 from docker_squash.version import version
 
+COMMON_OPTIONS = ["-v", "--verbose"]
+""" Options without a value accepted by all commands, these can precede the command """
+
 
 # Source: http://stackoverflow.com/questions/1383254/logging-streamhandler-and-standard-streams
 class SingleLevelFilter(logging.Filter):
@@ -22,6 +27,127 @@ class SingleLevelFilter(logging.Filter):
             return record.levelno == self.passlevel
 
 
+class ProgressBar(object):
+    """Renders progress of squashing phases as a single updated line"""
+
+    def __init__(self, stream=sys.stderr, interval=0.2, width=30):
+        self.stream = stream
+        self.interval = interval
+        self.width = width
+        self.phase = None
+        self.rendered = 0
+
+    def __call__(self, phase, done, total):
+        now = time.monotonic()
+
+        # Do not redraw too often, the phase can report every file
+        if (
+            phase == self.phase
+            and now - self.rendered < self.interval
+            and done != total
+        ):
+            return
+
+        if self.phase and phase != self.phase:
+            self.stream.write("\n")
+
+        self.phase = phase
+        self.rendered = now
+
+        if total:
+            done = min(done, total)
+            filled = self.width * done // total
+            line = "%-8s [%s%s] %3d%% %d/%d MB" % (
+                phase,
+                "#" * filled,
+                " " * (self.width - filled),
+                100 * done // total,
+                done // 1024 // 1024,
+                total // 1024 // 1024,
+            )
+        else:
+            line = "%-8s %d MB" % (phase, done // 1024 // 1024)
+
+        self.stream.write("\r%s" % line)
+        self.stream.flush()
+
+    def close(self):
+        if self.phase:
+            self.stream.write("\n")
+            self.stream.flush()
+
+
+def split_command(argv):
+    """
+    Returns the command (or None for squashing) and the arguments for it.
+    Options shared by all commands can be specified before the command.
+    """
+
+    index = 0
+
+    while argv[index : index + 1] and argv[index] in COMMON_OPTIONS:
+        index += 1
+
+    if argv[index : index + 1] == ["analyze"]:
+        return "analyze", argv[:index] + argv[index + 1 :]
+
+    return None, argv
+
+
+def format_size(size):
+    if size < 1024:
+        return "%d B" % size
+
+    for unit in ["KB", "MB", "GB"]:
+        size /= 1024
+
+        if size < 1024 or unit == "GB":
+            return "%.1f %s" % (size, unit)
+
+
+def print_waste_report(report, top, stream=sys.stdout):
+    """Prints the report of space wasted in the image as tables of layers and paths"""
+
+    row = "%5s  %-19s  %10s  %11s  %10s  %10s  %10s\n"
+
+    stream.write(
+        row
+        % ("LAYER", "DIFF ID", "SIZE", "OVERWRITTEN", "REMOVED", "DUPLICATE", "WASTED")
+    )
+
+    for layer in report["layers"]:
+        stream.write(
+            row
+            % (
+                layer["layer"],
+                layer["diff_id"][:19],
+                format_size(layer["size"]),
+                format_size(layer["overwritten"]),
+                format_size(layer["removed"]),
+                format_size(layer["duplicate"]),
+                format_size(layer["wasted"]),
+            )
+        )
+
+    stream.write("\nTotal wasted: %s\n" % format_size(report["wasted"]))
+
+    if not report["paths"] or not top:
+        return
+
+    row = "%10s  %-11s  %5s  %s\n"
+
+    stream.write(
+        "\nTop %s wasted paths:\n" % min(top, len(report["paths"]))
+        + row % ("WASTED", "REASON", "LAYER", "PATH")
+    )
+
+    for path in report["paths"][:top]:
+        stream.write(
+            row
+            % (format_size(path["size"]), path["reason"], path["layer"], path["path"])
+        )
+
+
 class MyParser(argparse.ArgumentParser):
     # noinspection PyMethodMayBeStatic
     def str2bool(self, v: str) -> bool:
@@ -48,6 +174,8 @@ class CLI(object):
         handler_out.addFilter(SingleLevelFilter(logging.INFO, False))
         handler_err.addFilter(SingleLevelFilter(logging.INFO, True))
 
+        self.handler_out = handler_out
+
         self.log = logging.getLogger()
         formatter = logging.Formatter(
             "%(asctime)s %(filename)s:%(lineno)-10s %(levelname)-5s %(message)s"
@@ -60,7 +188,15 @@ class CLI(object):
         self.log.addHandler(handler_err)
 
     def run(self):
-        parser = MyParser(description="Docker layer squashing tool")
+        command, argv = split_command(sys.argv[1:])
+
+        if command == "analyze":
+            return self.analyze(argv)
+
+        parser = MyParser(
+            description="Docker layer squashing tool",
+            epilog="Use 'docker-squash analyze IMAGE' to report space wasted in layers of the image without squashing it. An image named 'analyze' is squashed when referenced with its tag ('analyze:latest') or after '--'.",
+        )
 
         parser.add_argument(
             "-v", "--verbose", action="store_true", help="Verbose output"
@@ -70,11 +206,19 @@ class CLI(object):
             "--version", action="version", help="Show version and exit", version=version
         )
 
-        parser.add_argument("image", help="Image to be squashed")
+        parser.add_argument(
+            "image",
+            help="Image to be squashed. Images available in the Docker daemon are referenced by name or ID. Use the 'docker-archive:PATH' form to squash a tar archive created by 'docker save', the 'oci:PATH' form to squash an OCI image layout directory and the 'docker://REGISTRY/REPOSITORY:TAG' form to squash an image stored in a registry, without the Docker daemon.",
+        )
         parser.add_argument(
             "-f",
             "--from-layer",
-            help="Number of layers to squash or ID of the layer (or image ID or image name) to squash from. In case the provided value is an integer, specified number of layers will be squashed. Every layer in the image will be squashed if the parameter is not provided.",
+            help="Number of layers to squash or ID of the layer (or image ID or image name) to squash from. In case the provided value is an integer, specified number of layers will be squashed. Every layer in the image will be squashed if the parameter is not provided. Use 'auto' to squash as few top layers as possible reclaiming the most space, base layers shared with other images in the Docker daemon are never squashed.",
+        )
+        parser.add_argument(
+            "--layers",
+            metavar="START:END",
+            help="Range of layers to squash, counted from the base layer (0) like Python slices: END is not squashed, both can be omitted and negative values are counted from the top of the image. Layers above the range are kept as they are. For example '2:-3' squashes all layers except the two base layers and the three top layers. Cannot be used together with --from-layer.",
         )
         parser.add_argument(
             "-t",
@@ -97,9 +241,101 @@ class CLI(object):
             "--tmp-dir",
             help="Temporary directory to be created and used. This will NOT be deleted afterwards for easier debugging.",
         )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Resume interrupted squashing in the temporary directory specified with --tmp-dir. Only saving the image, selecting and squashing layers are resumed: these phases are skipped if completed by the previous run. Layers already downloaded from a registry are not downloaded again and blobs already pushed to a registry are not uploaded again, other phases (for example writing or loading the squashed image) are repeated.",
+        )
         parser.add_argument(
             "--output-path",
-            help="Path where the image may be stored after squashing.",
+            help="Path where the image may be stored after squashing. By default a tar archive in the 'docker save' format is written, use the 'oci:PATH' form to write an OCI image layout directory instead or the 'docker://REGISTRY/REPOSITORY:TAG' form to push the image directly to a registry. Only missing layers are pushed. Unmodified layers of images read from the Docker daemon or from 'docker save' archives are found in the image already pushed under the tag, other such layers are compressed and uploaded unless the same compressed blob exists.",
+        )
+        parser.add_argument(
+            "--platform",
+            help="Platform (for example linux/arm64) of the image to squash, in case the image read from OCI image layout or from a registry supports multiple platforms. By default the first platform is used.",
+        )
+        parser.add_argument(
+            "--all-platforms",
+            action="store_true",
+            help="Squash all platforms of the image read from OCI image layout or from a registry concurrently and write a new multi-platform image referencing them. The image has to be written as OCI image layout or pushed to a registry, loading into the Docker daemon has to be disabled.",
+        )
+        parser.add_argument(
+            "--platform-workers",
+            type=int,
+            help="Number of platforms squashed at the same time when the --all-platforms option is used. Default: number of CPUs",
+        )
+        parser.add_argument(
+            "--reproducible",
+            action="store_true",
+            help="Make the squashed layer and image metadata reproducible: the same image always results in the same squashed image ID. The date is taken from the SOURCE_DATE_EPOCH environment variable (1970-01-01 if not set).",
+        )
+        parser.add_argument(
+            "--layer-order",
+            choices=constants.LAYER_ORDERS,
+            help="Order of files in the squashed layer. The 'name' order sorts files by name, the 'compression' order groups files by type and size, which makes the layer smaller when compressed (for example when pushed to a registry). By default files are stored in the order in which they were squashed.",
+        )
+        parser.add_argument(
+            "--split-layers",
+            type=int,
+            help="Split the squashed layer into (at most) this number of layers of similar size, which can be pulled and extracted in parallel. Files are assigned to layers by their paths. By default a single layer is created.",
+        )
+        parser.add_argument(
+            "--previous-image",
+            help="Tar archive with the previously squashed version of the image. Files which did not change since then are stored in a separate stable layer, which keeps its digest between builds, changed files are stored in a thin layer on top of it.",
+        )
+        parser.add_argument(
+            "--deduplicate",
+            action="store_true",
+            help="Store files with the same content, permissions and ownership in the squashed layer as hard links to the first copy",
+        )
+        parser.add_argument(
+            "--exclude",
+            action="append",
+            help="Do not add files matching the rule to the squashed layer, can be specified multiple times. Rules are globs, where '*' does not match '/' and '**' matches anything ('**/' also no directory at all); globs without '/' are matched against file names. Rules prefixed with 're:' are regular expressions searched for in absolute paths. Excluding a directory excludes its content too.",
+        )
+        parser.add_argument(
+            "--exclude-preset",
+            action="append",
+            choices=sorted(path_filter.PRESETS),
+            help="Do not add files matching the set of rules for common build leftovers to the squashed layer, can be specified multiple times",
+        )
+        parser.add_argument(
+            "--progress",
+            action="store_true",
+            help="Show progress of saving, squashing, hashing and loading the image on the standard error output",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print wall time, CPU time and number of processed bytes for every phase of squashing",
+        )
+        parser.add_argument(
+            "--stats-file",
+            help="Write statistics of squashing phases as JSON into the specified file, use '-' to write them to standard output (log messages are written to standard error output then)",
+        )
+        parser.add_argument(
+            "--profile",
+            help="Profile the phase where layers are merged with cProfile and write the collected data into the specified file. The data can be read using the 'pstats' Python module.",
+        )
+        parser.add_argument(
+            "--report-file",
+            help="Write a JSON report with number of files kept and dropped (and bytes reclaimed) for every squashed layer into the specified file",
+        )
+        parser.add_argument(
+            "--trace-decisions",
+            metavar="FILE",
+            help="Write the decision made about every file in squashed layers (layer, path, 'keep' or 'drop' and the reason) into the specified file, one JSON array per line",
+        )
+        parser.add_argument(
+            "--in-memory",
+            action="store_true",
+            help="Squash small images in memory instead of using a temporary directory on the disk. Larger images are squashed on the disk. Ignored if the temporary directory is specified.",
+        )
+        parser.add_argument(
+            "--in-memory-threshold",
+            type=int,
+            default=constants.DEFAULT_IN_MEMORY_THRESHOLD // 1024 // 1024,
+            help="Size of the image (in MB) up to which the image is squashed in memory when the --in-memory option is used. Default: 200",
         )
         parser.add_argument(
             "--load-image",
@@ -110,26 +346,130 @@ class CLI(object):
             help="Whether to load the image into Docker daemon after squashing",
         )
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
 
-        if args.verbose:
-            self.log.setLevel(logging.DEBUG)
-        else:
-            self.log.setLevel(logging.INFO)
+        if args.stats_file == "-":
+            # Keep the standard output for the statistics only
+            self.handler_out.setStream(sys.stderr)
+
+        self._set_log_level(args)
+
+        progress = ProgressBar() if args.progress else None
+
+        def squash_image():
+            # Imported only when squashing, so that printing the help or
+            # the version is fast
+            from docker_squash import squash
 
-        self.log.debug("Running version %s", version)
-        try:
             squash.Squash(
                 log=self.log,
                 image=args.image,
                 from_layer=args.from_layer,
+                layers=args.layers,
                 tag=args.tag,
                 comment=args.message,
                 output_path=args.output_path,
                 load_image=args.load_image,
                 tmp_dir=args.tmp_dir,
                 cleanup=args.cleanup,
+                platform=args.platform,
+                stats=args.stats,
+                stats_file=args.stats_file,
+                profile_file=args.profile,
+                report_file=args.report_file,
+                trace_file=args.trace_decisions,
+                in_memory=args.in_memory,
+                in_memory_threshold=args.in_memory_threshold * 1024 * 1024,
+                resume=args.resume,
+                reproducible=args.reproducible,
+                layer_order=args.layer_order,
+                split_layers=args.split_layers,
+                previous_image=args.previous_image,
+                deduplicate=args.deduplicate,
+                exclude=args.exclude,
+                exclude_presets=args.exclude_preset,
+                progress=progress,
+                all_platforms=args.all_platforms,
+                platform_workers=args.platform_workers,
             ).run()
+
+        try:
+            self._execute(args, squash_image)
+        finally:
+            if progress:
+                progress.close()
+
+    def analyze(self, argv):
+        parser = MyParser(
+            prog="docker-squash analyze",
+            description="Reports space wasted in every layer of the image: files overwritten or removed by upper layers and files with the same content as other files. The image is not squashed, no layers are written.",
+        )
+
+        parser.add_argument(
+            "-v", "--verbose", action="store_true", help="Verbose output"
+        )
+        parser.add_argument(
+            "image",
+            help="Image to be analyzed, referenced in the same way as the image to be squashed",
+        )
+        parser.add_argument(
+            "--tmp-dir",
+            help="Temporary directory to be created and used. This will NOT be deleted afterwards for easier debugging.",
+        )
+        parser.add_argument(
+            "--platform",
+            help="Platform (for example linux/arm64) of the image to analyze, in case the image read from OCI image layout or from a registry supports multiple platforms. By default the first platform is used.",
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=20,
+            help="Number of paths wasting the most space to print. Default: 20",
+        )
+        parser.add_argument(
+            "--report-file",
+            help="Write the JSON report with space wasted in every layer and by every path into the specified file",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print wall time, CPU time and number of processed bytes for every phase of the analysis",
+        )
+
+        args = parser.parse_args(argv)
+
+        self._set_log_level(args)
+
+        def analyze_image():
+            from docker_squash import squash
+
+            report = squash.Squash(
+                log=self.log,
+                image=args.image,
+                tmp_dir=args.tmp_dir,
+                load_image=False,
+                platform=args.platform,
+                stats=args.stats,
+                report_file=args.report_file,
+            ).analyze()
+
+            print_waste_report(report, args.top)
+
+        self._execute(args, analyze_image)
+
+    def _set_log_level(self, args):
+        if args.verbose:
+            self.log.setLevel(logging.DEBUG)
+        else:
+            self.log.setLevel(logging.INFO)
+
+        self.log.debug("Running version %s", version)
+
+    def _execute(self, args, action):
+        """Runs the action, errors are logged and reported with the exit code"""
+
+        try:
+            action()
         except KeyboardInterrupt:
             self.log.error("Program interrupted by user, exiting...")
             sys.exit(1)
@@ -0,0 +1,8 @@
+DEFAULT_IN_MEMORY_THRESHOLD = 200 * 1024 * 1024
+""" Images up to this size are squashed in memory, if requested """
+
+NAME_ORDER = "name"
+""" Members of the squashed layer sorted by name """
+COMPRESSION_ORDER = "compression"
+""" Members of the squashed layer grouped by file type and size, for better compression """
+LAYER_ORDERS = [NAME_ORDER, COMPRESSION_ORDER]
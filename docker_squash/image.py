@@ -1,5 +1,7 @@
+import copy
 import datetime
 import hashlib
+import io
 import itertools
 import json
 import logging
@@ -10,25 +12,63 @@ import shutil
 import tarfile
 import tempfile
 import threading
-from typing import List, Optional, Union
-
-import docker as docker_library
+from collections import Counter, OrderedDict
+from typing import Callable, List, Optional, Tuple, Union
 
+from docker_squash.constants import COMPRESSION_ORDER
 from docker_squash.errors import SquashError, SquashUnnecessaryError
+from docker_squash.lib import common
+from docker_squash.lib.blobs import SharedBlobs
+from docker_squash.lib.checkpoint import Checkpoint
+from docker_squash.lib.path_filter import PathFilter
+from docker_squash.lib.stats import Stats
+from docker_squash.lib.trace import DecisionTrace
+
+MEMORY_DIR = "/dev/shm"
+""" Memory backed file system used to squash small images """
+AUTO_FROM_LAYER = "auto"
+""" Layers to squash are selected based on the space reclaimed and layers shared with other images """
+
+LARGE_FILE_SIZE = 1024 * 1024
+""" Files of at least this size are placed at the end of the layer in the compression order """
+
+
+class SparseContent(object):
+    """
+    File-like object with the content of a sparse file in the PAX 1.0 sparse
+    format: the sparse map followed by data extents read from the file.
+    """
+
+    def __init__(self, sparse_map, fileobj, extents):
+        self.sparse_map = io.BytesIO(sparse_map)
+        self.fileobj = fileobj
+        self.extents = list(extents)
+        self.remaining = 0
+        """ Number of bytes left in the current extent """
+
+    def read(self, size=-1):
+        data = self.sparse_map.read(size)
 
+        while size < 0 or len(data) < size:
+            if not self.remaining:
+                if not self.extents:
+                    break
+
+                offset, self.remaining = self.extents.pop(0)
+                self.fileobj.seek(offset)
+                continue
 
-class Chdir(object):
-    """Context manager for changing the current working directory"""
+            chunk = self.fileobj.read(
+                self.remaining if size < 0 else min(self.remaining, size - len(data))
+            )
 
-    def __init__(self, new_path):
-        self.newPath = os.path.expanduser(new_path)
+            if not chunk:
+                break
 
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
+            self.remaining -= len(chunk)
+            data += chunk
 
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
+        return data
 
 
 class Image(object):
@@ -51,6 +91,20 @@ class Image(object):
         tmp_dir: Optional[str] = None,
         tag: Optional[str] = None,
         comment: Optional[str] = "",
+        platform: Optional[str] = None,
+        stats: Optional[Stats] = None,
+        in_memory_threshold: Optional[int] = None,
+        resume: Optional[bool] = False,
+        source_date_epoch: Optional[int] = None,
+        layer_order: Optional[str] = None,
+        split_layers: Optional[int] = None,
+        previous_image: Optional[str] = None,
+        deduplicate: Optional[bool] = False,
+        path_filter: Optional[PathFilter] = None,
+        progress: Optional[Callable[[str, int, Optional[int]], None]] = None,
+        trace: Optional[DecisionTrace] = None,
+        shared_blobs: Optional[SharedBlobs] = None,
+        layer_range: Optional[Tuple[Optional[int], Optional[int]]] = None,
     ):
         self.log: logging.Logger = log
         self.debug = self.log.isEnabledFor(logging.DEBUG)
@@ -64,6 +118,17 @@ class Image(object):
         self.squash_id = None
         self.oci_format = False
 
+        self.transport, self.reference = common.parse_image_reference(image)
+        """ Transport of the image, None in case the image is read from the Docker daemon """
+        self.platform: str = platform
+        """ Platform (for example 'linux/arm64') to select from multi-platform images """
+        self.registry_client = None
+        """ Client for the registry the image is read from """
+        self.stats: Stats = stats or Stats()
+        """ Timing of squashing phases """
+        self.layer_reports = []
+        """ Content statistics of squashed layers, from the oldest layer """
+
         # Workaround for https://play.golang.org/p/sCsWMXYxqy
         #
         # Golang doesn't add padding to microseconds when marshaling
@@ -76,8 +141,50 @@ class Image(object):
         )
         """ Date used in metadata, already formatted using the `%Y-%m-%dT%H:%M:%S.%fZ` format """
 
+        self.source_date_epoch: int = source_date_epoch
+        """ Timestamp used to make the output reproducible, disabled if not set """
+        self.layer_order: str = layer_order
+        """ Order of members in the squashed layer, the order of squashing if not set """
+        self.split_layers: int = split_layers
+        """ Number of layers of similar size the squashed content is split into, single layer if not set """
+        self.previous_image: str = previous_image
+        """ Previously squashed image, unchanged files are stored in a separate layer if set """
+        self.deduplicate: bool = deduplicate
+        """ Store files with the same content, permissions and ownership as hard links to the first copy """
+        self.path_filter: PathFilter = path_filter or PathFilter()
+        """ Paths which are not added to the squashed layer """
+        self.progress = progress
+        """ Called with the phase, number of bytes done and total number of bytes (None if unknown) """
+        self.trace: DecisionTrace = trace
+        """ Decisions about every file in squashed layers are recorded here if set """
+        self.shared_blobs: SharedBlobs = shared_blobs
+        """ Blobs shared with images squashed at the same time, if set """
+        self.layer_range = layer_range
+        """ Start and end (exclusive) of the range of layers to squash, counted like Python slice indices; 'from_layer' is used if not set """
+        self.layers_to_carry: List[str] = []
+        """ Layers above the squashed range, carried over to the new image """
+        self.layer_paths_to_carry: List[str] = []
+        """ Paths of layers above the squashed range with content (v2 format) """
+
+        if source_date_epoch is not None:
+            self.date = datetime.datetime.fromtimestamp(
+                source_date_epoch, datetime.timezone.utc
+            ).strftime("%Y-%m-%dT%H:%M:%SZ")
+
         self.tmp_dir: str = tmp_dir
         """ Main temporary directory to save all working files. This is the root directory for all other temporary files. """
+        self.tmp_dir_provided: bool = tmp_dir is not None
+        """ Temporary directory was specified by the user, it will never be relocated """
+        self.in_memory_threshold: int = in_memory_threshold
+        """ Images smaller than this size (in bytes) are squashed in memory, disabled if not set """
+        self.resume: bool = resume
+        """ Resume squashing in the existing temporary directory from the last completed phase """
+        self.checkpoint: Checkpoint = None
+        """ Phases of squashing already completed in the temporary directory """
+
+    def _report_progress(self, phase, done, total=None):
+        if self.progress:
+            self.progress(phase, done, total)
 
     def squash(self):
         self._before_squashing()
@@ -93,7 +200,9 @@ class Image(object):
         """Cleanup the temporary directory"""
 
         self.log.debug("Cleaning up %s temporary directory" % self.tmp_dir)
-        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+        with self.stats.phase("cleanup"):
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
 
     def _initialize_directories(self):
         # Prepare temporary directory where all the work will be executed
@@ -102,15 +211,20 @@ class Image(object):
         except Exception:
             raise SquashError("Preparing temporary directory failed")
 
+        self._create_work_directories()
+
+    def _create_work_directories(self):
         # Temporary location on the disk of the old, unpacked *image*
         self.old_image_dir: str = os.path.join(self.tmp_dir, "old")
         # Temporary location on the disk of the new, unpacked, squashed *image*
         self.new_image_dir: str = os.path.join(self.tmp_dir, "new")
         # Temporary location on the disk of the squashed *layer*
         self.squashed_dir: str = os.path.join(self.new_image_dir, "squashed")
+        # Location of the tar archive with squashed layers
+        self.squashed_tar: str = os.path.join(self.squashed_dir, "layer.tar")
 
         for d in self.old_image_dir, self.new_image_dir:
-            os.makedirs(d)
+            os.makedirs(d, exist_ok=True)
 
     def _squash_id(self, layer):
         if layer == "<missing>":
@@ -157,31 +271,173 @@ class Image(object):
     def _before_squashing(self):
         self._initialize_directories()
 
-        # Location of the tar archive with squashed layers
-        self.squashed_tar = os.path.join(self.squashed_dir, "layer.tar")
-
         if self.tag:
             self.image_name, self.image_tag = self._parse_image_name(self.tag)
 
-        # The image id or name of the image to be squashed
-        try:
-            self.old_image_id = self.docker.inspect_image(self.image)["Id"]
-        except SquashError:
-            raise SquashError(
-                f"Could not get the image ID to squash, please check provided 'image' argument: {self.image}"
+        self._read_old_image_layers()
+
+        # By default - squash all layers.
+        if self.from_layer is None:
+            self.from_layer = len(self.old_image_layers)
+
+        end = len(self.old_image_layers)
+        auto = self.from_layer == AUTO_FROM_LAYER
+
+        if self.layer_range:
+            marker, end, _ = slice(*self.layer_range).indices(end)
+            number_of_layers = end - marker
+
+            self.log.debug(
+                f"We detected range of layers ({marker}:{end}) as the argument to squash"
             )
+        elif auto:
+            # Layers are selected when their content is available
+            marker = number_of_layers = None
+        else:
+            number_of_layers = self._number_of_layers()
+            marker = end - number_of_layers
+
+        if not auto:
+            self._select_layers(marker, end)
+
+        if self.in_memory_threshold and not self.tmp_dir_provided:
+            self._use_memory()
+
+        if not self.transport and not self.resume:
+            # Fail before transferring any data
+            self._check_disk_space(self.old_image_layer_sizes[marker:end])
+
+        self.checkpoint = Checkpoint(self.log, self.tmp_dir)
+        self.date = self.checkpoint.start(
+            {
+                "image": self.image,
+                "image_id": self.old_image_id,
+                "layers": self.from_layer if auto else number_of_layers,
+                "layers_carried": len(self.layers_to_carry),
+                "tag": self.tag,
+                "comment": self.comment,
+                "platform": self.platform,
+                "layer_order": self.layer_order,
+                "reproducible": self.source_date_epoch is not None,
+                "source_date_epoch": self.source_date_epoch,
+                "split_layers": self.split_layers,
+                "previous_image": self.previous_image,
+                "deduplicate": self.deduplicate,
+                "exclude": self.path_filter.rules,
+            },
+            self.date,
+        )
+
+        if self.checkpoint.done("merge"):
+            # Squashed layers were already removed, only layers to move
+            # are left and these are not modified by squashing
+            self.log.info("Layers already squashed, skipping saving the image")
+            self.size_before = self.checkpoint.get("merge")["size_before"]
+        elif self.checkpoint.done("save"):
+            self.log.info("Image already saved, skipping")
+            self.size_before = self.checkpoint.get("save")["size"]
+        else:
+            with self.stats.phase("save") as phase:
+                if self.transport:
+                    self._fetch_transport_image(self.old_image_dir)
+                else:
+                    # Fetch the image and unpack it on the fly to the old image directory
+                    self._save_image(self.old_image_id, self.old_image_dir)
+
+                phase.bytes += self._dir_size(self.old_image_dir)
+
+            self.size_before = self._image_size(self.old_image_dir)
+
+            self.checkpoint.complete("save", size=self.size_before)
+
+        if auto:
+            # Squashed layers may be already removed when resuming, the
+            # selection cannot be repeated
+            if self.checkpoint.done("select"):
+                number_of_layers = self.checkpoint.get("select")["layers"]
+            else:
+                with self.stats.phase("select"):
+                    number_of_layers = self._auto_number_of_layers()
+
+                self.checkpoint.complete("select", layers=number_of_layers)
+
+            self._select_layers(end - number_of_layers, end)
+
+        self.log.info("Squashing image '%s'..." % self.image)
+
+    def _read_old_image_layers(self):
+        """Reads IDs (and sizes, if known) of layers of the old image, from the base layer"""
 
         self.old_image_layers = []
 
-        # Read all layers in the image
-        self._read_layers(self.old_image_layers, self.old_image_id)
-        self.old_image_layers.reverse()
+        with self.stats.phase("inspect"):
+            if self.transport:
+                # Image is not read from the Docker daemon
+                self._read_transport_layers(self.old_image_layers)
+            else:
+                # The image id or name of the image to be squashed
+                try:
+                    image_info = self.docker.inspect_image(self.image)
+                except SquashError:
+                    raise SquashError(
+                        f"Could not get the image ID to squash, please check provided 'image' argument: {self.image}"
+                    )
+
+                self.old_image_id = image_info["Id"]
+                self.old_image_size = image_info.get("Size")
+                self.old_image_layer_sizes = []
+
+                # Read all layers in the image
+                self._read_layers(
+                    self.old_image_layers,
+                    self.old_image_id,
+                    self.old_image_layer_sizes,
+                )
+                self.old_image_layers.reverse()
+                self.old_image_layer_sizes.reverse()
+
         self.log.info("Old image has %s layers", len(self.old_image_layers))
         self.log.debug("Old layers: %s", self.old_image_layers)
 
-        # By default - squash all layers.
-        if self.from_layer is None:
-            self.from_layer = len(self.old_image_layers)
+    def _select_layers(self, marker, end):
+        """
+        Splits layers of the old image into layers to move, layers to squash
+        (from the marker up to the end) and layers to carry over
+        """
+
+        number_of_layers = end - marker
+
+        self._validate_number_of_layers(number_of_layers)
+
+        self.layers_to_squash = self.old_image_layers[marker:end]
+        self.layers_to_move = self.old_image_layers[:marker]
+        self.layers_to_carry = self.old_image_layers[end:]
+
+        self.log.info("Checking if squashing is necessary...")
+
+        if len(self.layers_to_squash) < 1:
+            raise SquashError(
+                f"Invalid number of layers to squash: {len(self.layers_to_squash)}"
+            )
+
+        if len(self.layers_to_squash) == 1:
+            raise SquashUnnecessaryError(
+                "Single layer marked to squash, no squashing is required"
+            )
+
+        if self.layers_to_carry:
+            self.log.info(
+                f"Attempting to squash {number_of_layers} layers, keeping {len(self.layers_to_carry)} layers above them..."
+            )
+        else:
+            self.log.info(f"Attempting to squash last {number_of_layers} layers...")
+
+        self.log.debug(f"Layers to squash: {self.layers_to_squash}")
+        self.log.debug(f"Layers to move: {self.layers_to_move}")
+        self.log.debug(f"Layers to carry over: {self.layers_to_carry}")
+
+    def _number_of_layers(self):
+        """Returns the number of layers to squash, based on 'from_layer'"""
 
         try:
             number_of_layers = int(self.from_layer)
@@ -190,6 +446,11 @@ class Image(object):
                 f"We detected number of layers ({number_of_layers}) as the argument to squash"
             )
         except ValueError:
+            if self.transport:
+                raise SquashError(
+                    f"Only number of layers to squash can be provided for images read from {self.transport} transport, provided: {self.from_layer}"
+                )
+
             squash_id = self._squash_id(self.from_layer)
             self.log.debug(f"We detected layer ({squash_id}) as the argument to squash")
 
@@ -202,42 +463,277 @@ class Image(object):
                 len(self.old_image_layers) - self.old_image_layers.index(squash_id) - 1
             )
 
-        self._validate_number_of_layers(number_of_layers)
+        return number_of_layers
 
-        marker = len(self.old_image_layers) - number_of_layers
+    def _auto_number_of_layers(self):
+        """
+        Selects the number of layers to squash. Base layers shared with
+        other images in the Docker daemon are never squashed, these would
+        not be reused from caches (in registries and on nodes) anymore.
+        From the remaining layers as few top layers as possible are
+        selected, so that the most space is reclaimed.
+
+        The reclaimed space is estimated from indexes of files in layers:
+        files overwritten or removed by upper layers are dropped when the
+        layers are squashed together.
+        """
 
-        self.layers_to_squash = self.old_image_layers[marker:]
-        self.layers_to_move = self.old_image_layers[:marker]
+        layer_tars, diff_ids = self._read_layer_tars()
+        shared = self._shared_layers(diff_ids)
 
-        self.log.info("Checking if squashing is necessary...")
+        # History entries up to the last shared layer are kept
+        with_content = [i for i, layer_tar in enumerate(layer_tars) if layer_tar]
+        first = with_content[shared - 1] + 1 if shared else 0
 
-        if len(self.layers_to_squash) < 1:
-            raise SquashError(
-                f"Invalid number of layers to squash: {len(self.layers_to_squash)}"
+        if first >= len(layer_tars) - 1:
+            raise SquashUnnecessaryError(
+                "All layers except the top one are shared with other images, no squashing is possible without breaking their reuse"
             )
 
-        if len(self.layers_to_squash) == 1:
+        reclaimed = self._reclaimed_bytes(layer_tars[first:])
+        # Space reclaimed when squashing from the layer to the top
+        savings = list(itertools.accumulate(reversed(reclaimed)))[::-1]
+
+        if not savings[0]:
             raise SquashUnnecessaryError(
-                "Single layer marked to squash, no squashing is required"
+                "No space can be reclaimed by squashing layers not shared with other images, no squashing is required"
             )
 
-        self.log.info(f"Attempting to squash last {number_of_layers} layers...")
-        self.log.debug(f"Layers to squash: {self.layers_to_squash}")
-        self.log.debug(f"Layers to move: {self.layers_to_move}")
+        # The highest layer reclaiming the same space as all of them, there
+        # is always a layer with content above it
+        marker = first + max(i for i, s in enumerate(savings) if s == savings[0])
 
-        # Fetch the image and unpack it on the fly to the old image directory
-        self._save_image(self.old_image_id, self.old_image_dir)
+        self.log.info(
+            "Selected %s layers to squash, reclaiming %.2f MB, %s base layers are shared with other images"
+            % (len(layer_tars) - marker, savings[0] / 1024 / 1024, shared)
+        )
 
-        self.size_before = self._dir_size(self.old_image_dir)
+        return len(layer_tars) - marker
 
-        self.log.info("Squashing image '%s'..." % self.image)
+    def _read_layer_tars(self):
+        """
+        Returns paths to archives of layers of the old image, one for every
+        history entry (None for entries without content), and diff IDs of
+        layers with content
+        """
+
+        raise SquashError(
+            f"Layers to squash cannot be selected automatically for the {self.FORMAT} image format"
+        )
+
+    def _shared_layers(self, diff_ids):
+        """
+        Returns the number of base layers (with content) the old image
+        shares with other images in the Docker daemon
+        """
+
+        if not self.docker:
+            self.log.warning(
+                "Docker daemon is not used, layers shared with other images cannot be found"
+            )
+            return 0
+
+        shared = 0
+
+        for image in self.docker.images():
+            if image["Id"] == self.old_image_id:
+                continue
+
+            layers = (
+                self.docker.inspect_image(image["Id"]).get("RootFS", {}).get("Layers")
+            )
+
+            for i, (diff_id, layer) in enumerate(zip(diff_ids, layers or [])):
+                if diff_id != layer:
+                    break
+
+                if i + 1 > shared:
+                    self.log.debug(
+                        "Layer %s is shared with the %s image" % (diff_id, image["Id"])
+                    )
+                    shared = i + 1
+
+        return shared
+
+    def _reclaimed_bytes(self, layer_tars):
+        """
+        Estimates the space reclaimed in every layer if all layers are
+        squashed together: the size of files overwritten or removed by upper
+        layers.
+        """
+
+        reclaimed = [0] * len(layer_tars)
+
+        for i, files in self._index_layers(layer_tars):
+            reclaimed[i] = sum(member.size for member, reason in files if reason)
+
+        return reclaimed
+
+    def _index_layers(self, layer_tars):
+        """
+        Indexes regular files of layers, only headers are read. Layers are
+        read from the top, for every layer with content its index and its
+        files are yielded, together with the reason the file is dropped
+        when the layers are squashed: 'overwritten' or 'removed' by upper
+        layers, None if the file is kept.
+        """
+
+        # Paths in upper layers, removed paths and opaque directories
+        files = set()
+        removed = set()
+        opaque = set()
+
+        for i in reversed(range(len(layer_tars))):
+            if not layer_tars[i]:
+                continue
+
+            with tarfile.open(layer_tars[i], "r", format=tarfile.PAX_FORMAT) as tar:
+                members = tar.getmembers()
+
+            layer_files = []
+
+            for member in members:
+                path = self._normalize_path(member.name)
+
+                if not member.isfile() or ".wh." in path:
+                    continue
+
+                # Directories above the file, from the root directory
+                parts = path.split("/")
+                dirs = ["/".join(parts[:j]) or "/" for j in range(1, len(parts))]
+
+                if path in files or any(d in files for d in dirs):
+                    reason = "overwritten"
+                elif path in removed or any(d in removed or d in opaque for d in dirs):
+                    reason = "removed"
+                else:
+                    reason = None
+
+                layer_files.append((member, reason))
+
+            yield i, layer_files
+
+            for member in members:
+                path = self._normalize_path(member.name)
+                name = os.path.basename(path)
+
+                if name == ".wh..wh..opq":
+                    opaque.add(os.path.dirname(path))
+                elif name.startswith(".wh."):
+                    removed.add(os.path.join(os.path.dirname(path), name[4:]))
+                elif not member.isdir():
+                    # Directories are merged, their content is not replaced
+                    files.add(path)
+
+    def analyze(self):
+        """
+        Reports space wasted in every layer of the image: files overwritten
+        or removed by upper layers and files with the same content as other
+        files in the image. No layers are written.
+        """
+
+        self._initialize_directories()
+        self._read_old_image_layers()
+
+        with self.stats.phase("save") as phase:
+            if self.transport:
+                self._fetch_transport_image(self.old_image_dir)
+            else:
+                self._save_image(self.old_image_id, self.old_image_dir)
+
+            phase.bytes += self._dir_size(self.old_image_dir)
+
+        with self.stats.phase("analyze"):
+            return self._waste_report(*self._read_layer_tars())
+
+    def _waste_report(self, layer_tars, diff_ids):
+        """
+        Generates the report of space wasted in layers and by paths, based
+        on indexes of layers. Only content of files of the same size is
+        read, to find duplicates.
+        """
+
+        layer_diff_ids = dict(
+            zip([i for i, layer_tar in enumerate(layer_tars) if layer_tar], diff_ids)
+        )
+        layers = {}
+        paths = []
+        # Files kept in the squashed image, by their size
+        kept = {}
+
+        for i, files in self._index_layers(layer_tars):
+            report = OrderedDict()
+            report["layer"] = i
+            report["diff_id"] = layer_diff_ids[i]
+            report["size"] = 0
+            report["overwritten"] = 0
+            report["removed"] = 0
+            report["duplicate"] = 0
+            layers[i] = report
+
+            for member, reason in files:
+                report["size"] += member.size
+
+                if reason:
+                    report[reason] += member.size
+                    paths.append(self._wasted_path(i, member, reason))
+                elif member.size:
+                    kept.setdefault(member.size, []).append((i, member))
+
+        # Files to read, by layer
+        candidates = {}
+
+        for same_size in kept.values():
+            if len(same_size) > 1:
+                for i, member in same_size:
+                    candidates.setdefault(i, []).append(member)
+
+        # The first file with the content (from the base layer) is the original
+        originals = set()
+
+        for i in sorted(candidates):
+            with tarfile.open(layer_tars[i], "r", format=tarfile.PAX_FORMAT) as tar:
+                # Read sequentially, layers may be compressed
+                for member in sorted(candidates[i], key=lambda m: m.offset):
+                    digest = self._member_digest(tar, member)
+
+                    if digest in originals:
+                        layers[i]["duplicate"] += member.size
+                        paths.append(self._wasted_path(i, member, "duplicate"))
+                    else:
+                        originals.add(digest)
+
+        for report in layers.values():
+            report["wasted"] = (
+                report["overwritten"] + report["removed"] + report["duplicate"]
+            )
+
+        report = OrderedDict()
+        report["image"] = self.image
+        report["wasted"] = sum(layer["wasted"] for layer in layers.values())
+        report["layers"] = [layers[i] for i in sorted(layers)]
+        report["paths"] = sorted(paths, key=lambda path: -path["size"])
+
+        return report
+
+    def _wasted_path(self, layer, member, reason):
+        path = OrderedDict()
+        path["path"] = self._normalize_path(member.name)
+        path["layer"] = layer
+        path["reason"] = reason
+        path["size"] = member.size
+
+        return path
 
     def _after_squashing(self):
-        self.log.debug("Removing from disk already squashed layers...")
-        self.log.debug("Cleaning up %s temporary directory" % self.old_image_dir)
-        shutil.rmtree(self.old_image_dir, ignore_errors=True)
+        # Squashed layers were already removed and other layers moved, mostly
+        # metadata is left. It is kept in temporary directories specified by
+        # the user, because it is needed to resume squashing
+        if not self.tmp_dir_provided:
+            self.log.debug("Cleaning up %s temporary directory" % self.old_image_dir)
+            shutil.rmtree(self.old_image_dir, ignore_errors=True)
 
-        self.size_after = self._dir_size(self.new_image_dir)
+        self.size_after = self._image_size(self.new_image_dir)
 
         size_before_mb = float(self.size_before) / 1024 / 1024
         size_after_mb = float(self.size_after) / 1024 / 1024
@@ -255,6 +751,11 @@ class Image(object):
                 % float(((size_before_mb - size_after_mb) / size_before_mb) * 100)
             )
 
+    def _image_size(self, directory):
+        """Returns the size of the image stored in the directory"""
+
+        return self._dir_size(directory)
+
     def _dir_size(self, directory):
         size = 0
 
@@ -264,6 +765,65 @@ class Image(object):
 
         return size
 
+    def content_report(self):
+        """
+        Returns a report about the content of squashed layers: how many
+        files were kept and how many (and how much data) were dropped
+        because of newer files, whiteouts, opaque directories or exclusion
+        rules.
+        """
+
+        total = self._new_layer_report(None)
+        total.pop("layer")
+
+        for layer_report in self.layer_reports:
+            for key in total.keys():
+                total[key] += layer_report[key]
+
+        report = OrderedDict()
+        report["image"] = self.image
+        report["size_before"] = self.size_before
+        report["size_after"] = self.size_after
+        report["layers"] = self.layer_reports
+        report["total"] = total
+
+        return report
+
+    def _new_layer_report(self, layer):
+        report = OrderedDict()
+        report["layer"] = layer
+        report["files_kept"] = 0
+        report["files_shadowed"] = 0
+        report["files_whiteout"] = 0
+        report["files_opaque"] = 0
+        report["files_excluded"] = 0
+        report["markers_added"] = 0
+        report["markers_dropped"] = 0
+        report["hardlinks_skipped"] = 0
+        report["symlinks_skipped"] = 0
+        report["bytes_reclaimed"] = 0
+
+        return report
+
+    def _report_kept(self, report, member, reason):
+        """Notes that the member was added to the squashed layer"""
+
+        report["files_kept"] += 1
+
+        if self.trace:
+            self.trace.record(report["layer"], member.name, "keep", reason)
+
+    def _report_dropped(self, report, key, member, reason):
+        """Notes that the member was not added to the squashed layer"""
+
+        report[key] += 1
+
+        if member.isfile():
+            report["bytes_reclaimed"] += member.size
+
+        if self.trace:
+            self.trace.record(report["layer"], member.name, "drop", reason)
+
     def layer_paths(self):
         """
         Returns name of directories to layers in the exported tar archive.
@@ -271,11 +831,25 @@ class Image(object):
         pass
 
     def export_tar_archive(self, target_tar_file):
+        self._fetch_missing_layers()
         self._tar_image(target_tar_file, self.new_image_dir)
         self.log.info("Image available at '%s'" % target_tar_file)
 
+    def export_oci_layout(self, target_dir):
+        raise SquashError(
+            f"Exporting to OCI image layout is not supported for {self.FORMAT} image format"
+        )
+
+    def push_to_registry(self, reference):
+        raise SquashError(
+            f"Pushing to a registry is not supported for {self.FORMAT} image format"
+        )
+
     def load_squashed_image(self):
-        self._load_image(self.new_image_dir)
+        self._fetch_missing_layers()
+
+        with self.stats.phase("load"):
+            self._load_image(self.new_image_dir)
 
         if self.tag:
             self.log.info(
@@ -283,6 +857,14 @@ class Image(object):
                 % (self.image_name, self.image_tag)
             )
 
+    def _fetch_missing_layers(self):
+        """
+        Makes sure all layers of the new image are available in the new
+        image directory. Layers may be missing if they were not needed
+        for squashing and the source image is stored remotely.
+        """
+        pass
+
     def _files_in_layers(self, layers):
         """
         Prepare a list of files in all layers
@@ -302,6 +884,12 @@ class Image(object):
         """Creates temporary directory that is used to work on layers"""
 
         if tmp_dir:
+            if self.resume and os.path.exists(
+                os.path.join(tmp_dir, Checkpoint.FILE_NAME)
+            ):
+                self.log.debug("Reusing %s temporary directory" % tmp_dir)
+                return tmp_dir
+
             if os.path.exists(tmp_dir):
                 raise SquashError(
                     f"The '{tmp_dir}' directory already exists, please remove it before you proceed"
@@ -315,31 +903,77 @@ class Image(object):
         return tmp_dir
 
     def _load_image(self, directory):
-        tar_file = os.path.join(self.tmp_dir, "image.tar")
+        """
+        Loads the image into the Docker daemon. The archive is generated on
+        the fly and streamed to the daemon, it is never written to the disk.
+        """
+
+        fd_r, fd_w = os.pipe()
+
+        r = os.fdopen(fd_r, "rb")
+        w = os.fdopen(fd_w, "wb")
+
+        errors = []
 
-        self._tar_image(tar_file, directory)
+        def write():
+            try:
+                with w:
+                    with tarfile.open(
+                        fileobj=w, mode="w|", format=tarfile.PAX_FORMAT
+                    ) as tar:
+                        self._add_image_files(tar, directory)
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        total = self._dir_size(directory)
+
+        def read():
+            done = 0
+
+            for chunk in iter(lambda: r.read(10485760), b""):
+                done += len(chunk)
+                self._report_progress("load", done, total)
+                yield chunk
 
-        with open(tar_file, "rb") as f:
+        try:
             self.log.debug("Loading squashed image...")
-            self.docker.load_image(f)
-            self.log.debug("Image loaded!")
+            self.docker.load_image(read())
+        finally:
+            # Make sure the writer does not wait for a reader forever
+            r.close()
+            writer.join()
+
+        if errors:
+            raise SquashError(
+                f"Generating the squashed image archive failed: {errors[0]}"
+            )
 
-        os.remove(tar_file)
+        self.log.debug("Image loaded!")
 
     def _tar_image(self, target_tar_file, directory):
-        with tarfile.open(target_tar_file, "w", format=tarfile.PAX_FORMAT) as tar:
-            self.log.debug("Generating tar archive for the squashed image...")
-            with Chdir(directory):
-                # docker produces images like this:
-                #   repositories
-                #   <layer>/json
-                # and not:
-                #   ./
-                #   ./repositories
-                #   ./<layer>/json
-                for f in os.listdir("."):
-                    tar.add(f)
-            self.log.debug("Archive generated")
+        with self.stats.phase("archive") as phase:
+            with tarfile.open(target_tar_file, "w", format=tarfile.PAX_FORMAT) as tar:
+                self.log.debug("Generating tar archive for the squashed image...")
+                self._add_image_files(tar, directory)
+                self.log.debug("Archive generated")
+
+            phase.bytes += os.path.getsize(target_tar_file)
+
+    def _add_image_files(self, tar, directory):
+        # docker produces images like this:
+        #   repositories
+        #   <layer>/json
+        # and not:
+        #   ./
+        #   ./repositories
+        #   ./<layer>/json
+        #
+        # The working directory is not changed, this can run in a thread
+        for f in os.listdir(directory):
+            tar.add(os.path.join(directory, f), arcname=f)
 
     def _layers_to_squash(self, layers, from_layer):
         """Prepares a list of layer IDs that should be squashed"""
@@ -372,7 +1006,13 @@ class Image(object):
             self.log.info("Saving image %s to %s directory..." % (image_id, directory))
             self.log.debug("Try #%s..." % (x + 1))
 
+            # The directory can contain data from a previous attempt
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+
             try:
+                import docker as docker_library
+
                 image = self.docker.get_image(image_id)
 
                 if int(docker_library.__version__.split(".")[0]) < 3:
@@ -386,49 +1026,466 @@ class Image(object):
                     # Docker library >=3.0.0 returns iterator over raw data
                     self.log.debug("Extracting image using iterator over raw data")
 
-                    fd_r, fd_w = os.pipe()
+                    fd_r, fd_w = os.pipe()
+
+                    r = os.fdopen(fd_r, "rb")
+                    w = os.fdopen(fd_w, "wb")
+
+                    extracter = threading.Thread(
+                        target=self._extract_tar, args=(r, directory)
+                    )
+                    extracter.start()
+
+                    done = 0
+
+                    for chunk in image:
+                        w.write(chunk)
+                        done += len(chunk)
+                        # The size of the image is just an estimate of the
+                        # size of the archive
+                        self._report_progress(
+                            "save", done, getattr(self, "old_image_size", None)
+                        )
+
+                    w.flush()
+                    w.close()
+
+                    extracter.join()
+                    r.close()
+                self.log.info("Image saved!")
+                return True
+            except Exception as e:
+                self.log.exception(e)
+                self.log.warning(
+                    f"An error occurred while saving the {image_id} image, retrying..."
+                )
+
+        raise SquashError(f"Couldn't save {image_id} image!")
+
+    def _unpack(self, tar_file, directory):
+        """Unpacks tar archive to selected directory"""
+
+        self.log.info("Unpacking %s tar file to %s directory" % (tar_file, directory))
+
+        with tarfile.open(tar_file, "r") as tar:
+            tar.extractall(path=directory)
+
+        self.log.info("Archive unpacked!")
+
+    def _read_layers(self, layers, image_id, sizes=None):
+        """Reads the JSON metadata for specified layer / image id"""
+
+        for layer in self.docker.history(image_id):
+            layers.append(layer["Id"])
+
+            if sizes is not None:
+                sizes.append(layer.get("Size", 0))
+
+    def _check_disk_space(self, layer_sizes_to_squash):
+        """
+        Estimates the peak usage of the temporary directory and makes sure
+        there is enough free space before the image is saved. At the peak the
+        temporary directory holds the old image, the squashed layer (which is
+        at most as big as all squashed layers together) and the archive of
+        the new image (which is at most as big as the old image).
+
+        If there is not enough space and the temporary directory was not
+        specified by the user, the first scratch directory (listed in the
+        DOCKER_SQUASH_SCRATCH_DIRS environment variable) with enough free
+        space is used instead.
+        """
+
+        old_image_size = self.old_image_size or sum(self.old_image_layer_sizes)
+        required = 2 * old_image_size + sum(layer_sizes_to_squash)
+        available = self._free_space(self.tmp_dir)
+
+        self.log.debug(
+            "Estimated temporary space required: %.2f MB, available in '%s': %.2f MB"
+            % (required / 1024 / 1024, self.tmp_dir, available / 1024 / 1024)
+        )
+
+        if available >= required:
+            return
+
+        if not self.tmp_dir_provided:
+            for scratch_dir in self._scratch_dirs():
+                if self._free_space(scratch_dir) >= required:
+                    self.log.info(
+                        "Not enough free space in '%s', using '%s' scratch directory instead"
+                        % (self.tmp_dir, scratch_dir)
+                    )
+                    self._relocate_tmp_directory(scratch_dir)
+                    return
+
+        raise SquashError(
+            f"Not enough free space in the '{self.tmp_dir}' temporary directory, squashing requires up to {required / 1024 / 1024:.2f} MB, available {available / 1024 / 1024:.2f} MB"
+        )
+
+    def _scratch_dirs(self):
+        return [
+            d
+            for d in os.getenv("DOCKER_SQUASH_SCRATCH_DIRS", "").split(os.pathsep)
+            if d
+        ]
+
+    def _free_space(self, directory):
+        try:
+            return shutil.disk_usage(directory).free
+        except OSError as e:
+            self.log.debug("Could not read free space in '%s': %s" % (directory, e))
+            return 0
+
+    def _relocate_tmp_directory(self, scratch_dir):
+        """
+        Moves the temporary directory, together with files already stored
+        there, to the scratch directory.
+        """
+
+        tmp_dir = tempfile.mkdtemp(prefix="docker-squash-", dir=scratch_dir)
+
+        for name in os.listdir(self.tmp_dir):
+            shutil.move(os.path.join(self.tmp_dir, name), tmp_dir)
+
+        os.rmdir(self.tmp_dir)
+
+        self.tmp_dir = tmp_dir
+        self.log.debug("Using %s as the temporary directory" % self.tmp_dir)
+
+        self._create_work_directories()
+
+    def _use_memory(self):
+        """
+        Moves the temporary directory to the memory backed file system, if
+        the image is small enough and there is enough free memory. All
+        files are then kept in memory, no data is written to the disk.
+
+        Otherwise (or if the size of the image cannot be estimated) the
+        disk is used.
+        """
+
+        image_size = self._estimate_image_size()
+
+        if image_size is None or image_size > self.in_memory_threshold:
+            self.log.info("Image is too large to be squashed in memory, using disk")
+            return
+
+        # Old image, squashed layer and new image
+        required = 3 * image_size
+
+        if self._free_space(MEMORY_DIR) < required:
+            self.log.info("Not enough free memory to squash the image, using disk")
+            return
+
+        self.log.info("Squashing image in memory...")
+        self._relocate_tmp_directory(MEMORY_DIR)
+
+    def _estimate_image_size(self):
+        """
+        Estimates the size of the uncompressed image. Returns None if the
+        size cannot be estimated without fetching the image.
+        """
+
+        if not self.transport:
+            return self.old_image_size or sum(self.old_image_layer_sizes)
+
+        if self.transport == common.DOCKER_ARCHIVE_TRANSPORT:
+            return os.path.getsize(self.reference)
+
+        # Layers in OCI image layouts and in registries are usually
+        # compressed, the size of uncompressed data is not known
+        return None
+
+    def _read_transport_layers(self, layers):
+        """
+        Reads layers of an image that is not read from the Docker daemon,
+        but from a 'docker save' tar archive, OCI image layout directory or
+        from a registry.
+
+        Layer IDs are not stored in these formats, the history from the
+        image config is used to find out how many layers there are. Only
+        the top layer gets an ID (the ID of the image), all other layers
+        are reported as '<missing>', similar to what 'docker history' shows
+        for pulled images.
+        """
+
+        if self.transport in common.LOCAL_TRANSPORTS and not os.path.exists(
+            self.reference
+        ):
+            raise SquashError(
+                f"The '{self.reference}' path provided as the image to squash does not exist"
+            )
+
+        config = self._read_transport_image_metadata()[1]
+        history = config.get("history", [])
+
+        if not history:
+            raise SquashError(
+                f"No history found in the configuration of the '{self.reference}' image"
+            )
+
+        layers.extend(["<missing>"] * (len(history) - 1))
+        layers.append(self.old_image_id)
+
+    def _read_transport_image_metadata(self):
+        """
+        Reads the manifest (in the 'docker save' format) and the config of
+        the image. As a side effect the ID of the image is set.
+        """
+
+        if self.transport == common.REGISTRY_TRANSPORT:
+            manifest, config = self._read_registry_image_metadata()
+        elif self.transport == common.DOCKER_ARCHIVE_TRANSPORT:
+            with tarfile.open(self.reference, "r") as tar:
+
+                def read_json(name):
+                    return json.load(
+                        tar.extractfile(tar.getmember(name)),
+                        object_pairs_hook=OrderedDict,
+                    )
+
+                manifest, config = self._read_image_metadata(read_json)
+        else:
+
+            def read_json(name):
+                with open(os.path.join(self.reference, name), "r") as f:
+                    return json.load(f, object_pairs_hook=OrderedDict)
+
+            manifest, config = self._read_image_metadata(read_json)
+
+        # Config file is named after its digest, which is the image ID
+        self.old_image_id = "sha256:%s" % os.path.basename(manifest["Config"]).replace(
+            ".json", ""
+        )
+
+        return manifest, config
+
+    def _read_image_metadata(self, read_json):
+        try:
+            manifest = read_json("manifest.json")[0]
+        except (KeyError, FileNotFoundError):
+            try:
+                manifest = self._manifest_from_oci_index(read_json)
+            except (KeyError, FileNotFoundError):
+                raise SquashError(
+                    f"Unable to locate manifest.json nor index.json in the '{self.reference}' image"
+                )
+
+        return manifest, read_json(manifest["Config"])
+
+    def _read_registry_image_metadata(self):
+        """
+        Reads the manifest and the config of the image from the registry.
+        Only the config is downloaded, layers are fetched later, when we know
+        which of them are needed.
+        """
+
+        from docker_squash.lib import registry
+
+        registry_name, repository, reference = registry.parse_reference(self.reference)
+        self.registry_client = registry.Registry(self.log, registry_name, repository)
+
+        self.log.info(
+            "Reading %s/%s:%s image from registry..."
+            % (registry_name, repository, reference)
+        )
+
+        descriptor = {}
+        manifest = self.registry_client.get_manifest(reference)
+
+        # Multi-platform image, select the platform
+        while "manifests" in manifest:
+            descriptor = self._select_manifest(manifest["manifests"])
+            manifest = self.registry_client.get_manifest(descriptor["digest"])
+
+        # Keep layer descriptors, so that we can reference or mount layers
+        # in the registry without downloading them
+        self.source_layers = {
+            self._blob_path(layer["digest"]): layer for layer in manifest["layers"]
+        }
+        self.source_manifest = self._convert_manifest(manifest, descriptor)
+
+        config_file = os.path.join(self.old_image_dir, self.source_manifest["Config"])
+        self.registry_client.get_blob(manifest["config"]["digest"], config_file)
+
+        with open(config_file, "r") as f:
+            config = json.load(f, object_pairs_hook=OrderedDict)
+
+        return self.source_manifest, config
+
+    def platforms(self):
+        """
+        Returns names and descriptions of all platforms of the multi-platform
+        image (OCI image layout or image in a registry), the most specific
+        name (including the variant) is used. Attestation manifests are
+        ignored.
+        """
+
+        if self.transport == common.REGISTRY_TRANSPORT:
+            from docker_squash.lib import registry
+
+            registry_name, repository, reference = registry.parse_reference(
+                self.reference
+            )
+            client = registry.Registry(self.log, registry_name, repository)
+            manifests = client.get_manifest(reference).get("manifests", [])
+
+            def read_manifest(descriptor):
+                return client.get_manifest(descriptor["digest"])
+
+        elif self.transport == common.OCI_TRANSPORT:
+
+            def read_json(name):
+                with open(os.path.join(self.reference, name), "r") as f:
+                    return json.load(f, object_pairs_hook=OrderedDict)
+
+            def read_manifest(descriptor):
+                return read_json(self._blob_path(descriptor["digest"]))
+
+            try:
+                manifests = read_json("index.json")["manifests"]
+            except (KeyError, FileNotFoundError):
+                manifests = []
+        else:
+            manifests = []
+
+        # Images in OCI image layout written by Docker reference the index
+        # with platform manifests, follow it
+        while manifests and not any("platform" in m for m in manifests):
+            manifests = read_manifest(manifests[0]).get("manifests", [])
+
+        platforms = [
+            (self._platform_names(m)[-1], m["platform"])
+            for m in manifests
+            if m.get("platform") and m["platform"].get("os") != "unknown"
+        ]
+
+        if not platforms:
+            raise SquashError(f"The {self.image} image is not a multi-platform image")
+
+        return platforms
+
+    def _manifest_from_oci_index(self, read_json):
+        """
+        Converts the manifest referenced by the OCI index.json file into
+        the manifest format used by 'docker save' (manifest.json). Paths to
+        blobs are relative to the root of the OCI image layout.
+        """
+
+        descriptor = self._select_manifest(read_json("index.json")["manifests"])
+        manifest = read_json(self._blob_path(descriptor["digest"]))
+
+        # Nested index, follow it
+        while "manifests" in manifest:
+            descriptor = self._select_manifest(manifest["manifests"])
+            manifest = read_json(self._blob_path(descriptor["digest"]))
+
+        return self._convert_manifest(manifest, descriptor)
+
+    def _select_manifest(self, manifests):
+        """
+        Selects the descriptor of the manifest for the requested platform
+        from the list of manifests in an index. Attestation manifests (with
+        the 'unknown' platform) are ignored. If no platform was requested, the
+        first manifest is selected.
+        """
+
+        candidates = [
+            m for m in manifests if m.get("platform", {}).get("os") != "unknown"
+        ]
+
+        if self.platform:
+            candidates = [
+                m for m in candidates if self.platform in self._platform_names(m)
+            ]
+
+        if not candidates:
+            raise SquashError(
+                f"Could not find image for the {self.platform} platform in the {self.image} image"
+            )
+
+        return candidates[0]
+
+    def _platform_names(self, descriptor):
+        platform = descriptor.get("platform")
+
+        if not platform:
+            return []
 
-                    r = os.fdopen(fd_r, "rb")
-                    w = os.fdopen(fd_w, "wb")
+        name = "%s/%s" % (platform.get("os"), platform.get("architecture"))
 
-                    extracter = threading.Thread(
-                        target=self._extract_tar, args=(r, directory)
-                    )
-                    extracter.start()
+        if platform.get("variant"):
+            return [name, "%s/%s" % (name, platform["variant"])]
 
-                    for chunk in image:
-                        w.write(chunk)
+        return [name]
 
-                    w.flush()
-                    w.close()
+    def _convert_manifest(self, manifest, descriptor):
+        """
+        Converts the OCI (or Docker v2 schema 2) manifest into the manifest
+        format used by 'docker save'.
+        """
 
-                    extracter.join()
-                    r.close()
-                self.log.info("Image saved!")
-                return True
-            except Exception as e:
-                self.log.exception(e)
-                self.log.warning(
-                    f"An error occurred while saving the {image_id} image, retrying..."
-                )
+        converted = OrderedDict()
+        converted["Config"] = self._blob_path(manifest["config"]["digest"])
 
-        raise SquashError(f"Couldn't save {image_id} image!")
+        # Docker (and containerd) store the full image name in its own
+        # annotation, the OCI one contains just the tag
+        annotations = descriptor.get("annotations", {})
+        ref_name = annotations.get(
+            "io.containerd.image.name",
+            annotations.get("org.opencontainers.image.ref.name"),
+        )
+        converted["RepoTags"] = [ref_name] if ref_name else []
+        converted["Layers"] = [
+            self._blob_path(layer["digest"]) for layer in manifest["layers"]
+        ]
 
-    def _unpack(self, tar_file, directory):
-        """Unpacks tar archive to selected directory"""
+        return converted
 
-        self.log.info("Unpacking %s tar file to %s directory" % (tar_file, directory))
+    def _blob_path(self, digest):
+        return "blobs/%s" % digest.replace(":", "/", 1)
 
-        with tarfile.open(tar_file, "r") as tar:
-            tar.extractall(path=directory)
+    def _fetch_transport_image(self, directory):
+        """
+        Makes the content of the image available in the specified directory.
+        Tar archives are unpacked, files in OCI image layout are linked (or
+        copied if linking is not possible) so that the original layout is
+        never modified.
 
-        self.log.info("Archive unpacked!")
+        Layers of images read from a registry are downloaded later, only
+        when required.
+        """
 
-    def _read_layers(self, layers, image_id):
-        """Reads the JSON metadata for specified layer / image id"""
+        if self.transport == common.REGISTRY_TRANSPORT:
+            return
 
-        for layer in self.docker.history(image_id):
-            layers.append(layer["Id"])
+        # The directory can contain data from an interrupted run
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+        if self.transport == common.DOCKER_ARCHIVE_TRANSPORT:
+            self._unpack(self.reference, directory)
+        else:
+            self.log.info(
+                "Linking %s OCI image layout to %s directory..."
+                % (self.reference, directory)
+            )
+            for root, _, files in os.walk(self.reference):
+                target = os.path.join(directory, os.path.relpath(root, self.reference))
+                os.makedirs(target, exist_ok=True)
+
+                for f in files:
+                    self._link_or_copy(os.path.join(root, f), os.path.join(target, f))
+
+    def _link_or_copy(self, src, dest):
+        """
+        Hard links the file, falling back to copying when source and target are
+        on different file systems.
+        """
+
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
 
     def _parse_image_name(self, image):
         """
@@ -509,9 +1566,28 @@ class Image(object):
         """
         for layer in layers:
             layer_id = layer.replace("sha256:", "")
+            layer_path = os.path.join(src, layer_id)
+
+            if not os.path.exists(layer_path) and os.path.exists(
+                os.path.join(dest, layer_id)
+            ):
+                self.log.debug("Layer '%s' was already moved, skipping" % layer_id)
+                continue
+
+            if self.transport == common.REGISTRY_TRANSPORT and not os.path.exists(
+                layer_path
+            ):
+                self.log.debug(
+                    "Unmodified layer '%s' was not downloaded, skipping" % layer_id
+                )
+                continue
 
             self.log.debug("Moving unmodified layer '%s'..." % layer_id)
-            shutil.move(os.path.join(src, layer_id), dest)
+
+            # Layer may be a file in a subdirectory (OCI image layout)
+            target_path = os.path.join(dest, layer_id)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.move(layer_path, target_path)
 
     def _file_should_be_skipped(self, file_name, file_paths):
         # file_paths is now array of array with files to be skipped.
@@ -553,13 +1629,17 @@ class Image(object):
         This method is responsible for adding back all markers that were not
         added to the squashed layer AND files they refer to can be found in layers
         we do not squash.
+
+        Returns the list of markers that were added back.
         """
 
+        added = []
+
         if markers:
             self.log.debug("Marker files to add: %s" % [o.name for o in markers.keys()])
         else:
             # No marker files to add
-            return
+            return added
 
         # https://github.com/goldmann/docker-squash/issues/108
         # Some tar archives do have the filenames prefixed with './'
@@ -607,15 +1687,54 @@ class Image(object):
                 # Add the file name to the list too to avoid re-reading all files
                 # in tar archive
                 tar_files.append(normalized_file)
+                added.append(marker)
             else:
                 self.log.debug("Skipping '%s' marker file..." % marker.name)
 
+        return added
+
+    def _add_exclusion_markers(self, excluded_files, tar, files_in_layers):
+        """
+        Adds marker files for excluded files which can be found in layers we
+        do not squash, otherwise their older versions would be visible in the
+        squashed image. If the content of these layers is unknown, markers
+        for all excluded files are added.
+        """
+
+        if files_in_layers is None:
+            files_in_moved_layers = None
+        else:
+            files_in_moved_layers = set().union(*files_in_layers.values())
+
+        tar_files = set(self._normalize_path(x) for x in tar.getnames())
+        marked = set()
+
+        # Directories come before their content, which is hidden with them
+        for path in sorted(excluded_files):
+            if files_in_moved_layers is not None and path not in files_in_moved_layers:
+                continue
+
+            if any(d in marked for d in self._path_hierarchy(path)):
+                continue
+
+            marker = os.path.join(
+                os.path.dirname(path), ".wh.%s" % os.path.basename(path)
+            )
+
+            if marker not in tar_files:
+                self.log.debug("Adding '%s' marker file for excluded file" % marker)
+                tar.addfile(tarfile.TarInfo(name=marker.lstrip("/")))
+
+            marked.add(path)
+
     def _normalize_path(
         self, path: Union[str, pathlib.Path]
     ) -> Union[str, pathlib.Path]:
         return os.path.normpath(os.path.join("/", path))
 
-    def _add_hardlinks(self, squashed_tar, squashed_files, to_skip, skipped_hard_links):
+    def _add_hardlinks(
+        self, squashed_tar, squashed_files, to_skip, skipped_hard_links, layer_reports
+    ):
         for layer, hardlinks_in_layer in enumerate(skipped_hard_links):
             # We need to start from 1, that's why we bump it here
             current_layer = layer + 1
@@ -645,38 +1764,32 @@ class Image(object):
                     or normalized_name in squashed_files
                     or normalized_linkname not in squashed_files
                 ):
-                    self.log.debug(
-                        "Found a hard link '%s' to a file which is marked to be skipped: '%s', skipping link too"
-                        % (normalized_name, normalized_linkname)
+                    self._report_dropped(
+                        layer_reports[layer], "hardlinks_skipped", member, "hardlink"
                     )
                 else:
-                    if self.debug:
-                        self.log.debug(
-                            "Adding hard link '%s' pointing to '%s' back..."
-                            % (normalized_name, normalized_linkname)
-                        )
-
                     squashed_files.append(normalized_name)
                     squashed_tar.addfile(member)
+                    self._report_kept(layer_reports[layer], member, "hardlink")
 
-    def _add_file(self, member, content, squashed_tar, squashed_files, to_skip):
+    def _add_file(
+        self, member, content, squashed_tar, squashed_files, to_skip, duplicates=None
+    ):
         normalized_name = self._normalize_path(member.name)
 
         if normalized_name in squashed_files:
-            self.log.debug(
-                "Skipping file '%s' because it is already squashed" % normalized_name
-            )
-            return
+            return False
 
         if self._file_should_be_skipped(normalized_name, to_skip):
-            self.log.debug(
-                "Skipping '%s' file because it's on the list to skip files"
-                % normalized_name
-            )
-            return
+            return False
+
+        # Content of sparse files cannot be reliably read again after hashing,
+        # rewinding does not restore the position in their sparse map
+        if content and duplicates is not None and member.size and not member.sparse:
+            member, content = self._deduplicate(member, content, duplicates)
 
         if content:
-            squashed_tar.addfile(member, content)
+            self._add_member(squashed_tar, member, content)
         else:
             # Special case: other(?) files, we skip the file
             # itself
@@ -685,7 +1798,115 @@ class Image(object):
         # We added a file to the squashed tar, so let's note it
         squashed_files.append(normalized_name)
 
-    def _add_symlinks(self, squashed_tar, squashed_files, to_skip, skipped_sym_links):
+        return True
+
+    def _add_member(self, tar, member, content):
+        """
+        Adds the file to the archive. Sparse files are stored in the PAX 1.0
+        sparse format, so that only their data extents are copied, instead
+        of the whole (expanded) content.
+        """
+
+        if member.sparse is None:
+            tar.addfile(member, content)
+            return
+
+        extents = [(offset, size) for offset, size in member.sparse if size]
+
+        # Trailing hole is described by an empty extent at the end of file
+        if not extents or sum(extents[-1]) < member.size:
+            extents.append((member.size, 0))
+
+        sparse_map = "".join(
+            "%d\n" % number
+            for number in [len(extents)] + [n for extent in extents for n in extent]
+        ).encode()
+        sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+
+        header = copy.copy(member)
+        header.pax_headers = {
+            key: value
+            for key, value in member.pax_headers.items()
+            if not key.startswith("GNU.sparse.") and key not in ("path", "size")
+        }
+        header.pax_headers["GNU.sparse.major"] = "1"
+        header.pax_headers["GNU.sparse.minor"] = "0"
+        header.pax_headers["GNU.sparse.name"] = member.name
+        header.pax_headers["GNU.sparse.realsize"] = str(member.size)
+        header.type = tarfile.REGTYPE
+        header.sparse = None
+        # Readers which do not understand the format extract the sparse
+        # map and the data into this file
+        directory, name = os.path.split(member.name)
+        header.name = os.path.join(directory, "GNUSparseFile.0", name)
+        header.size = len(sparse_map) + sum(size for _, size in extents)
+
+        if self.debug:
+            self.log.debug(
+                "Adding sparse file '%s' with %s data bytes"
+                % (member.name, header.size - len(sparse_map))
+            )
+
+        tar.addfile(header, SparseContent(sparse_map, content, extents))
+
+    def _deduplicate(self, member, content, duplicates):
+        """
+        Finds out if a file with the same content, permissions and ownership
+        was already added to the squashed layer. If it was, a hard link to
+        it is returned to be added instead of the file. Hard links share the
+        inode, the modification time of the first copy is used for all of
+        them.
+        """
+
+        sha256 = hashlib.sha256()
+
+        for chunk in iter(lambda: content.read(10485760), b""):
+            sha256.update(chunk)
+
+        content.seek(0)
+
+        key = (
+            member.size,
+            sha256.hexdigest(),
+            member.mode,
+            member.uid,
+            member.gid,
+            member.uname,
+            member.gname,
+            tuple(
+                sorted(
+                    (name, value)
+                    for name, value in member.pax_headers.items()
+                    if "xattr." in name
+                )
+            ),
+        )
+
+        if key not in duplicates:
+            duplicates[key] = [member.name]
+            return member, content
+
+        if self.debug:
+            self.log.debug(
+                "File '%s' is the same as '%s', adding it as a hard link"
+                % (member.name, duplicates[key][0])
+            )
+
+        duplicates[key].append(member.name)
+
+        link = copy.copy(member)
+        link.pax_headers = dict(member.pax_headers)
+        link.pax_headers.pop("size", None)
+        link.type = tarfile.LNKTYPE
+        link.sparse = None
+        link.linkname = duplicates[key][0]
+        link.size = 0
+
+        return link, None
+
+    def _add_symlinks(
+        self, squashed_tar, squashed_files, to_skip, skipped_sym_links, layer_reports
+    ):
         added_symlinks = []
         for layer, symlinks_in_layer in enumerate(skipped_sym_links):
             # We need to start from 1, that's why we bump it here
@@ -700,16 +1921,14 @@ class Image(object):
 
                 # File is already in squashed files, skipping
                 if normalized_name in squashed_files:
-                    self.log.debug(
-                        "Found a symbolic link '%s' which is already squashed, skipping"
-                        % (normalized_name)
+                    self._report_dropped(
+                        layer_reports[layer], "symlinks_skipped", member, "shadowed"
                     )
                     continue
 
                 if self._file_should_be_skipped(normalized_name, added_symlinks):
-                    self.log.debug(
-                        "Found a symbolic link '%s' which is on a path to previously squashed symlink, skipping"
-                        % (normalized_name)
+                    self._report_dropped(
+                        layer_reports[layer], "symlinks_skipped", member, "symlink-path"
                     )
                     continue
                 # Find out if the name is on the list of files to skip - if it is - get the layer number
@@ -728,21 +1947,15 @@ class Image(object):
                     or layer_skip_linkname
                     and current_layer > layer_skip_linkname
                 ):
-                    self.log.debug(
-                        "Found a symbolic link '%s' to a file which is marked to be skipped: '%s', skipping link too"
-                        % (normalized_name, normalized_linkname)
+                    self._report_dropped(
+                        layer_reports[layer], "symlinks_skipped", member, "whiteout"
                     )
                 else:
-                    if self.debug:
-                        self.log.debug(
-                            "Adding symbolic link '%s' pointing to '%s' back..."
-                            % (normalized_name, normalized_linkname)
-                        )
-
                     added_symlinks.append([normalized_name])
 
                     squashed_files.append(normalized_name)
                     squashed_tar.addfile(member)
+                    self._report_kept(layer_reports[layer], member, "symlink")
 
         return added_symlinks
 
@@ -754,9 +1967,21 @@ class Image(object):
         layers_to_squash.reverse()
 
         # Find all files in layers that we don't squash
-        files_in_layers_to_move = self._files_in_layers(layers_to_move)
+        if all(
+            os.path.exists(self._extract_tar_name(layer)) for layer in layers_to_move
+        ):
+            with self.stats.phase("index") as phase:
+                files_in_layers_to_move = self._files_in_layers(layers_to_move)
+                phase.bytes += sum(
+                    os.path.getsize(self._extract_tar_name(layer))
+                    for layer in layers_to_move
+                )
+        else:
+            # Content of the layers is unknown (these were not downloaded),
+            # all marker files will be added back
+            files_in_layers_to_move = None
 
-        with tarfile.open(
+        with self.stats.phase("merge") as phase, tarfile.open(
             self.squashed_tar, "w", format=tarfile.PAX_FORMAT
         ) as squashed_tar:
             to_skip = []
@@ -768,7 +1993,28 @@ class Image(object):
             squashed_files = []
             # List of opaque directories in the image
             opaque_dirs = []
-            reading_layers: List[tarfile.TarFile] = []
+            # Layers which need to stay open, because some of their files
+            # will be added at the end of squashing
+            reading_layers: List[Tuple[str, tarfile.TarFile]] = []
+            # The same layer (blob) can be used multiple times in the image
+            remaining_uses = Counter(layers_to_squash)
+            # Layers which are moved or carried over as they are
+            layers_to_keep = set(layers_to_move) | set(self.layer_paths_to_carry)
+            # Files with the same content by their metadata and digest,
+            # the first file is the target of hard links, if enabled
+            duplicates = {} if self.deduplicate else None
+            # Content statistics, in the same order as layers are squashed
+            layer_reports = []
+            # Layer reports for skipped marker files
+            marker_reports = {}
+            # Excluded files, these may exist in layers we do not squash
+            excluded_files = set()
+            # Progress of reading layers to squash
+            total = sum(
+                os.path.getsize(self._extract_tar_name(layer))
+                for layer in layers_to_squash
+            )
+            done = 0
 
             for layer_id in layers_to_squash:
                 layer_tar_file = self._extract_tar_name(layer_id)
@@ -778,12 +2024,18 @@ class Image(object):
                 layer_tar: tarfile.TarFile = tarfile.open(
                     layer_tar_file, "r", format=tarfile.PAX_FORMAT
                 )
-                reading_layers.append(layer_tar)
+                layer_size = os.path.getsize(layer_tar_file)
+                remaining_uses[layer_id] -= 1
+                report = self._new_layer_report(layer_id)
+                layer_reports.append(report)
                 # Find all marker files for all layers
                 # We need the list of marker files upfront, so we can
                 # skip unnecessary files
                 members = layer_tar.getmembers()
                 markers = self._marker_files(layer_tar, members)
+                # Member offsets are in the uncompressed stream, progress is
+                # reported in bytes of the layer file, which may be compressed
+                layer_end = max((m.offset_data + m.size for m in members), default=0)
 
                 skipped_sym_link_files = {}
                 skipped_hard_link_files = {}
@@ -818,16 +2070,31 @@ class Image(object):
                             self._normalize_path(marker.name.replace(".wh.", ""))
                         )
                         skipped_markers[marker] = marker_file
+                        marker_reports[marker] = report
 
                 # Copy all the files to the new tar
                 for member in members:
                     normalized_name = self._normalize_path(member.name)
+                    self._report_progress(
+                        "merge",
+                        done
+                        + layer_size * (member.offset_data + member.size) // layer_end,
+                        total,
+                    )
 
                     if self._is_in_opaque_dir(member, opaque_dirs):
-                        self.log.debug(
-                            "Skipping file '%s' because it is in an opaque directory"
-                            % normalized_name
+                        self._report_dropped(report, "files_opaque", member, "opaque")
+                        continue
+
+                    # Marker files are never excluded, these hide files in
+                    # layers that we do not squash
+                    if member not in markers and self.path_filter.matches(
+                        normalized_name
+                    ):
+                        self._report_dropped(
+                            report, "files_excluded", member, "excluded"
                         )
+                        excluded_files.add(normalized_name)
                         continue
 
                     # Skip all symlinks, we'll investigate them later
@@ -835,19 +2102,14 @@ class Image(object):
                         skipped_sym_link_files[normalized_name] = member
                         continue
 
+                    # Marker files are added back at the end of squashing, if
+                    # necessary
                     if member in skipped_markers.keys():
-                        self.log.debug(
-                            "Skipping '%s' marker file, at the end of squashing we'll see if it's necessary to add it back"
-                            % normalized_name
-                        )
                         continue
 
+                    # Files on a symlink path are added at the end of squashing,
+                    # if the symlink is not added
                     if self._file_should_be_skipped(normalized_name, skipped_sym_links):
-                        self.log.debug(
-                            "Skipping '%s' file because it's on a symlink path, at the end of squashing we'll see if it's necessary to add it back"
-                            % normalized_name
-                        )
-
                         if member.isfile():
                             f = (member, layer_tar.extractfile(member))
                         else:
@@ -858,9 +2120,8 @@ class Image(object):
 
                     # Skip files that are marked to be skipped
                     if self._file_should_be_skipped(normalized_name, to_skip):
-                        self.log.debug(
-                            "Skipping '%s' file because it's on the list to skip files"
-                            % normalized_name
+                        self._report_dropped(
+                            report, "files_whiteout", member, "whiteout"
                         )
                         continue
 
@@ -870,9 +2131,8 @@ class Image(object):
                         # file want to add is older than the one already in the archive.
                         # This is true because we do reverse squashing - from
                         # newer to older layer
-                        self.log.debug(
-                            "Skipping '%s' file because it's older than file already added to the archive"
-                            % normalized_name
+                        self._report_dropped(
+                            report, "files_shadowed", member, "shadowed"
                         )
                         continue
 
@@ -886,42 +2146,468 @@ class Image(object):
                     if member.isfile():
                         content = layer_tar.extractfile(member)
 
-                    self._add_file(
-                        member, content, squashed_tar, squashed_files, to_skip
-                    )
+                    if self._add_file(
+                        member,
+                        content,
+                        squashed_tar,
+                        squashed_files,
+                        to_skip,
+                        duplicates,
+                    ):
+                        self._report_kept(report, member, "file")
+                    else:
+                        self._report_dropped(
+                            report, "files_shadowed", member, "shadowed"
+                        )
+
+                done += layer_size
+                self._report_progress("merge", done, total)
 
                 skipped_hard_links.append(skipped_hard_link_files)
                 skipped_files.append(skipped_files_in_layer)
                 opaque_dirs += layer_opaque_dirs
 
+                # Hard links, symbolic links and marker files are added
+                # later without reading the layer, the layer can be released
+                # right away, unless there are files with deferred content
+                if any(content for _, content in skipped_files_in_layer.values()):
+                    reading_layers.append((layer_id, layer_tar))
+                else:
+                    layer_tar.close()
+                    self._release_layer(layer_id, remaining_uses, layers_to_keep)
+
             self._add_hardlinks(
-                squashed_tar, squashed_files, to_skip, skipped_hard_links
+                squashed_tar, squashed_files, to_skip, skipped_hard_links, layer_reports
             )
             added_symlinks = self._add_symlinks(
-                squashed_tar, squashed_files, to_skip, skipped_sym_links
+                squashed_tar, squashed_files, to_skip, skipped_sym_links, layer_reports
             )
 
-            for layer in skipped_files:
+            for report, layer in zip(layer_reports, skipped_files):
                 for member, content in layer.values():
-                    self._add_file(
-                        member, content, squashed_tar, squashed_files, added_symlinks
-                    )
+                    if self._add_file(
+                        member,
+                        content,
+                        squashed_tar,
+                        squashed_files,
+                        added_symlinks,
+                        duplicates,
+                    ):
+                        self._report_kept(report, member, "file")
+                    else:
+                        self._report_dropped(
+                            report, "files_shadowed", member, "symlink-path"
+                        )
+
+            added_markers = []
 
-            if files_in_layers_to_move:
+            if layers_to_move:
                 self._reduce(skipped_markers)
 
-                self._add_markers(
+                added_markers = self._add_markers(
                     skipped_markers,
                     squashed_tar,
                     files_in_layers_to_move,
                     added_symlinks,
                 )
 
-            tar: tarfile.TarFile
-            for tar in reading_layers:
-                tar.close()
+                self._add_exclusion_markers(
+                    excluded_files, squashed_tar, files_in_layers_to_move
+                )
+
+            for marker, report in marker_reports.items():
+                if marker in added_markers:
+                    report["markers_added"] += 1
+
+                    if self.trace:
+                        self.trace.record(
+                            report["layer"], marker.name, "keep", "marker"
+                        )
+                else:
+                    report["markers_dropped"] += 1
+
+                    if self.trace:
+                        self.trace.record(
+                            report["layer"], marker.name, "drop", "marker"
+                        )
+
+            for layer_id, layer_tar in reading_layers:
+                layer_tar.close()
+                self._release_layer(layer_id, remaining_uses, layers_to_keep)
+
+        phase.bytes += os.path.getsize(self.squashed_tar)
+
+        if duplicates:
+            self.log.info(
+                "Stored %s duplicate files as hard links, saved %s bytes"
+                % (
+                    sum(len(names) - 1 for names in duplicates.values()),
+                    sum(
+                        size * (len(names) - 1)
+                        for (size, *_), names in duplicates.items()
+                    ),
+                )
+            )
+
+        if self.source_date_epoch is not None or self.layer_order:
+            with self.stats.phase("normalize"):
+                self._normalize_squashed_layer()
+
+        # Layers were squashed from the newest one
+        self.layer_reports = list(reversed(layer_reports))
         self.log.info("Squashing finished!")
 
+    def _normalize_squashed_layer(self):
+        """
+        Rewrites the squashed layer, so that members are ordered (by name,
+        unless other order is requested) and the same content always results
+        in the same archive. Hard links are always placed after their
+        targets, so that these exist when links are extracted.
+
+        In the reproducible mode modification times are clamped to the source
+        date and PAX headers which do not describe the content (access and
+        change times) are removed.
+        """
+
+        self.log.debug("Normalizing squashed layer...")
+
+        if self.layer_order == COMPRESSION_ORDER:
+            order = self._compression_order
+        else:
+            order = self._name_order
+
+        normalized_tar = "%s.normalized" % self.squashed_tar
+
+        with tarfile.open(
+            self.squashed_tar, "r", format=tarfile.PAX_FORMAT
+        ) as squashed_tar, tarfile.open(
+            normalized_tar, "w", format=tarfile.PAX_FORMAT
+        ) as tar:
+            for member in self._ordered_members(squashed_tar.getmembers(), order):
+                if self.source_date_epoch is not None:
+                    member.mtime = min(int(member.mtime), self.source_date_epoch)
+
+                    for header in "atime", "ctime", "mtime":
+                        member.pax_headers.pop(header, None)
+
+                if member.isfile():
+                    self._add_member(tar, member, squashed_tar.extractfile(member))
+                else:
+                    tar.addfile(member)
+
+        os.replace(normalized_tar, self.squashed_tar)
+
+    def _ordered_members(self, members, order):
+        """
+        Sorts members in the order. Hard links are placed after all other
+        members and after their targets, which can be hard links too (for
+        example links to deduplicated files), so that targets exist when
+        links are extracted.
+        """
+
+        members = sorted(members, key=order)
+        links = OrderedDict(
+            (self._normalize_path(m.name), m) for m in members if m.islnk()
+        )
+        ordered = [m for m in members if not m.islnk()]
+
+        for name in list(links):
+            chain = []
+
+            # Follow links to links which were not placed yet
+            while name in links:
+                chain.append(links.pop(name))
+                name = self._normalize_path(chain[-1].linkname)
+
+            ordered.extend(reversed(chain))
+
+        return ordered
+
+    def _name_order(self, member):
+        return (member.islnk(), member.name)
+
+    def _compression_order(self, member):
+        """
+        Groups similar files together, so that compressors (working with a
+        limited window) can find more matches: directories, symbolic links
+        and other special files go first, followed by small files and large
+        files, each grouped by the extension and then by the directory.
+        Hard links are placed last.
+        """
+
+        if member.islnk():
+            group = 3
+        elif not member.isfile():
+            return (0, "", "", member.name)
+        elif member.size < LARGE_FILE_SIZE:
+            group = 1
+        else:
+            group = 2
+
+        directory, name = os.path.split(member.name)
+
+        return (group, os.path.splitext(name)[1].lower(), directory, name)
+
+    def _squashed_layer_dirs(self, count):
+        """
+        Returns directories of squashed layers, from the lowest one. Without
+        splitting there is a single squashed layer.
+        """
+
+        if self.previous_image or self.split_layers and self.split_layers > 1:
+            return ["%s-%d" % (self.squashed_dir, i) for i in range(count)]
+
+        return [self.squashed_dir]
+
+    def _split_squashed_layer(self):
+        """
+        Splits the squashed layer into (at most) the requested number of
+        layers of similar size, so that these can be pulled and extracted
+        in parallel. Returns paths to the new layer archives, from the
+        lowest layer.
+
+        Every layer contains a contiguous range of paths in the tree order,
+        where whiteouts go first in their directory. This way an opaque
+        directory marker is never placed above any other member of the same
+        directory, so it cannot hide them. Hard links are placed in the same
+        layer as their targets.
+        """
+
+        self.log.info("Splitting squashed layer into %s layers..." % self.split_layers)
+
+        with tarfile.open(
+            self.squashed_tar, "r", format=tarfile.PAX_FORMAT
+        ) as squashed_tar:
+            members = squashed_tar.getmembers()
+            ordered = sorted(
+                (m for m in members if not m.islnk()), key=self._tree_order
+            )
+            total = sum(self._member_size(m) for m in ordered)
+            parts = [[] for _ in range(self.split_layers)]
+            part_of = {}
+            size = 0
+
+            for member in ordered:
+                # Members are assigned by the position of their middle in
+                # the ordered content, the index of the part never decreases,
+                # so every part contains a contiguous range of paths
+                member_size = self._member_size(member)
+                i = (
+                    ((2 * size + member_size) * self.split_layers // (2 * total))
+                    if total
+                    else 0
+                )
+                parts[i].append(member)
+                part_of[self._normalize_path(member.name)] = i
+                size += member_size
+
+            for member in members:
+                if member.islnk():
+                    i = part_of.get(
+                        self._normalize_path(member.linkname), len(parts) - 1
+                    )
+                    parts[i].append(member)
+                    part_of[self._normalize_path(member.name)] = i
+
+            layer_tars = self._write_squashed_layers(squashed_tar, parts)
+
+        shutil.rmtree(self.squashed_dir)
+
+        return layer_tars
+
+    def _split_by_churn(self, moved_layers):
+        """
+        Splits the squashed layer into a stable layer with files not changed
+        since the previous image and a thin hot layer with all other files
+        on top of it. Returns paths to the new layer archives, from the
+        lowest layer.
+
+        Headers of unchanged files are taken from the previous image, so the
+        stable layer stays the same (including its digest) as long as none
+        of its files change, even if modification times differ between
+        builds. Opaque directory markers are always stable, these cannot be
+        placed above other members of the directory.
+        """
+
+        self.log.info(
+            "Comparing squashed files with the '%s' previous image..."
+            % self.previous_image
+        )
+
+        previous = self._read_previous_layers(moved_layers)
+
+        with tarfile.open(
+            self.squashed_tar, "r", format=tarfile.PAX_FORMAT
+        ) as squashed_tar:
+            members = squashed_tar.getmembers()
+            headers = {}
+            hot = set()
+
+            for member in members:
+                name = self._normalize_path(member.name)
+                previous_member, previous_digest = previous.get(name, (None, None))
+
+                if previous_member and self._member_signature(
+                    previous_member, previous_digest
+                ) == self._member_signature(
+                    member, self._member_digest(squashed_tar, member)
+                ):
+                    headers[member.name] = previous_member
+                elif not name.endswith(".wh..wh..opq"):
+                    hot.add(name)
+
+            # Hard links need to be stored in the same layer as their targets
+            links = [m for m in members if m.islnk()]
+
+            for member in links:
+                if self._normalize_path(member.name) in hot:
+                    hot.add(self._normalize_path(member.linkname))
+
+            for member in links:
+                if self._normalize_path(member.linkname) in hot:
+                    hot.add(self._normalize_path(member.name))
+
+            parts = [[], []]
+
+            for member in self._ordered_members(members, self._tree_order):
+                parts[self._normalize_path(member.name) in hot].append(member)
+
+            self.log.info(
+                "%s members are unchanged, %s members changed"
+                % (len(parts[0]), len(parts[1]))
+            )
+
+            layer_tars = self._write_squashed_layers(squashed_tar, parts, headers)
+
+        shutil.rmtree(self.squashed_dir)
+
+        return layer_tars
+
+    def _read_previous_layers(self, moved_layers):
+        """
+        Reads headers and content digests of members of the squashed layers
+        of the previous image, by path. Layers which were moved when the
+        previous image was squashed are skipped.
+        """
+
+        transport, path = common.parse_image_reference(self.previous_image)
+
+        if transport not in [None, common.DOCKER_ARCHIVE_TRANSPORT] or not (
+            os.path.isfile(path)
+        ):
+            raise SquashError(
+                f"The '{self.previous_image}' previous image needs to be a tar archive created by 'docker save' or by squashing"
+            )
+
+        files = {}
+
+        with tarfile.open(path, "r") as archive:
+            manifest = json.load(archive.extractfile("manifest.json"))[0]
+
+            # Upper layers take precedence
+            for layer_path in manifest["Layers"][moved_layers:]:
+                with tarfile.open(
+                    fileobj=archive.extractfile(layer_path), mode="r"
+                ) as layer:
+                    for member in layer.getmembers():
+                        files[self._normalize_path(member.name)] = (
+                            member,
+                            self._member_digest(layer, member),
+                        )
+
+        return files
+
+    def _member_digest(self, tar, member):
+        if not member.isfile():
+            return None
+
+        sha256 = hashlib.sha256()
+        f = tar.extractfile(member)
+
+        for chunk in iter(lambda: f.read(10485760), b""):
+            sha256.update(chunk)
+
+        return sha256.hexdigest()
+
+    def _member_signature(self, member, digest):
+        # Modification time is not compared, rebuilt files have a new one
+        return (
+            member.type,
+            member.mode,
+            member.uid,
+            member.gid,
+            member.uname,
+            member.gname,
+            member.linkname,
+            member.size,
+            digest,
+        )
+
+    def _write_squashed_layers(self, squashed_tar, parts, headers=None):
+        """
+        Writes members of the squashed layer, divided into parts, as
+        separate layers, from the lowest one. Empty parts are skipped, but
+        there is always at least one layer. Headers of members can be
+        replaced. Returns paths to the layer archives.
+        """
+
+        parts = [part for part in parts if part] or [[]]
+        layer_tars = []
+
+        for part, directory in zip(parts, self._squashed_layer_dirs(len(parts))):
+            os.makedirs(directory, exist_ok=True)
+            layer_tar = os.path.join(directory, "layer.tar")
+
+            if self.layer_order:
+                part = self._order_split_layer(part)
+
+            with tarfile.open(layer_tar, "w", format=tarfile.PAX_FORMAT) as tar:
+                for member in part:
+                    header = (headers or {}).get(member.name, member)
+
+                    if member.isfile():
+                        self._add_member(tar, header, squashed_tar.extractfile(member))
+                    else:
+                        tar.addfile(header)
+
+            self.log.debug("Layer '%s' contains %s members" % (layer_tar, len(part)))
+            layer_tars.append(layer_tar)
+
+        return layer_tars
+
+    def _order_split_layer(self, members):
+        if self.layer_order == COMPRESSION_ORDER:
+            return self._ordered_members(members, self._compression_order)
+
+        return self._ordered_members(members, self._name_order)
+
+    def _tree_order(self, member):
+        return [
+            (not part.startswith(".wh."), part)
+            for part in self._normalize_path(member.name).split("/")
+        ]
+
+    def _member_size(self, member):
+        # Every member takes at least one header block in the archive
+        return tarfile.BLOCKSIZE + member.size
+
+    def _release_layer(self, layer_id, remaining_uses, layers_to_keep):
+        """
+        Removes the already squashed layer from the old image directory to
+        free the disk space as early as possible. Layers which are still
+        needed (to be squashed again, moved or carried over) are kept.
+        """
+
+        if remaining_uses[layer_id] > 0 or layer_id in layers_to_keep:
+            return
+
+        # The saved image is not complete anymore
+        if self.checkpoint:
+            self.checkpoint.discard("save")
+
+        self.log.debug("Removing squashed layer '%s'..." % layer_id)
+        os.remove(self._extract_tar_name(layer_id))
+
     def _is_in_opaque_dir(self, member, dirs):
         """
         If the member we investigate is an opaque directory
@@ -931,11 +2617,7 @@ class Image(object):
         """
 
         for opaque_dir in dirs:
-            if member.name == opaque_dir or member.name.startswith("%s/" % opaque_dir):
-                self.log.debug(
-                    "Member '%s' found to be part of opaque directory '%s'"
-                    % (member.name, opaque_dir)
-                )
+            if member.name == opaque_dir or member.name.startswith(opaque_dir + "/"):
                 return True
 
         return False
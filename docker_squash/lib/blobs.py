@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+class SharedBlobs(object):
+    """
+    Coordinates images squashed concurrently (for example all platforms of
+    a multi-platform image), so that blobs they have in common are
+    downloaded or pushed only once.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        """ Directory with downloaded blobs, images link them into their own directories """
+        self._lock = threading.Lock()
+        self._actions = {}
+
+    def once(self, key, action):
+        """
+        Calls the action only for the first caller with the key, other
+        callers wait until it finishes. The result of the action (or the
+        exception raised by it) is returned to all callers.
+        """
+
+        with self._lock:
+            first = key not in self._actions
+
+            if first:
+                self._actions[key] = [threading.Event(), None, None]
+
+            entry = self._actions[key]
+
+        if first:
+            try:
+                entry[1] = action()
+            except Exception as e:
+                entry[2] = e
+            finally:
+                entry[0].set()
+        else:
+            entry[0].wait()
+
+        if entry[2] is not None:
+            raise entry[2]
+
+        return entry[1]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+from collections import OrderedDict
+
+from docker_squash.errors import SquashError
+
+
+class Checkpoint(object):
+    """
+    Phases of squashing completed in the temporary directory. The state is
+    stored in a file in the temporary directory, every update is written
+    atomically, so that an interrupted run can be resumed from the last
+    completed phase.
+    """
+
+    FILE_NAME = "checkpoint.json"
+
+    def __init__(self, log, directory):
+        self.log = log
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.state = OrderedDict()
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.state = json.load(f, object_pairs_hook=OrderedDict)
+
+    def start(self, key, date):
+        """
+        Starts squashing of the image identified by the key or resumes it,
+        if there is a checkpoint for the same key already. Returns the date
+        to be used in the metadata: it needs to stay the same when resuming,
+        otherwise already generated IDs would not match.
+        """
+
+        if self.state:
+            if self.state["key"] != key:
+                raise SquashError(
+                    f"The '{os.path.dirname(self.path)}' temporary directory contains a checkpoint of squashing with different parameters, please remove it before you proceed"
+                )
+
+            self.log.info("Resuming squashing from the '%s' checkpoint..." % self.path)
+
+            return self.state["date"]
+
+        self.state["key"] = key
+        self.state["date"] = date
+        self.state["phases"] = OrderedDict()
+        self._write()
+
+        return date
+
+    def done(self, phase):
+        return phase in self.state.get("phases", {})
+
+    def get(self, phase):
+        """Returns data stored when the phase was completed"""
+
+        return self.state["phases"][phase]
+
+    def complete(self, phase, **data):
+        self.log.debug("Phase '%s' completed" % phase)
+        self.state["phases"][phase] = data
+        self._write()
+
+    def discard(self, phase):
+        """Marks the phase as not completed, its results are not valid anymore"""
+
+        if self.done(phase):
+            del self.state["phases"][phase]
+            self._write()
+
+    def _write(self):
+        tmp_path = "%s.tmp" % self.path
+
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.path)
@@ -2,21 +2,46 @@
 
 import os
 
-import docker
-import requests
-
 from docker_squash.errors import Error
 
-# First try to import Docker client using the API
-# available in version 2 of the library and fall
-# back to version 1
-try:
-    from docker.api.client import APIClient as APIClientClass
-except ImportError:
-    from docker.client import Client as APIClientClass
-
 DEFAULT_TIMEOUT_SECONDS = 600
 
+DOCKER_ARCHIVE_TRANSPORT = "docker-archive"
+""" Tar archive produced by 'docker save' """
+OCI_TRANSPORT = "oci"
+""" OCI image layout directory """
+REGISTRY_TRANSPORT = "docker"
+""" Image stored in a registry, referenced as 'docker://registry/repository:tag' """
+
+LOCAL_TRANSPORTS = [DOCKER_ARCHIVE_TRANSPORT, OCI_TRANSPORT]
+
+
+def parse_image_reference(reference):
+    """
+    Splits the image reference into the transport and the reference itself.
+
+    References without a known transport prefix are names (or IDs) of images
+    available in the Docker daemon, for these the transport is None.
+
+    Examples:
+        'docker-archive:/tmp/image.tar' -> ('docker-archive', '/tmp/image.tar')
+        'oci:/tmp/layout' -> ('oci', '/tmp/layout')
+        'docker://localhost:5000/busybox' -> ('docker', 'localhost:5000/busybox')
+        'busybox:latest' -> (None, 'busybox:latest')
+    """
+
+    if reference:
+        transport, separator, rest = reference.partition(":")
+
+        if separator and transport in LOCAL_TRANSPORTS:
+            return transport, rest
+
+        # Make sure we do not confuse it with the 'docker' image
+        if transport == REGISTRY_TRANSPORT and rest.startswith("//"):
+            return transport, rest[2:]
+
+    return None, reference
+
 
 def docker_client(log):
     log.debug("Preparing Docker client...")
@@ -43,6 +68,18 @@ def docker_client(log):
     except KeyError:
         pass
 
+    # The Docker library is imported only when needed, importing it (and
+    # the requests library) takes a significant part of the startup time
+    import docker
+
+    # First try to import Docker client using the API
+    # available in version 2 of the library and fall
+    # back to version 1
+    try:
+        from docker.api.client import APIClient as APIClientClass
+    except ImportError:
+        from docker.client import Client as APIClientClass
+
     params = {"version": "auto"}
     params.update(docker.utils.kwargs_from_env())
     params["timeout"] = timeout
@@ -72,6 +109,8 @@ def docker_client(log):
 
 
 def valid_docker_connection(client):
+    import requests
+
     try:
         return client.ping()
     except requests.exceptions.ConnectionError:
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from docker_squash.errors import SquashError
+
+REGEX_PREFIX = "re:"
+""" Prefix of exclusion rules which are regular expressions instead of globs """
+
+PRESETS = {
+    "apk": ["/var/cache/apk/*"],
+    "apt": [
+        "/var/cache/apt/*.bin",
+        "/var/cache/apt/archives/*.deb",
+        "/var/lib/apt/lists/*",
+    ],
+    "dnf": ["/var/cache/dnf/*", "/var/cache/yum/*"],
+    "npm": ["/root/.npm/*"],
+    "pip": ["/root/.cache/pip/*"],
+    "pycache": ["__pycache__"],
+    "tmp": ["/tmp/*", "/var/tmp/*"],
+}
+""" Named sets of exclusion rules for common build leftovers, cache directories themselves are kept """
+
+
+class PathFilter(object):
+    """
+    Matches normalized (absolute) paths against exclusion rules. A path
+    matches if the rule matches the path itself or any of its parent
+    directories, so excluding a directory excludes all its content.
+
+    Rules are globs by default, where '*' and '?' do not match the '/'
+    separator and '**' matches anything, '**/' matches zero or more
+    directories. Globs containing '/' are matched against the whole path,
+    other globs against a single path component (file or directory name).
+    Rules prefixed with 're:' are regular expressions searched for in the
+    path.
+
+    Rules are indexed instead of being tried one by one: rules without
+    wildcards are looked up in sets of paths and names, all other rules
+    are combined into a single regular expression.
+    """
+
+    def __init__(self, rules=None, presets=None):
+        self.rules = []
+        """ All rules, including rules of presets """
+        self.paths = set()
+        """ Excluded paths, without wildcards """
+        self.names = set()
+        """ Excluded file or directory names, without wildcards """
+        self.patterns = []
+        """ Regular expressions for all other rules """
+
+        for preset in presets or []:
+            if preset not in PRESETS:
+                raise SquashError(
+                    f"Unknown exclusion preset: '{preset}', available presets: {', '.join(sorted(PRESETS))}"
+                )
+
+            for rule in PRESETS[preset]:
+                self._add(rule)
+
+        for rule in rules or []:
+            self._add(rule)
+
+        self.regex = None
+
+        if self.patterns:
+            self.regex = re.compile("|".join(self.patterns), re.DOTALL)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def _add(self, rule):
+        self.rules.append(rule)
+
+        if rule.startswith(REGEX_PREFIX):
+            pattern = rule[len(REGEX_PREFIX) :]
+
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise SquashError(f"Invalid exclusion rule: '{rule}': {e}")
+
+            self.patterns.append("(?:%s)" % pattern)
+        elif "/" in rule.strip("/"):
+            path = "/" + rule.strip("/")
+
+            if self._is_glob(path):
+                self.patterns.append("(?:^%s(?:/|$))" % self._translate(path))
+            else:
+                self.paths.add(path)
+        elif self._is_glob(rule):
+            self.patterns.append(
+                "(?:(?:^|/)%s(?:/|$))" % self._translate(rule.strip("/"))
+            )
+        elif rule.startswith("/"):
+            # Top level directory
+            self.paths.add(rule.rstrip("/"))
+        else:
+            self.names.add(rule.strip("/"))
+
+    def _is_glob(self, rule):
+        return any(c in rule for c in "*?[")
+
+    def _translate(self, glob):
+        """Translates the glob into a regular expression"""
+
+        pattern = []
+        i = 0
+
+        while i < len(glob):
+            c = glob[i]
+
+            # Zero or more directories
+            if glob.startswith("**/", i):
+                pattern.append("(?:.*/)?")
+                i += 3
+                continue
+
+            if glob.startswith("**", i):
+                pattern.append(".*")
+                i += 2
+                continue
+
+            if c == "*":
+                pattern.append("[^/]*")
+            elif c == "?":
+                pattern.append("[^/]")
+            elif c == "[" and "]" in glob[i + 2 :]:
+                end = glob.index("]", i + 2)
+                chars = glob[i + 1 : end].replace("\\", "\\\\")
+
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+
+                pattern.append("[%s]" % chars)
+                i = end
+            else:
+                pattern.append(re.escape(c))
+
+            i += 1
+
+        return "".join(pattern)
+
+    def matches(self, path):
+        """Returns True if the normalized path should be excluded"""
+
+        if self.paths or self.names:
+            parent = path
+
+            while parent not in ("/", ""):
+                if parent in self.paths:
+                    return True
+
+                parent, name = parent.rsplit("/", 1)
+
+                if name in self.names:
+                    return True
+
+        return bool(self.regex and self.regex.search(path))
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from urllib.parse import urljoin
+
+import requests
+
+from docker_squash.errors import SquashError
+from docker_squash.lib.common import DEFAULT_TIMEOUT_SECONDS
+
+DOCKER_HUB_REGISTRY = "docker.io"
+DOCKER_HUB_ENDPOINT = "registry-1.docker.io"
+DOCKER_HUB_AUTH_KEY = "https://index.docker.io/v1/"
+
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+
+def parse_reference(reference):
+    """
+    Splits the image reference into the registry, the repository and the tag
+    (or digest).
+
+    Same rules as in Docker apply: the first component of the name is
+    a registry if it contains a dot or a colon or if it is 'localhost',
+    otherwise Docker Hub is used.
+
+    Examples:
+        'localhost:5000/app:1.0' -> ('localhost:5000', 'app', '1.0')
+        'busybox' -> ('docker.io', 'library/busybox', 'latest')
+        'quay.io/org/app@sha256:abc' -> ('quay.io', 'org/app', 'sha256:abc')
+    """
+
+    name, _, digest = reference.partition("@")
+    tag = "latest"
+
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+
+    parts = name.split("/", 1)
+
+    if len(parts) == 2 and (
+        "." in parts[0] or ":" in parts[0] or parts[0] == "localhost"
+    ):
+        registry, repository = parts
+    else:
+        registry, repository = DOCKER_HUB_REGISTRY, name
+
+    if registry == DOCKER_HUB_REGISTRY and "/" not in repository:
+        repository = "library/%s" % repository
+
+    return registry, repository, digest or tag
+
+
+class Registry(object):
+    """
+    Minimal client for the OCI distribution API, implementing only the
+    operations needed to squash images.
+
+    Credentials are read from the Docker client configuration file
+    (credential helpers are not supported). Registries running on localhost
+    are accessed over plain HTTP, all other over HTTPS.
+    """
+
+    def __init__(self, log, registry, repository):
+        self.log = log
+        self.registry = registry
+        self.repository = repository
+        self.session = requests.Session()
+        self.scopes = []
+
+        if registry == DOCKER_HUB_REGISTRY:
+            host = DOCKER_HUB_ENDPOINT
+        else:
+            host = registry
+
+        if registry.startswith("localhost") or registry.startswith("127."):
+            scheme = "http"
+        else:
+            scheme = "https"
+
+        self.url = "%s://%s/v2/" % (scheme, host)
+
+        try:
+            self.timeout = int(os.getenv("DOCKER_TIMEOUT", DEFAULT_TIMEOUT_SECONDS))
+        except ValueError:
+            self.timeout = DEFAULT_TIMEOUT_SECONDS
+
+    def get_manifest(self, reference):
+        """Fetches the manifest (or index) for the tag or digest"""
+
+        manifest = self.find_manifest(reference)
+
+        if manifest is None:
+            raise SquashError(
+                f"Manifest {reference} not found in the {self.repository} repository of the {self.registry} registry"
+            )
+
+        return manifest
+
+    def find_manifest(self, reference):
+        """Fetches the manifest (or index) for the tag or digest, None if it does not exist"""
+
+        response = self._request(
+            "GET",
+            "manifests/%s" % reference,
+            headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        )
+
+        if response.status_code == 404:
+            return None
+
+        self._check(response, 200)
+
+        return json.loads(response.text, object_pairs_hook=OrderedDict)
+
+    def get_blob(self, digest, path):
+        """Downloads the blob to the specified file, verifying its digest"""
+
+        sha256 = hashlib.sha256()
+        response = self._request("GET", "blobs/%s" % digest, stream=True)
+        self._check(response, 200)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The blob is available under the final name only when it is
+        # complete, interrupted downloads are never mistaken for finished ones
+        partial_path = "%s.partial" % path
+
+        with open(partial_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=10485760):
+                sha256.update(chunk)
+                f.write(chunk)
+
+        if "sha256:%s" % sha256.hexdigest() != digest:
+            os.remove(partial_path)
+            raise SquashError(
+                f"Digest of the blob downloaded from the {self.registry} registry does not match, expected {digest}, got sha256:{sha256.hexdigest()}"
+            )
+
+        os.replace(partial_path, path)
+
+    def blob_exists(self, digest):
+        response = self._request("HEAD", "blobs/%s" % digest)
+
+        return response.status_code == 200
+
+    def mount_blob(self, digest, source_repository):
+        """
+        Tries to mount the blob from other repository in the same registry.
+        Returns True if the blob was mounted.
+        """
+
+        response = self._request(
+            "POST",
+            "blobs/uploads/",
+            params={"mount": digest, "from": source_repository},
+        )
+
+        return response.status_code == 201
+
+    def upload_blob(self, digest, path):
+        """Uploads the blob in a single request"""
+
+        response = self._request("POST", "blobs/uploads/")
+        self._check(response, 202)
+
+        with open(path, "rb") as f:
+            response = self._request(
+                "PUT",
+                response.headers["Location"],
+                params={"digest": digest},
+                data=f,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "Content-Length": str(os.path.getsize(path)),
+                },
+            )
+
+        self._check(response, 201)
+
+    def put_manifest(self, reference, manifest, media_type):
+        response = self._request(
+            "PUT",
+            "manifests/%s" % reference,
+            data=manifest.encode("utf-8"),
+            headers={"Content-Type": media_type},
+        )
+
+        self._check(response, 201)
+
+    def _request(self, method, path, **kwargs):
+        response = self._send(method, path, **kwargs)
+
+        if response.status_code == 401 and self._authenticate(
+            response.headers.get("WWW-Authenticate", "")
+        ):
+            data = kwargs.get("data")
+
+            if hasattr(data, "seek"):
+                data.seek(0)
+
+            response = self._send(method, path, **kwargs)
+
+        return response
+
+    def _send(self, method, path, **kwargs):
+        # Location headers returned by the registry can be absolute
+        url = urljoin(urljoin(self.url, "%s/" % self.repository), path)
+
+        try:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise SquashError(f"Could not connect to the {self.registry} registry: {e}")
+
+    def _check(self, response, *codes):
+        if response.status_code not in codes:
+            raise SquashError(
+                f"Unexpected response from the {self.registry} registry for {response.request.method} {response.url}: {response.status_code} {response.text}"
+            )
+
+    def _authenticate(self, challenge):
+        """
+        Handles the authentication challenge returned by the registry.
+        Returns True if the request should be retried.
+        """
+
+        scheme, _, params = challenge.partition(" ")
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        credentials = self._read_credentials()
+
+        if scheme.lower() == "basic":
+            if not credentials or self.session.auth:
+                return False
+
+            self.session.auth = credentials
+            return True
+
+        if scheme.lower() != "bearer" or "realm" not in params:
+            return False
+
+        scope = params.get("scope")
+
+        if scope in self.scopes:
+            # We already have a token for this scope, it was not enough
+            return False
+
+        if scope:
+            self.scopes.append(scope)
+
+        self.log.debug("Requesting token for %s scopes..." % self.scopes)
+
+        response = requests.get(
+            params["realm"],
+            params={"service": params.get("service"), "scope": self.scopes},
+            auth=credentials,
+            timeout=self.timeout,
+        )
+
+        self._check(response, 200)
+
+        token = response.json()
+        self.session.headers["Authorization"] = "Bearer %s" % token.get(
+            "token", token.get("access_token")
+        )
+
+        return True
+
+    def _read_credentials(self):
+        config_file = os.path.join(
+            os.getenv("DOCKER_CONFIG", os.path.expanduser("~/.docker")), "config.json"
+        )
+
+        try:
+            with open(config_file, "r") as f:
+                auths = json.load(f).get("auths", {})
+        except (OSError, ValueError):
+            return None
+
+        keys = [self.registry, "https://%s" % self.registry]
+
+        if self.registry == DOCKER_HUB_REGISTRY:
+            keys.append(DOCKER_HUB_AUTH_KEY)
+
+        for key in keys:
+            auth = auths.get(key, {}).get("auth")
+
+            if auth:
+                username, _, password = (
+                    base64.b64decode(auth).decode("utf-8").partition(":")
+                )
+                return (username, password)
+
+        return None
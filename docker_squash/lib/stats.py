@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Phase(object):
+    """Measurements of a single phase of squashing"""
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        """ Wall time in seconds """
+        self.cpu_time = 0.0
+        """ CPU time of the process (all threads) in seconds """
+        self.bytes = 0
+        """ Number of bytes processed """
+        self.calls = 0
+
+    def as_dict(self):
+        data = OrderedDict()
+        data["wall_time"] = round(self.wall_time, 6)
+        data["cpu_time"] = round(self.cpu_time, 6)
+        data["bytes"] = self.bytes
+        data["calls"] = self.calls
+
+        return data
+
+
+class Stats(object):
+    """
+    Records the wall time, CPU time and number of bytes processed for every
+    phase of squashing. A phase can be entered multiple times, measurements
+    are summed up.
+
+    If a profile file is provided, selected phases are profiled with cProfile
+    and the collected statistics are written to that file (in the format
+    read by the 'pstats' module).
+    """
+
+    def __init__(self, profile_file=None, profiled_phases=("merge",)):
+        self.phases = OrderedDict()
+        self.profile_file = profile_file
+        self.profiled_phases = profiled_phases
+        self._profiler = None
+        # Images can be squashed concurrently, all of them record the phases
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measures the code executed in the context. The Phase object is
+        returned, so that the number of processed bytes can be added.
+        """
+
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = Phase(name)
+
+        phase = self.phases[name]
+        profiler = None
+
+        if self.profile_file and name in self.profiled_phases:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+
+            profiler = self._profiler
+            profiler.enable()
+
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+
+        try:
+            yield phase
+        finally:
+            with self._lock:
+                phase.wall_time += time.perf_counter() - wall_time
+                phase.cpu_time += time.process_time() - cpu_time
+                phase.calls += 1
+
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_file)
+
+    def add_bytes(self, name, size):
+        """Adds the number of processed bytes to the phase"""
+
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = Phase(name)
+
+            self.phases[name].bytes += size
+
+    def as_dict(self):
+        return OrderedDict(
+            (name, phase.as_dict()) for name, phase in self.phases.items()
+        )
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def report(self):
+        """Returns lines of a human readable table with all phases"""
+
+        lines = ["%-10s %10s %10s %14s" % ("Phase", "Wall [s]", "CPU [s]", "Bytes")]
+
+        for phase in self.phases.values():
+            lines.append(
+                "%-10s %10.3f %10.3f %14d"
+                % (phase.name, phase.wall_time, phase.cpu_time, phase.bytes)
+            )
+
+        lines.append(
+            "%-10s %10.3f %10.3f %14d"
+            % (
+                "total",
+                sum(p.wall_time for p in self.phases.values()),
+                sum(p.cpu_time for p in self.phases.values()),
+                sum(p.bytes for p in self.phases.values()),
+            )
+        )
+
+        return lines
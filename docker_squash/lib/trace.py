@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import json
+import queue
+import threading
+
+BATCH_SIZE = 1024
+""" Number of decisions handed over to the writer thread at once """
+
+
+class DecisionTrace(object):
+    """
+    Records what happened to every file while squashing: the layer the file
+    comes from, its path, the action ('keep' or 'drop') and the reason.
+
+    Recording a decision only appends it to a list, decisions are handed over
+    in batches to a background thread which formats and writes them to the
+    file, one JSON array per line:
+
+        ["<layer id>", "<path>", "<action>", "<reason>"]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "w")
+        self._batch = []
+        # Images can be squashed concurrently, all of them record decisions
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._write, name="decision-trace", daemon=True
+        )
+        self._thread.start()
+
+    def record(self, layer, path, action, reason):
+        with self._lock:
+            self._batch.append((layer, path, action, reason))
+
+            if len(self._batch) >= BATCH_SIZE:
+                self._queue.put(self._batch)
+                self._batch = []
+
+    def close(self):
+        """Writes all recorded decisions and waits for the writer thread"""
+
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write(self):
+        with self._file as f:
+            while True:
+                batch = self._queue.get()
+
+                if batch is None:
+                    break
+
+                f.writelines(
+                    json.dumps(decision, separators=(",", ":")) + "\n"
+                    for decision in batch
+                )
@@ -0,0 +1,109 @@
+import concurrent.futures
+import copy
+import os
+import shutil
+from collections import OrderedDict
+
+from docker_squash.errors import SquashError
+from docker_squash.v2_image import V2Image
+
+
+class MultiPlatformImage(object):
+    """
+    All platforms of a multi-platform image (OCI image layout or image in
+    a registry), squashed concurrently. Each platform is squashed by its own
+    V2Image, the squashed images are referenced by a new index.
+    """
+
+    FORMAT = V2Image.FORMAT
+
+    def __init__(self, log, images, platforms, shared_blobs, workers=None):
+        self.log = log
+        self.images = images
+        """ Platform names mapped to images squashing them """
+        self.platforms = platforms
+        """ Platform names mapped to platform descriptions used in the index """
+        self.shared_blobs = shared_blobs
+        """ Blobs shared by all platforms """
+        self.workers = workers or os.cpu_count() or 1
+        """ Maximum number of platforms squashed (or pushed) at the same time """
+
+    def _map(self, function):
+        """Calls the function for every platform in the worker pool"""
+
+        with concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix="platform"
+        ) as executor:
+            return list(executor.map(function, self.images.items()))
+
+    def squash(self):
+        self.log.info(
+            "Squashing %s platforms: %s..." % (len(self.images), ", ".join(self.images))
+        )
+
+        def squash(item):
+            name, image = item
+            image_id = image.squash()
+            self.log.info("Squashed %s platform, image ID is %s" % (name, image_id))
+
+            return image_id
+
+        return self._map(squash)
+
+    def content_report(self):
+        report = OrderedDict()
+        report["platforms"] = OrderedDict(
+            (name, image.content_report()) for name, image in self.images.items()
+        )
+
+        return report
+
+    def _platform_manifest(self, name, descriptor):
+        descriptor = copy.copy(descriptor)
+        descriptor["platform"] = self.platforms[name]
+
+        return descriptor
+
+    def export_oci_layout(self, target_dir):
+        self.log.info(
+            "Exporting multi-platform image to '%s' OCI image layout..." % target_dir
+        )
+
+        # Blobs are only linked, there is no need to do it concurrently,
+        # blobs shared between platforms are written once
+        manifests = [
+            self._platform_manifest(name, image.export_oci_manifest(target_dir))
+            for name, image in self.images.items()
+        ]
+
+        next(iter(self.images.values())).export_oci_index(target_dir, manifests)
+
+    def push_to_registry(self, reference):
+        self.log.info("Pushing multi-platform image to %s..." % reference)
+
+        def push(item):
+            name, image = item
+
+            return self._platform_manifest(name, image.push_manifest(reference))
+
+        manifests = self._map(push)
+
+        next(iter(self.images.values())).push_index(reference, manifests)
+
+    def export_tar_archive(self, target_tar_file):
+        raise SquashError(
+            "Multi-platform image can be written only as OCI image layout or pushed to a registry"
+        )
+
+    def load_squashed_image(self):
+        raise SquashError(
+            "Multi-platform image cannot be loaded into the Docker daemon"
+        )
+
+    def cleanup(self):
+        for image in self.images.values():
+            # Squashing of the platform may not have started
+            if image.tmp_dir:
+                image.cleanup()
+
+        shutil.rmtree(self.shared_blobs.directory, ignore_errors=True)
@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import concurrent.futures
+import json
 import os
+import re
+import tempfile
+from collections import OrderedDict
 from logging import Logger
-from typing import Optional
+from typing import Callable, List, Optional
 
 import docker.errors as docker_errors
 from packaging import version as packaging_version
 
+from docker_squash.constants import DEFAULT_IN_MEMORY_THRESHOLD
 from docker_squash.errors import SquashError
 from docker_squash.image import Image
 from docker_squash.lib import common
+from docker_squash.lib.blobs import SharedBlobs
+from docker_squash.lib.path_filter import PathFilter
+from docker_squash.lib.stats import Stats
+from docker_squash.lib.trace import DecisionTrace
+from docker_squash.multi_platform_image import MultiPlatformImage
 from docker_squash.v1_image import V1Image
 from docker_squash.v2_image import V2Image
 from docker_squash.version import version
@@ -28,6 +40,26 @@ class Squash(object):
         output_path: Optional[str] = None,
         load_image: Optional[bool] = True,
         cleanup: Optional[bool] = False,
+        platform: Optional[str] = None,
+        stats: Optional[bool] = False,
+        stats_file: Optional[str] = None,
+        profile_file: Optional[str] = None,
+        report_file: Optional[str] = None,
+        trace_file: Optional[str] = None,
+        in_memory: Optional[bool] = False,
+        in_memory_threshold: Optional[int] = DEFAULT_IN_MEMORY_THRESHOLD,
+        resume: Optional[bool] = False,
+        reproducible: Optional[bool] = False,
+        layer_order: Optional[str] = None,
+        split_layers: Optional[int] = None,
+        previous_image: Optional[str] = None,
+        deduplicate: Optional[bool] = False,
+        exclude: Optional[List[str]] = None,
+        exclude_presets: Optional[List[str]] = None,
+        progress: Optional[Callable[[str, int, Optional[int]], None]] = None,
+        all_platforms: Optional[bool] = False,
+        platform_workers: Optional[int] = None,
+        layers: Optional[str] = None,
     ):
         self.log: Logger = log
         self.docker = docker
@@ -39,23 +71,105 @@ class Squash(object):
         self.output_path: str = output_path
         self.load_image: bool = load_image
         self.cleanup: bool = cleanup
+        self.platform: str = platform
+        self.print_stats: bool = stats
+        self.stats_file: str = stats_file
+        self.stats: Stats = Stats(profile_file)
+        self.report_file: str = report_file
+        self.trace_file: str = trace_file
+        self.in_memory_threshold: int = in_memory_threshold if in_memory else None
+        self.resume: bool = resume
+        self.layer_order: str = layer_order
+        self.split_layers: int = split_layers
+        self.previous_image: str = previous_image
+        self.deduplicate: bool = deduplicate
+        self.path_filter: PathFilter = PathFilter(exclude, exclude_presets)
+        self.progress = progress
+        self.all_platforms: bool = all_platforms
+        self.platform_workers: int = platform_workers
+        self.layer_range = None
+        self.source_date_epoch: int = None
+
+        if reproducible:
+            try:
+                self.source_date_epoch = int(os.getenv("SOURCE_DATE_EPOCH", 0))
+            except ValueError:
+                raise SquashError(
+                    "Provided SOURCE_DATE_EPOCH value: %s cannot be parsed as integer"
+                    % os.getenv("SOURCE_DATE_EPOCH")
+                )
+
+        if layers is not None:
+            if from_layer is not None:
+                raise SquashError(
+                    "Range of layers to squash cannot be used together with the layer to squash from"
+                )
+
+            self.layer_range = self._parse_layer_range(layers)
+
+        if split_layers is not None and split_layers < 1:
+            raise SquashError(
+                "Provided number of layers to split the squashed layer into: %s is not a positive number"
+                % split_layers
+            )
+
+        if previous_image and split_layers and split_layers > 1:
+            raise SquashError(
+                "Squashed layer cannot be split into layers of similar size when the previous image is provided"
+            )
+
         self.development = False
 
+        self.transport = common.parse_image_reference(image)[0]
+        self.output_transport, self.output_target = common.parse_image_reference(
+            output_path
+        )
+
+        if all_platforms:
+            self._check_all_platforms(profile_file)
+
         if tag == image and cleanup:
             log.warning("Tag is the same as image; preventing cleanup")
             self.cleanup = False
+        if self.transport and cleanup:
+            log.warning("Image is not read from the Docker daemon; preventing cleanup")
+            self.cleanup = False
         if tmp_dir:
             self.development = True
-        if not docker:
-            self.docker = common.docker_client(self.log)
+        if resume and not tmp_dir:
+            log.warning("Temporary directory is not specified; nothing to resume")
+            self.resume = False
+
+    def _connect(self):
+        """
+        Connects to the Docker daemon, if it is needed, and returns its
+        version (None if the daemon is not used). It is done when running,
+        creating the squash never communicates with the daemon.
+        """
+
+        # Images available locally do not require the Docker daemon,
+        # unless we want to load the squashed image into it
+        if not self.docker and (self.load_image or not self.transport):
+            with self.stats.phase("connect"):
+                self.docker = common.docker_client(self.log)
+
+        if not self.docker:
+            self.log.info("docker-squash version %s..." % version)
+            return None
+
+        with self.stats.phase("connect"):
+            docker_version = self.docker.version()
 
-    def run(self):
-        docker_version = self.docker.version()
         self.log.info(
             "docker-squash version %s, Docker %s, API %s..."
             % (version, docker_version["Version"], docker_version["ApiVersion"])
         )
 
+        return docker_version
+
+    def run(self):
+        docker_version = self._connect()
+
         if self.image is None:
             raise SquashError("Image is not provided")
 
@@ -65,46 +179,235 @@ class Squash(object):
             )
             return
 
-        if self.output_path and os.path.exists(self.output_path):
+        if (
+            self.output_path
+            and self.output_transport
+            not in [common.OCI_TRANSPORT, common.REGISTRY_TRANSPORT]
+            and os.path.exists(self.output_target)
+        ):
             self.log.warning(
                 "Path '%s' specified as output path where the squashed image should be saved already exists, it'll be overriden"
-                % self.output_path
+                % self.output_target
+            )
+
+        trace = DecisionTrace(self.trace_file) if self.trace_file else None
+
+        if self.all_platforms:
+            image = self._create_multi_platform_image(trace)
+        else:
+            image = self._create_image(
+                docker_version, self.platform, self.tmp_dir, trace
             )
 
-        if packaging_version.parse(
+        self.log.info("Using %s image format" % image.FORMAT)
+
+        try:
+            return self.squash(image)
+        except Exception:
+            # https://github.com/goldmann/docker-scripts/issues/44
+            # If development mode is not enabled, make sure we clean up the
+            # temporary directory
+            if not self.development:
+                image.cleanup()
+
+            raise
+        finally:
+            if trace:
+                trace.close()
+
+            self._report_stats()
+
+    def _create_image(
+        self, docker_version, platform, tmp_dir, trace, shared_blobs=None
+    ) -> Image:
+        # Images available locally are always in the v2 format
+        if self.transport or packaging_version.parse(
             docker_version["ApiVersion"]
         ) >= packaging_version.parse("1.22"):
-            image: Image = V2Image(
+            return V2Image(
                 self.log,
                 self.docker,
                 self.image,
                 self.from_layer,
-                self.tmp_dir,
+                tmp_dir,
                 self.tag,
                 self.comment,
+                platform,
+                self.stats,
+                self.in_memory_threshold,
+                self.resume,
+                self.source_date_epoch,
+                self.layer_order,
+                self.split_layers,
+                self.previous_image,
+                self.deduplicate,
+                self.path_filter,
+                self.progress,
+                trace,
+                shared_blobs,
+                self.layer_range,
             )
-        else:
-            image: Image = V1Image(
-                self.log,
-                self.docker,
-                self.image,
-                self.from_layer,
-                self.tmp_dir,
-                self.tag,
+
+        if self.previous_image or self.split_layers and self.split_layers > 1:
+            self.log.warning(
+                "Splitting the squashed layer is not supported for the v1 image format; squashing into a single layer"
             )
 
-        self.log.info("Using %s image format" % image.FORMAT)
+        return V1Image(
+            self.log,
+            self.docker,
+            self.image,
+            self.from_layer,
+            tmp_dir,
+            self.tag,
+            stats=self.stats,
+            in_memory_threshold=self.in_memory_threshold,
+            resume=self.resume,
+            source_date_epoch=self.source_date_epoch,
+            layer_order=self.layer_order,
+            deduplicate=self.deduplicate,
+            path_filter=self.path_filter,
+            progress=self.progress,
+            trace=trace,
+            layer_range=self.layer_range,
+        )
+
+    def _parse_layer_range(self, layers):
+        """
+        Parses the range of layers in the START:END format, both are
+        optional and can be negative (counted from the top of the image)
+        """
+
+        match = re.match(r"^(-?\d+)?:(-?\d+)?$", layers.strip())
+
+        if not match:
+            raise SquashError(
+                "Provided range of layers to squash: %s is not in the START:END format"
+                % layers
+            )
+
+        return tuple(int(index) if index else None for index in match.groups())
+
+    def _check_all_platforms(self, profile_file):
+        if self.platform:
+            raise SquashError(
+                "Platform cannot be selected when squashing all platforms of the image"
+            )
+
+        if self.transport not in [common.OCI_TRANSPORT, common.REGISTRY_TRANSPORT]:
+            raise SquashError(
+                "All platforms can be squashed only for images read from OCI image layout or from a registry"
+            )
+
+        if self.output_transport not in [
+            common.OCI_TRANSPORT,
+            common.REGISTRY_TRANSPORT,
+        ]:
+            raise SquashError(
+                "Squashed multi-platform image can be written only as OCI image layout or pushed to a registry, use the 'oci:PATH' or 'docker://REGISTRY/REPOSITORY:TAG' output path"
+            )
+
+        if self.load_image:
+            raise SquashError(
+                "Squashed multi-platform image cannot be loaded into the Docker daemon, disable loading the image"
+            )
+
+        if profile_file:
+            raise SquashError("Profiling is not supported when squashing all platforms")
+
+        if self.platform_workers is not None and self.platform_workers < 1:
+            raise SquashError(
+                "Provided number of platforms squashed at the same time: %s is not a positive number"
+                % self.platform_workers
+            )
+
+    def _create_multi_platform_image(self, trace) -> MultiPlatformImage:
+        if self.tmp_dir:
+            shared_blobs = SharedBlobs(os.path.join(self.tmp_dir, "shared"))
+        else:
+            shared_blobs = SharedBlobs(tempfile.mkdtemp(prefix="docker-squash-"))
+
+        platforms = OrderedDict(self._create_image(None, None, None, trace).platforms())
+        images = OrderedDict()
+
+        for name in platforms:
+            tmp_dir = None
+
+            # Every platform is squashed in its own subdirectory
+            if self.tmp_dir:
+                tmp_dir = os.path.join(self.tmp_dir, name.replace("/", "-"))
+
+            images[name] = self._create_image(None, name, tmp_dir, trace, shared_blobs)
+
+        return MultiPlatformImage(
+            self.log, images, platforms, shared_blobs, self.platform_workers
+        )
+
+    def analyze(self):
+        """
+        Analyzes the image instead of squashing it: reports space wasted in
+        every layer of the image. The report is returned and written to the
+        report file, if specified.
+        """
+
+        docker_version = self._connect()
+
+        if self.image is None:
+            raise SquashError("Image is not provided")
+
+        image = self._create_image(docker_version, self.platform, self.tmp_dir, None)
 
         try:
-            return self.squash(image)
-        except Exception:
-            # https://github.com/goldmann/docker-scripts/issues/44
-            # If development mode is not enabled, make sure we clean up the
-            # temporary directory
+            report = image.analyze()
+        finally:
             if not self.development:
                 image.cleanup()
 
-            raise
+            self._report_stats()
+
+        if self.report_file:
+            self.log.info("Writing waste report to '%s'..." % self.report_file)
+
+            with open(self.report_file, "w") as f:
+                json.dump(report, f, indent=2)
+
+        return report
+
+    async def run_async(self, executor=None):
+        """
+        Wrapper running the synchronous squashing in a thread of the provided
+        executor (or of the default executor of the event loop), so that it
+        can be awaited. The same executor can be shared by many squashes to
+        limit the number of squashes running at the same time.
+
+        Nothing is asynchronous inside: connecting to the daemon, all the
+        communication with the daemon or registries and processing of the
+        layers is blocking and done in the executor thread. Process pool
+        executors are not supported, the squashing cannot be pickled.
+        """
+
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            raise SquashError(
+                "Squashing cannot be run in a process pool executor, use a thread pool executor"
+            )
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(executor, self.run)
+
+    def _report_stats(self):
+        if self.print_stats:
+            self.log.info("Squashing statistics:")
+
+            for line in self.stats.report():
+                self.log.info(line)
+
+        if self.stats_file:
+            if self.stats_file == "-":
+                print(self.stats.as_json())
+            else:
+                with open(self.stats_file, "w") as f:
+                    f.write(self.stats.as_json())
 
     def _cleanup(self):
         try:
@@ -135,9 +438,21 @@ class Squash(object):
 
         self.log.info("New squashed image ID is %s" % new_image_id)
 
-        if self.output_path:
+        if self.report_file:
+            self.log.info("Writing content report to '%s'..." % self.report_file)
+
+            with open(self.report_file, "w") as f:
+                json.dump(image.content_report(), f, indent=2)
+
+        if self.output_transport == common.OCI_TRANSPORT:
+            # Write the image as OCI image layout
+            image.export_oci_layout(self.output_target)
+        elif self.output_transport == common.REGISTRY_TRANSPORT:
+            # Push only what's missing in the registry
+            image.push_to_registry(self.output_target)
+        elif self.output_path:
             # Move the tar archive to the specified path
-            image.export_tar_archive(self.output_path)
+            image.export_tar_archive(self.output_target)
 
         if self.load_image:
             # Load squashed image into Docker
@@ -154,7 +469,8 @@ class Squash(object):
         # We cannot use here a tag name because it could be used as the target,
         # squashed image tag - we need to use the image ID.
         if self.cleanup:
-            self._cleanup()
+            with self.stats.phase("cleanup"):
+                self._cleanup()
 
         self.log.info("Done")
 
@@ -3,6 +3,7 @@ import os
 import random
 import shutil
 
+from docker_squash.errors import SquashError
 from docker_squash.image import Image
 
 
@@ -24,6 +25,11 @@ class V1Image(Image):
     def _before_squashing(self):
         super(V1Image, self)._before_squashing()
 
+        if self.layers_to_carry:
+            raise SquashError(
+                f"Layers above the squashed range cannot be carried over for the {self.FORMAT} image format"
+            )
+
         if self.layers_to_move:
             self.squash_id = self.layers_to_move[-1]
 
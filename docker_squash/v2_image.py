@@ -1,3 +1,4 @@
+import gzip
 import hashlib
 import json
 import os
@@ -8,6 +9,18 @@ from typing import List, Tuple
 
 from docker_squash.errors import SquashError
 from docker_squash.image import Image
+from docker_squash.lib import common, registry
+
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar"
+
+# Layers referenced by Docker manifests are stored in the same way as OCI ones
+DOCKER_LAYER_MEDIA_TYPES = {
+    "application/vnd.docker.image.rootfs.diff.tar": OCI_LAYER_MEDIA_TYPE,
+    "application/vnd.docker.image.rootfs.diff.tar.gzip": OCI_LAYER_MEDIA_TYPE + "+gzip",
+}
 
 
 class V2Image(Image):
@@ -36,18 +49,67 @@ class V2Image(Image):
             self.old_image_config, self.old_image_manifest, self.layers_to_move
         )
 
+        if self.layers_to_carry:
+            # Layers above the squashed range are these left after moving
+            # all layers up to the end of the range
+            self.layer_paths_to_carry = self._read_layer_paths(
+                self.old_image_config,
+                self.old_image_manifest,
+                self.layers_to_move + self.layers_to_squash,
+            )[0]
+            self.layer_paths_to_squash = self.layer_paths_to_squash[
+                : len(self.layer_paths_to_squash) - len(self.layer_paths_to_carry)
+            ]
+
         if self.layer_paths_to_move:
             self.squash_id = self.layer_paths_to_move[-1]
 
         self.log.debug(f"Layers paths to squash: {self.layer_paths_to_squash}")
         self.log.debug(f"Layers paths to move: {self.layer_paths_to_move}")
+        self.log.debug(f"Layers paths to carry over: {self.layer_paths_to_carry}")
+
+        if self.transport == common.REGISTRY_TRANSPORT and not self.checkpoint.done(
+            "merge"
+        ):
+            # Only layers to squash are needed, moved layers can be
+            # referenced by their digests
+            with self.stats.phase("save"):
+                self._download_layers(self.layer_paths_to_squash, self.old_image_dir)
 
     def _squash(self):
         if self.layer_paths_to_squash:
-            # Prepare the directory
-            os.makedirs(self.squashed_dir)
-            # Merge data layers
-            self._squash_layers(self.layer_paths_to_squash, self.layer_paths_to_move)
+            if self.checkpoint.done("merge"):
+                self.log.info("Layers already squashed, skipping")
+                self.squashed_diff_ids = self.checkpoint.get("merge")["diff_ids"]
+                self.layer_reports = self.checkpoint.get("merge")["layer_reports"]
+            else:
+                # Prepare the directory
+                os.makedirs(self.squashed_dir, exist_ok=True)
+                # Merge data layers
+                self._squash_layers(
+                    self.layer_paths_to_squash, self.layer_paths_to_move
+                )
+
+                if self.previous_image:
+                    with self.stats.phase("split"):
+                        squashed_tars = self._split_by_churn(
+                            len(self.layer_paths_to_move)
+                        )
+                elif self.split_layers and self.split_layers > 1:
+                    with self.stats.phase("split"):
+                        squashed_tars = self._split_squashed_layer()
+                else:
+                    squashed_tars = [self.squashed_tar]
+
+                self.squashed_diff_ids = [
+                    self._compute_sha256(squashed_tar) for squashed_tar in squashed_tars
+                ]
+                self.checkpoint.complete(
+                    "merge",
+                    diff_ids=self.squashed_diff_ids,
+                    layer_reports=self.layer_reports,
+                    size_before=self.size_before,
+                )
 
         self.diff_ids = self._generate_diff_ids()
         self.chain_ids = self._generate_chain_ids(self.diff_ids)
@@ -55,33 +117,54 @@ class V2Image(Image):
         metadata = self._generate_image_metadata()
         image_id = self._write_image_metadata(metadata)
 
-        layer_path_id = None
+        layer_path_ids = []
+        parent = None
 
         if self.layer_paths_to_squash:
-            # Compute layer id to use to name the directory where
-            # we store the layer data inside of the tar archive
-            layer_path_id = self._generate_squashed_layer_path_id()
+            squashed_dirs = self._squashed_layer_dirs(len(self.squashed_diff_ids))
 
-            if self.oci_format:
-                old_layer_path = self.old_image_manifest["Config"]
-            else:
-                if self.layer_paths_to_squash[0]:
-                    old_layer_path = self.layer_paths_to_squash[0]
+            for i, squashed_dir in enumerate(squashed_dirs):
+                # Compute layer id to use to name the directory where
+                # we store the layer data inside of the tar archive
+                layer_path_id = self._generate_squashed_layer_path_id(
+                    self.chain_ids[len(self.layer_paths_to_move) + i], parent
+                )
+
+                if self.oci_format:
+                    old_layer_path = self.old_image_manifest["Config"]
+                else:
+                    if self.layer_paths_to_squash[0]:
+                        old_layer_path = self.layer_paths_to_squash[0]
+                    else:
+                        old_layer_path = layer_path_id
+                    old_layer_path = os.path.join(old_layer_path, "json")
+
+                layer_dir = os.path.join(self.new_image_dir, layer_path_id)
+
+                # When resuming, the layer could be already moved. The same date
+                # is used, so it is the same layer
+                if os.path.exists(layer_dir):
+                    self.log.debug("Squashed layer already moved, skipping")
                 else:
-                    old_layer_path = layer_path_id
-                old_layer_path = os.path.join(old_layer_path, "json")
+                    metadata = self._generate_last_layer_metadata(
+                        layer_path_id, old_layer_path, parent
+                    )
+                    self._write_squashed_layer_metadata(metadata, squashed_dir)
 
-            metadata = self._generate_last_layer_metadata(layer_path_id, old_layer_path)
-            self._write_squashed_layer_metadata(metadata)
+                    # Write version file to the squashed layer
+                    # Even Docker doesn't know why it's needed...
+                    self._write_version_file(squashed_dir)
 
-            # Write version file to the squashed layer
-            # Even Docker doesn't know why it's needed...
-            self._write_version_file(self.squashed_dir)
+                    # Move the temporary squashed layer directory to the correct one
+                    shutil.move(squashed_dir, layer_dir)
 
-            # Move the temporary squashed layer directory to the correct one
-            shutil.move(
-                self.squashed_dir, os.path.join(self.new_image_dir, layer_path_id)
-            )
+                layer_path_ids.append(layer_path_id)
+                # Next squashed layer is placed on top of this one
+                parent = layer_path_id
+
+        carried_layer_paths = self._carry_layers(
+            parent or (self.layer_paths_to_move or [None])[-1]
+        )
 
         manifest = self._generate_manifest_metadata(
             image_id,
@@ -89,11 +172,15 @@ class V2Image(Image):
             self.image_tag,
             self.old_image_manifest,
             self.layer_paths_to_move,
-            layer_path_id,
+            layer_path_ids,
+            carried_layer_paths,
         )
 
         self._write_manifest_metadata(manifest)
 
+        self.new_image_id = image_id
+        self.new_image_manifest = manifest[0]
+
         repository_image_id = manifest[0]["Layers"][-1].split("/")[0]
 
         # Move all the layers that should be untouched
@@ -108,6 +195,596 @@ class V2Image(Image):
 
         return image_id
 
+    def _carry_layers(self, parent):
+        """
+        Moves layers above the squashed range to the new image and returns
+        their paths. Blobs in OCI image layout are named after their content
+        and are moved as they are. Layers stored in directories named after
+        the layer and its parents get new names (based on the new chain IDs),
+        their metadata is updated to point to the new parent.
+        """
+
+        if self.oci_format:
+            self._move_layers(
+                self.layer_paths_to_carry, self.old_image_dir, self.new_image_dir
+            )
+
+            return list(self.layer_paths_to_carry)
+
+        layer_paths = []
+        first = len(self.chain_ids) - len(self.layer_paths_to_carry)
+
+        for i, layer_path in enumerate(self.layer_paths_to_carry):
+            layer_path_id = self._generate_squashed_layer_path_id(
+                self.chain_ids[first + i], parent
+            )
+            layer_dir = os.path.join(self.new_image_dir, layer_path_id)
+
+            if os.path.exists(layer_dir):
+                self.log.debug("Layer '%s' was already carried over" % layer_path)
+            else:
+                metadata = self._read_json_file(
+                    os.path.join(self.old_image_dir, layer_path, "json")
+                )
+
+                if parent:
+                    metadata["parent"] = parent
+                else:
+                    metadata.pop("parent", None)
+
+                metadata["id"] = layer_path_id
+
+                shutil.move(os.path.join(self.old_image_dir, layer_path), layer_dir)
+                self._write_json_metadata(
+                    self._dump_json(metadata)[0], os.path.join(layer_dir, "json")
+                )
+
+            layer_paths.append("%s/layer.tar" % layer_path_id)
+            parent = layer_path_id
+
+        return layer_paths
+
+    def export_oci_layout(self, target_dir):
+        """
+        Writes the squashed image as an OCI image layout into the specified
+        directory. If the directory already contains an OCI image layout,
+        the image is added to it.
+
+        Blobs are named after their digests, which are already known at
+        this point, so no layer is rewritten nor hashed again. Where
+        possible blobs are hard linked from the temporary directory instead
+        of being copied.
+        """
+
+        self.log.info("Exporting image to '%s' OCI image layout..." % target_dir)
+
+        self._fetch_missing_layers()
+
+        with self.stats.phase("export"):
+            self._write_oci_layout(target_dir)
+
+        self.log.info("Image available at '%s'" % target_dir)
+
+    def export_oci_manifest(self, target_dir):
+        """
+        Writes blobs and the manifest of the squashed image into the OCI
+        image layout directory, without adding the image to the index.
+        The descriptor of the manifest is returned.
+        """
+
+        self._fetch_missing_layers()
+
+        with self.stats.phase("export"):
+            self._prepare_oci_layout(target_dir)
+
+            return self._write_oci_manifest(target_dir)
+
+    def export_oci_index(self, target_dir, manifests):
+        """
+        Writes the OCI index referencing the provided manifests (of all
+        platforms of the image) into the OCI image layout directory and
+        adds the index to the layout under the name of this image.
+        """
+
+        with self.stats.phase("export"):
+            index = self._prepare_oci_layout(target_dir)
+            json_index = self._dump_json(self._generate_oci_index(manifests))[0]
+            descriptor = self._manifest_descriptor(json_index, OCI_INDEX_MEDIA_TYPE)
+
+            self._write_json_metadata(
+                json_index,
+                os.path.join(target_dir, self._blob_path(descriptor["digest"])),
+            )
+            self._add_to_oci_index(target_dir, index, descriptor)
+
+        self.log.info("Image available at '%s'" % target_dir)
+
+    def _write_oci_layout(self, target_dir):
+        index = self._prepare_oci_layout(target_dir)
+        descriptor = self._write_oci_manifest(target_dir)
+
+        self._add_to_oci_index(target_dir, index, descriptor)
+
+    def _add_to_oci_index(self, target_dir, index, descriptor):
+        if self.image_name and self.image_tag:
+            name = "%s:%s" % (self.image_name, self.image_tag)
+            descriptor["annotations"] = OrderedDict(
+                [
+                    ("io.containerd.image.name", name),
+                    ("org.opencontainers.image.ref.name", self.image_tag),
+                ]
+            )
+
+            # Replace the image with the same name, if there is any
+            index["manifests"] = [
+                m
+                for m in index["manifests"]
+                if m.get("annotations", {}).get("io.containerd.image.name") != name
+            ]
+
+        index["manifests"].append(descriptor)
+
+        self._write_json_metadata(
+            self._dump_json(index)[0], os.path.join(target_dir, "index.json")
+        )
+
+    def _write_oci_manifest(self, target_dir):
+        config, layers = self._oci_descriptors()
+
+        for descriptor, path in [config] + layers:
+            blob = os.path.join(target_dir, self._blob_path(descriptor["digest"]))
+
+            if os.path.exists(blob):
+                self.log.debug(
+                    "Blob %s already exists, skipping" % descriptor["digest"]
+                )
+            else:
+                self._link_or_copy(path, blob)
+
+        manifest = self._generate_oci_manifest(
+            config[0], [descriptor for descriptor, _ in layers]
+        )
+        json_manifest = self._dump_json(manifest)[0]
+        descriptor = self._manifest_descriptor(json_manifest, OCI_MANIFEST_MEDIA_TYPE)
+
+        self._write_json_metadata(
+            json_manifest,
+            os.path.join(target_dir, self._blob_path(descriptor["digest"])),
+        )
+
+        return descriptor
+
+    def _manifest_descriptor(self, json_manifest, media_type):
+        descriptor = OrderedDict()
+        descriptor["mediaType"] = media_type
+        descriptor["digest"] = (
+            "sha256:%s" % hashlib.sha256(json_manifest.encode("utf-8")).hexdigest()
+        )
+        descriptor["size"] = len(json_manifest.encode("utf-8"))
+
+        return descriptor
+
+    def push_to_registry(self, reference):
+        """
+        Pushes the squashed image directly to the registry.
+
+        Only blobs that are not available in the target repository are
+        uploaded. For unchanged layers this check is done by digest, so
+        in most cases only the squashed layer, the config and the manifest
+        are transferred. Uncompressed layers (of images read from the
+        Docker daemon or from 'docker save' archives) are looked up by
+        their diff IDs in the image already stored under the tag, other
+        uncompressed layers are compressed before the check.
+        """
+
+        registry_name, repository, tag = registry.parse_reference(reference)
+        client = registry.Registry(self.log, registry_name, repository)
+
+        self.log.info("Pushing image to %s/%s:%s..." % (registry_name, repository, tag))
+
+        with self.stats.phase("push"):
+            self.target_layers = self._read_target_layers(client, tag)
+            self._push_manifest(client, tag)
+
+        self.log.info("Image pushed to %s/%s:%s" % (registry_name, repository, tag))
+
+    def push_manifest(self, reference):
+        """
+        Pushes blobs and the manifest of the squashed image to the registry
+        repository, the manifest is referenced only by its digest. The
+        descriptor of the manifest is returned.
+        """
+
+        registry_name, repository, tag = registry.parse_reference(reference)
+        client = registry.Registry(self.log, registry_name, repository)
+
+        with self.stats.phase("push"):
+            self.target_layers = self._read_target_layers(client, tag)
+            return self._push_manifest(client)
+
+    def push_index(self, reference, manifests):
+        """
+        Pushes the OCI index referencing the provided manifests (of all
+        platforms of the image, already pushed) to the registry.
+        """
+
+        registry_name, repository, tag = registry.parse_reference(reference)
+        client = registry.Registry(self.log, registry_name, repository)
+
+        with self.stats.phase("push"):
+            client.put_manifest(
+                tag,
+                self._dump_json(self._generate_oci_index(manifests))[0],
+                OCI_INDEX_MEDIA_TYPE,
+            )
+
+        self.log.info("Image pushed to %s/%s:%s" % (registry_name, repository, tag))
+
+    def _read_target_layers(self, client, tag):
+        """
+        Reads compressed layers of the image already stored under the tag
+        in the target repository (usually the previous version of the
+        image), by their diff IDs. Unmodified layers which are not
+        compressed (read from the Docker daemon or from a 'docker save'
+        archive) are found there, without compressing them first.
+        """
+
+        layers = {}
+
+        try:
+            manifest = client.find_manifest(tag)
+
+            # Multi-platform image, select the platform
+            while manifest and "manifests" in manifest:
+                manifest = client.get_manifest(
+                    self._select_manifest(manifest["manifests"])["digest"]
+                )
+
+            if not manifest or "config" not in manifest:
+                return layers
+
+            config_path = os.path.join(self.tmp_dir, "target-config.json")
+            client.get_blob(manifest["config"]["digest"], config_path)
+            config = self._read_json_file(config_path)
+        except SquashError as e:
+            self.log.debug(
+                "Could not read layers of the image in the target repository: %s" % e
+            )
+            return layers
+
+        for diff_id, layer in zip(config["rootfs"]["diff_ids"], manifest["layers"]):
+            descriptor = OrderedDict()
+            descriptor["mediaType"] = DOCKER_LAYER_MEDIA_TYPES.get(
+                layer["mediaType"], layer["mediaType"]
+            )
+            descriptor["digest"] = layer["digest"]
+            descriptor["size"] = layer["size"]
+            layers[diff_id] = descriptor
+
+        return layers
+
+    def _push_manifest(self, client, tag=None):
+        config, layers = self._oci_descriptors()
+        pushed_layers = []
+
+        for descriptor, path in layers:
+            pushed_layers.append(self._push_layer(client, descriptor, path))
+
+        self._push_blob(client, *config)
+
+        manifest = self._generate_oci_manifest(config[0], pushed_layers)
+        json_manifest = self._dump_json(manifest)[0]
+        descriptor = self._manifest_descriptor(json_manifest, OCI_MANIFEST_MEDIA_TYPE)
+
+        client.put_manifest(
+            tag or descriptor["digest"], json_manifest, OCI_MANIFEST_MEDIA_TYPE
+        )
+
+        return descriptor
+
+    def _push_layer(self, client, descriptor, path):
+        """
+        Makes sure the layer is available in the registry, returns the
+        descriptor of the layer stored in the registry.
+        """
+
+        if self.shared_blobs:
+            return self.shared_blobs.once(
+                ("push", client.registry, client.repository, descriptor["digest"]),
+                lambda: self._push_missing_layer(client, descriptor, path),
+            )
+
+        return self._push_missing_layer(client, descriptor, path)
+
+    def _push_missing_layer(self, client, descriptor, path):
+        digest = descriptor["digest"]
+        target_layer = getattr(self, "target_layers", {}).get(digest)
+
+        # Uncompressed layer already stored in the target repository
+        if (
+            descriptor["mediaType"] == OCI_LAYER_MEDIA_TYPE
+            and target_layer
+            and client.blob_exists(target_layer["digest"])
+        ):
+            self.log.info(
+                "Layer %s already exists in the registry as blob %s, skipping"
+                % (digest, target_layer["digest"])
+            )
+            return target_layer
+
+        # Check it first, there is no need to download or compress
+        # layers which are already in the registry
+        if client.blob_exists(digest):
+            self.log.info("Blob %s already exists in the registry, skipping" % digest)
+            return descriptor
+
+        # Unmodified layers from the same registry can be mounted
+        if (
+            self.registry_client
+            and self.registry_client.registry == client.registry
+            and client.mount_blob(digest, self.registry_client.repository)
+        ):
+            self.log.info(
+                "Blob %s mounted from %s repository"
+                % (digest, self.registry_client.repository)
+            )
+            return descriptor
+
+        if not os.path.exists(path):
+            self._download_blob(digest, path)
+
+        if descriptor["mediaType"] != OCI_LAYER_MEDIA_TYPE:
+            # Already compressed, the blob is pushed under the same digest,
+            # which is already coordinated with other images
+            self._push_missing_blob(client, descriptor, path)
+            return descriptor
+
+        descriptor, path = self._compress_layer(descriptor, path)
+        self._push_blob(client, descriptor, path)
+
+        return descriptor
+
+    def _push_blob(self, client, descriptor, path):
+        if self.shared_blobs:
+            self.shared_blobs.once(
+                ("push", client.registry, client.repository, descriptor["digest"]),
+                lambda: self._push_missing_blob(client, descriptor, path),
+            )
+        else:
+            self._push_missing_blob(client, descriptor, path)
+
+    def _push_missing_blob(self, client, descriptor, path):
+        digest = descriptor["digest"]
+
+        if client.blob_exists(digest):
+            self.log.info("Blob %s already exists in the registry, skipping" % digest)
+            return
+
+        self.log.info("Uploading blob %s (%s bytes)..." % (digest, descriptor["size"]))
+        client.upload_blob(digest, path)
+        self.stats.add_bytes("push", descriptor["size"])
+
+    def _compress_layer(self, descriptor, path):
+        """
+        Compresses the layer with gzip. Compressed data does not depend on
+        the time of compression, the same layer will always result in the
+        same blob (and digest).
+        """
+
+        compressed_path = os.path.join(
+            self.tmp_dir, "%s.tar.gz" % descriptor["digest"].split(":")[-1]
+        )
+        sha256 = hashlib.sha256()
+
+        self.log.debug("Compressing layer %s..." % descriptor["digest"])
+
+        with open(path, "rb") as f, open(compressed_path, "wb") as compressed:
+            with gzip.GzipFile(
+                filename="", mode="wb", fileobj=compressed, compresslevel=6, mtime=0
+            ) as gz:
+                shutil.copyfileobj(f, gz, 10485760)
+
+        with open(compressed_path, "rb") as f:
+            for chunk in iter(lambda: f.read(10485760), b""):
+                sha256.update(chunk)
+
+        compressed_descriptor = OrderedDict()
+        compressed_descriptor["mediaType"] = OCI_LAYER_MEDIA_TYPE + "+gzip"
+        compressed_descriptor["digest"] = "sha256:%s" % sha256.hexdigest()
+        compressed_descriptor["size"] = os.path.getsize(compressed_path)
+
+        return compressed_descriptor, compressed_path
+
+    def _prepare_oci_layout(self, target_dir):
+        """
+        Prepares the OCI image layout directory structure and returns the
+        content of the index.json file.
+        """
+
+        if os.path.exists(os.path.join(target_dir, "oci-layout")):
+            return self._read_json_file(os.path.join(target_dir, "index.json"))
+
+        if os.path.exists(target_dir) and os.listdir(target_dir):
+            raise SquashError(
+                f"The '{target_dir}' directory exists and it is not an OCI image layout"
+            )
+
+        os.makedirs(os.path.join(target_dir, "blobs", "sha256"), exist_ok=True)
+
+        self._write_json_metadata(
+            '{"imageLayoutVersion":"1.0.0"}', os.path.join(target_dir, "oci-layout")
+        )
+
+        # The layout is valid even before any image is added to it
+        index = self._generate_oci_index([])
+        self._write_json_metadata(
+            self._dump_json(index)[0], os.path.join(target_dir, "index.json")
+        )
+
+        return index
+
+    def _oci_descriptors(self):
+        """
+        Prepares OCI descriptors for the config and all layers of the
+        squashed image. Descriptors are returned together with the path
+        to the file containing the data.
+        """
+
+        config_path = os.path.join(
+            self.new_image_dir, self.new_image_manifest["Config"]
+        )
+        config = OrderedDict()
+        config["mediaType"] = OCI_CONFIG_MEDIA_TYPE
+        config["digest"] = "sha256:%s" % self.new_image_id
+        config["size"] = os.path.getsize(config_path)
+
+        layers = []
+
+        for diff_id, layer_path in zip(
+            self.diff_ids, self.new_image_manifest["Layers"]
+        ):
+            path = os.path.join(self.new_image_dir, layer_path)
+
+            if self.transport == common.REGISTRY_TRANSPORT and (
+                layer_path in self.source_layers
+            ):
+                # Layer from the registry, which may not be downloaded
+                source = self.source_layers[layer_path]
+                descriptor = OrderedDict()
+                descriptor["mediaType"] = DOCKER_LAYER_MEDIA_TYPES.get(
+                    source["mediaType"], source["mediaType"]
+                )
+                descriptor["digest"] = source["digest"]
+                descriptor["size"] = source["size"]
+                layers.append((descriptor, path))
+                continue
+
+            descriptor = OrderedDict()
+            descriptor["mediaType"] = self._layer_media_type(path)
+
+            if layer_path.startswith("blobs/"):
+                # Blob is already named after its digest, it may be
+                # compressed, so we cannot use the diff_id
+                descriptor["digest"] = "sha256:%s" % os.path.basename(layer_path)
+            else:
+                # Uncompressed layer, its digest is the diff_id
+                descriptor["digest"] = "sha256:%s" % diff_id
+
+            descriptor["size"] = os.path.getsize(path)
+            layers.append((descriptor, path))
+
+        return (config, config_path), layers
+
+    def _read_layer_tars(self):
+        manifest = self._get_manifest()
+        config = self._read_json_file(
+            os.path.join(self.old_image_dir, manifest["Config"])
+        )
+        layer_paths = self._read_layer_paths(config, manifest, [])[0]
+
+        if self.transport == common.REGISTRY_TRANSPORT:
+            # Content of all layers is needed to select these to squash
+            self._download_layers(layer_paths, self.old_image_dir)
+
+        layer_paths = iter(layer_paths)
+
+        return [
+            (
+                None
+                if entry.get("empty_layer", False)
+                else self._extract_tar_name(next(layer_paths))
+            )
+            for entry in config["history"]
+        ], config["rootfs"]["diff_ids"]
+
+    def _image_size(self, directory):
+        """
+        Layers of images read from a registry are downloaded only when
+        needed, layers missing in the directory are counted with their size
+        in the registry.
+        """
+
+        size = super()._image_size(directory)
+
+        if self.transport != common.REGISTRY_TRANSPORT:
+            return size
+
+        if directory == self.old_image_dir:
+            manifest = self.source_manifest
+        else:
+            manifest = self.new_image_manifest
+
+        return size + sum(
+            self.source_layers[layer_path]["size"]
+            for layer_path in set(manifest["Layers"])
+            if layer_path in self.source_layers
+            and not os.path.exists(os.path.join(directory, layer_path))
+        )
+
+    def _fetch_missing_layers(self):
+        if self.transport != common.REGISTRY_TRANSPORT:
+            return
+
+        self._download_layers(
+            self.layer_paths_to_move + self.layer_paths_to_carry, self.new_image_dir
+        )
+
+    def _download_layers(self, layer_paths, directory):
+        for layer_path in layer_paths:
+            path = os.path.join(directory, layer_path)
+
+            if not os.path.exists(path):
+                self._download_blob(self.source_layers[layer_path]["digest"], path)
+
+    def _download_blob(self, digest, path):
+        if not self.shared_blobs:
+            self.log.info("Downloading blob %s..." % digest)
+            self.registry_client.get_blob(digest, path)
+            return
+
+        # Layers are removed while squashing, the blob is kept in the
+        # shared directory for other images
+        shared_path = os.path.join(self.shared_blobs.directory, self._blob_path(digest))
+
+        def download():
+            if not os.path.exists(shared_path):
+                self.log.info("Downloading blob %s..." % digest)
+                self.registry_client.get_blob(digest, shared_path)
+
+        self.shared_blobs.once(("download", digest), download)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._link_or_copy(shared_path, path)
+
+    def _layer_media_type(self, path):
+        with open(path, "rb") as f:
+            magic = f.read(4)
+
+        if magic[:2] == b"\x1f\x8b":
+            return OCI_LAYER_MEDIA_TYPE + "+gzip"
+
+        if magic == b"\x28\xb5\x2f\xfd":
+            return OCI_LAYER_MEDIA_TYPE + "+zstd"
+
+        return OCI_LAYER_MEDIA_TYPE
+
+    def _generate_oci_manifest(self, config, layers):
+        manifest = OrderedDict()
+        manifest["schemaVersion"] = 2
+        manifest["mediaType"] = OCI_MANIFEST_MEDIA_TYPE
+        manifest["config"] = config
+        manifest["layers"] = layers
+
+        return manifest
+
+    def _generate_oci_index(self, manifests):
+        index = OrderedDict()
+        index["schemaVersion"] = 2
+        index["mediaType"] = OCI_INDEX_MEDIA_TYPE
+        index["manifests"] = manifests
+
+        return index
+
     def _write_image_metadata(self, metadata):
         # Create JSON from the metadata
         # Docker adds new line at the end
@@ -118,8 +795,8 @@ class V2Image(Image):
 
         return image_id
 
-    def _write_squashed_layer_metadata(self, metadata):
-        layer_metadata_file = os.path.join(self.squashed_dir, "json")
+    def _write_squashed_layer_metadata(self, metadata, squashed_dir=None):
+        layer_metadata_file = os.path.join(squashed_dir or self.squashed_dir, "json")
         json_metadata = self._dump_json(metadata)[0]
 
         self._write_json_metadata(json_metadata, layer_metadata_file)
@@ -137,7 +814,8 @@ class V2Image(Image):
         image_tag,
         old_image_manifest,
         layer_paths_to_move,
-        layer_path_id=None,
+        layer_path_ids=None,
+        carried_layer_paths=None,
     ):
         manifest = OrderedDict()
         manifest["Config"] = "%s.json" % image_id
@@ -147,9 +825,11 @@ class V2Image(Image):
 
         manifest["Layers"] = old_image_manifest["Layers"][: len(layer_paths_to_move)]
 
-        if layer_path_id:
+        for layer_path_id in layer_path_ids or []:
             manifest["Layers"].append("%s/layer.tar" % layer_path_id)
 
+        manifest["Layers"].extend(carried_layer_paths or [])
+
         return [manifest]
 
     def _read_json_file(self, json_file):
@@ -227,22 +907,37 @@ class V2Image(Image):
         return chain_ids
 
     def _generate_diff_ids(self):
-        diff_ids = []
-
-        for path in self.layer_paths_to_move:
-            sha256 = self._compute_sha256(self._extract_tar_name(path))
-            diff_ids.append(sha256)
+        # Layers that are moved are not modified, we can reuse their
+        # diff_ids instead of computing checksums of all the moved layers.
+        # This is also the only correct way in case the layers are
+        # compressed, which can happen for OCI image layouts.
+        diff_ids = [
+            diff_id.split(":")[-1]
+            for diff_id in self.old_image_config["rootfs"]["diff_ids"][
+                : len(self.layer_paths_to_move)
+            ]
+        ]
 
         if self.layer_paths_to_squash:
-            sha256 = self._compute_sha256(os.path.join(self.squashed_dir, "layer.tar"))
-            diff_ids.append(sha256)
+            diff_ids.extend(self.squashed_diff_ids)
+
+        # Layers above the squashed range are not modified either
+        if self.layer_paths_to_carry:
+            diff_ids.extend(
+                diff_id.split(":")[-1]
+                for diff_id in self.old_image_config["rootfs"]["diff_ids"][
+                    -len(self.layer_paths_to_carry) :
+                ]
+            )
 
         return diff_ids
 
     def _compute_sha256(self, layer_tar):
         sha256 = hashlib.sha256()
+        total = os.path.getsize(layer_tar)
+        done = 0
 
-        with open(layer_tar, "rb") as f:
+        with self.stats.phase("hashing") as phase, open(layer_tar, "rb") as f:
             while True:
                 # Read in 10MB chunks
                 data = f.read(10485760)
@@ -251,13 +946,19 @@ class V2Image(Image):
                     break
 
                 sha256.update(data)
+                phase.bytes += len(data)
+                done += len(data)
+                self._report_progress("hashing", done, total)
 
         return sha256.hexdigest()
 
-    def _generate_squashed_layer_path_id(self):
+    def _generate_squashed_layer_path_id(self, chain_id=None, parent=None):
         """
         This function generates the id used to name the directory to
-        store the squashed layer content in the archive.
+        store the squashed layer content in the archive. By default it is
+        the id of the topmost squashed layer placed on top of moved layers,
+        if the squashed content is split, chain id of the layer and its
+        parent need to be provided.
 
         This mimics what Docker does here: https://github.com/docker/docker/blob/v1.10.0-rc1/image/v1/imagev1.go#L42
         To make it simpler we do reuse old image metadata and
@@ -283,7 +984,7 @@ class V2Image(Image):
 
         # The 'layer_id' element is the chain_id of the
         # squashed layer
-        v1_metadata["layer_id"] = "sha256:%s" % self.chain_ids[-1]
+        v1_metadata["layer_id"] = "sha256:%s" % (chain_id or self.chain_ids[-1])
 
         # Add back 'os' element
         if operating_system:
@@ -293,7 +994,9 @@ class V2Image(Image):
         # exported tar archive) of the last layer that we move
         # (layer below squashed layer)
 
-        if self.layer_paths_to_move:
+        if parent:
+            v1_metadata["parent"] = "sha256:%s" % parent
+        elif self.layer_paths_to_move:
             if self.layer_paths_to_squash:
                 parent = self.layer_paths_to_move[-1]
             else:
@@ -314,7 +1017,9 @@ class V2Image(Image):
 
         return sha
 
-    def _generate_last_layer_metadata(self, layer_path_id, old_layer_path: Path):
+    def _generate_last_layer_metadata(
+        self, layer_path_id, old_layer_path: Path, parent=None
+    ):
         config_file = os.path.join(self.old_image_dir, old_layer_path)
         with open(config_file, "r") as f:
             config = json.load(f, object_pairs_hook=OrderedDict)
@@ -327,8 +1032,11 @@ class V2Image(Image):
         else:
             config["config"]["Image"] = ""
 
-        # Update 'parent' - it should be path to the last layer to move
-        if self.layer_paths_to_move:
+        # Update 'parent' - it should be path to the last layer to move,
+        # or to the previous squashed layer if the squashed content is split
+        if parent:
+            config["parent"] = parent
+        elif self.layer_paths_to_move:
             config["parent"] = self.layer_paths_to_move[-1]
         else:
             config.pop("parent", None)
@@ -347,6 +1055,15 @@ class V2Image(Image):
         # Remove unnecessary or old fields
         metadata.pop("container", None)
 
+        # History and diff_ids of layers above the squashed range, these
+        # are added back on top of squashed layers
+        carried_history = metadata["history"][
+            len(metadata["history"]) - len(self.layers_to_carry) :
+        ]
+        carried_diff_ids = metadata["rootfs"]["diff_ids"][
+            len(metadata["rootfs"]["diff_ids"]) - len(self.layer_paths_to_carry) :
+        ]
+
         # Remove squashed layers from history
         metadata["history"] = metadata["history"][: len(self.layers_to_move)]
         # Remove diff_ids for squashed layers
@@ -354,16 +1071,27 @@ class V2Image(Image):
             : len(self.layer_paths_to_move)
         ]
 
-        history = {"comment": self.comment, "created": self.date}
-
         if self.layer_paths_to_squash:
-            # Add diff_ids for the squashed layer
-            metadata["rootfs"]["diff_ids"].append("sha256:%s" % self.diff_ids[-1])
+            # Add diff_ids for squashed layers, there is more of them
+            # if the squashed content is split
+            squashed_diff_ids = self.diff_ids[
+                len(self.layer_paths_to_move) : len(self.diff_ids)
+                - len(self.layer_paths_to_carry)
+            ]
+
+            for diff_id in squashed_diff_ids:
+                metadata["rootfs"]["diff_ids"].append("sha256:%s" % diff_id)
+                # Add new entry for squashed layer to history
+                metadata["history"].append(
+                    {"comment": self.comment, "created": self.date}
+                )
         else:
-            history["empty_layer"] = True
+            metadata["history"].append(
+                {"comment": self.comment, "created": self.date, "empty_layer": True}
+            )
 
-        # Add new entry for squashed layer to history
-        metadata["history"].append(history)
+        metadata["history"].extend(carried_history)
+        metadata["rootfs"]["diff_ids"].extend(carried_diff_ids)
 
         if self.squash_id:
             # Update image id, should be one layer below squashed layer
@@ -374,6 +1102,12 @@ class V2Image(Image):
         return metadata
 
     def _get_manifest(self):
+        if self.transport == common.REGISTRY_TRANSPORT:
+            # Blobs of images from a registry are stored in the same way as
+            # in OCI image layout
+            self.oci_format = True
+            return self.source_manifest
+
         if os.path.exists(os.path.join(self.old_image_dir, "index.json")):
             # New OCI Archive format type
             self.oci_format = True
@@ -392,6 +1126,14 @@ class V2Image(Image):
                         os.path.join(self.old_image_dir, "manifest.json")
                     )
                 )[0]
+            elif self.transport:
+                # Plain OCI image layout (not produced by Docker), the
+                # manifest needs to be read through the index
+                return self._manifest_from_oci_index(
+                    lambda name: self._read_json_file(
+                        os.path.join(self.old_image_dir, name)
+                    )
+                )
             else:
                 raise SquashError("Unable to locate manifest.json")
         else:
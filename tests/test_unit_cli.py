@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from docker_squash import cli
+from tests.test_unit_squash import ArchiveHelper
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Printing the help or the version needs to be fast, libraries used only
+    for squashing must not be imported at startup.
+    """
+
+    HEAVY_MODULES = [
+        "asyncio",
+        "docker",
+        "docker_squash.image",
+        "docker_squash.squash",
+        "packaging",
+        "requests",
+        "tarfile",
+        "urllib3",
+    ]
+
+    def imported_modules(self, code):
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import sys\n%s\nprint('\\n'.join(sys.modules))" % code,
+            ]
+        )
+
+        return set(output.decode().splitlines())
+
+    def test_should_not_import_heavy_modules_at_startup(self):
+        modules = self.imported_modules("import docker_squash.cli")
+
+        self.assertEqual(modules & set(self.HEAVY_MODULES), set())
+
+    def test_should_print_version_and_help_without_importing_heavy_modules(self):
+        for option in "--version", "--help":
+            modules = self.imported_modules(
+                "from docker_squash import cli\n"
+                "sys.argv = ['docker-squash', '%s']\n"
+                "try:\n"
+                "    cli.CLI().run()\n"
+                "except SystemExit:\n"
+                "    pass" % option
+            )
+
+            self.assertIn("docker_squash.cli", modules)
+            self.assertEqual(modules & set(self.HEAVY_MODULES), set())
+
+
+class TestStats(unittest.TestCase):
+    def test_should_write_only_stats_to_standard_output(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        source = os.path.join(tmp, "source.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("opt", None), ("opt/file", b"first")],
+                [("opt", None), ("opt/file", b"second")],
+            ],
+        )
+
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "docker_squash.cli",
+                "docker-archive:%s" % source,
+                "--output-path",
+                os.path.join(tmp, "output.tar"),
+                "--load-image",
+                "false",
+                "--stats-file",
+                "-",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+
+        self.assertIn("merge", json.loads(process.stdout))
+        self.assertIn(b"Squashing image", process.stderr)
+
+
+class TestAnalyze(unittest.TestCase):
+    def test_should_split_analyze_command(self):
+        self.assertEqual(
+            ("analyze", ["image", "--top", "5"]),
+            cli.split_command(["analyze", "image", "--top", "5"]),
+        )
+
+    def test_should_split_analyze_command_after_common_options(self):
+        self.assertEqual(
+            ("analyze", ["-v", "image"]),
+            cli.split_command(["-v", "analyze", "image"]),
+        )
+
+    def test_should_squash_image_named_analyze(self):
+        for argv in [
+            ["analyze:latest"],
+            ["--", "analyze"],
+            ["-t", "analyze", "image"],
+            ["-v", "-f", "2", "analyze"],
+            [],
+        ]:
+            self.assertEqual((None, argv), cli.split_command(argv))
+
+    def test_should_print_waste_tables(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        source = os.path.join(tmp, "source.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("opt", None), ("opt/file", b"first")],
+                [("opt", None), ("opt/file", b"second")],
+            ],
+        )
+
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-m",
+                "docker_squash.cli",
+                "analyze",
+                "docker-archive:%s" % source,
+            ]
+        ).decode()
+
+        self.assertIn("Total wasted: 5 B", output)
+        self.assertRegex(output, r"\n +5 B +overwritten +0 +/opt/file\n")
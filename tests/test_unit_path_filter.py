@@ -0,0 +1,79 @@
+import unittest
+
+from docker_squash.errors import SquashError
+from docker_squash.lib.path_filter import PathFilter
+
+
+class TestPathFilter(unittest.TestCase):
+    def test_should_match_paths_and_their_content(self):
+        path_filter = PathFilter(["/var/cache/apt", "/tmp"])
+
+        self.assertTrue(path_filter.matches("/var/cache/apt"))
+        self.assertTrue(path_filter.matches("/var/cache/apt/archives/a.deb"))
+        self.assertTrue(path_filter.matches("/tmp/file"))
+        self.assertFalse(path_filter.matches("/var/cache"))
+        self.assertFalse(path_filter.matches("/var/cache/aptitude"))
+        self.assertFalse(path_filter.matches("/opt/tmp"))
+
+        self.assertEqual(path_filter.paths, {"/var/cache/apt", "/tmp"})
+        self.assertIsNone(path_filter.regex)
+
+    def test_should_match_names_in_any_directory(self):
+        path_filter = PathFilter(["__pycache__", "*.pyc"])
+
+        self.assertTrue(path_filter.matches("/__pycache__"))
+        self.assertTrue(path_filter.matches("/usr/lib/app/__pycache__/a.cpython.pyc"))
+        self.assertTrue(path_filter.matches("/usr/lib/app/module.pyc"))
+        self.assertFalse(path_filter.matches("/usr/lib/app/module.py"))
+        self.assertFalse(path_filter.matches("/usr/lib/app/__pycache__x"))
+
+        self.assertEqual(path_filter.names, {"__pycache__"})
+
+    def test_should_match_globs_against_whole_path(self):
+        path_filter = PathFilter(["/var/lib/apt/lists/*", "/opt/**/*.log", "/a?/[!x]"])
+
+        self.assertTrue(path_filter.matches("/var/lib/apt/lists/data"))
+        self.assertFalse(path_filter.matches("/var/lib/apt/lists"))
+        self.assertTrue(path_filter.matches("/opt/app/logs/debug.log"))
+        self.assertFalse(path_filter.matches("/opt/debug.log.gz"))
+        self.assertTrue(path_filter.matches("/opt/debug.log"))
+        self.assertTrue(path_filter.matches("/ab/c"))
+        self.assertFalse(path_filter.matches("/ab/x"))
+
+    def test_should_match_any_number_of_directories(self):
+        path_filter = PathFilter(["a/**/b", "**/node_modules"])
+
+        self.assertTrue(path_filter.matches("/a/b"))
+        self.assertTrue(path_filter.matches("/a/x/y/b/file"))
+        self.assertFalse(path_filter.matches("/a/xb"))
+        self.assertTrue(path_filter.matches("/node_modules"))
+        self.assertTrue(path_filter.matches("/app/node_modules/lib"))
+        self.assertFalse(path_filter.matches("/app/my_node_modules"))
+
+    def test_should_match_regular_expressions(self):
+        path_filter = PathFilter([r"re:\.(orig|rej)$"])
+
+        self.assertTrue(path_filter.matches("/src/file.c.orig"))
+        self.assertFalse(path_filter.matches("/src/file.c"))
+
+    def test_should_use_presets(self):
+        path_filter = PathFilter(presets=["apt", "pip"])
+
+        self.assertTrue(path_filter)
+        self.assertTrue(path_filter.matches("/root/.cache/pip/http/a"))
+        self.assertTrue(path_filter.matches("/var/cache/apt/archives/bash.deb"))
+        self.assertFalse(path_filter.matches("/var/cache/apt/archives/partial"))
+        self.assertFalse(path_filter.matches("/root/.cache/pip"))
+        self.assertFalse(PathFilter())
+
+    def test_should_fail_on_unknown_preset(self):
+        with self.assertRaises(SquashError) as cm:
+            PathFilter(presets=["unknown"])
+
+        self.assertIn("Unknown exclusion preset: 'unknown'", str(cm.exception))
+
+    def test_should_fail_on_invalid_regular_expression(self):
+        with self.assertRaises(SquashError) as cm:
+            PathFilter(["re:("])
+
+        self.assertIn("Invalid exclusion rule: 're:('", str(cm.exception))
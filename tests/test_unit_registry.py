@@ -0,0 +1,143 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import mock
+
+from docker_squash.errors import SquashError
+from docker_squash.lib import registry
+
+
+class TestParseReference(unittest.TestCase):
+    def test_should_parse_reference_with_registry(self):
+        self.assertEqual(
+            registry.parse_reference("localhost:5000/app:1.0"),
+            ("localhost:5000", "app", "1.0"),
+        )
+        self.assertEqual(
+            registry.parse_reference("quay.io/org/app"),
+            ("quay.io", "org/app", "latest"),
+        )
+
+    def test_should_parse_docker_hub_reference(self):
+        self.assertEqual(
+            registry.parse_reference("busybox"),
+            ("docker.io", "library/busybox", "latest"),
+        )
+        self.assertEqual(
+            registry.parse_reference("jboss/wildfly:abc"),
+            ("docker.io", "jboss/wildfly", "abc"),
+        )
+
+    def test_should_parse_reference_with_digest(self):
+        self.assertEqual(
+            registry.parse_reference("localhost:5000/app@sha256:abc"),
+            ("localhost:5000", "app", "sha256:abc"),
+        )
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.log = mock.Mock()
+        self.registry = registry.Registry(self.log, "localhost:5000", "app")
+        self.registry.session = mock.Mock()
+
+    def response(self, status_code, headers=None):
+        response = mock.Mock()
+        response.status_code = status_code
+        response.headers = headers or {}
+        return response
+
+    def test_should_use_plain_http_for_local_registry(self):
+        self.assertEqual(self.registry.url, "http://localhost:5000/v2/")
+        self.assertEqual(
+            registry.Registry(self.log, "docker.io", "library/busybox").url,
+            "https://registry-1.docker.io/v2/",
+        )
+
+    @mock.patch("docker_squash.lib.registry.requests.get")
+    def test_should_authenticate_with_token(self, mock_get):
+        self.registry.session.headers = {}
+        self.registry.session.request.side_effect = [
+            self.response(
+                401,
+                {
+                    "WWW-Authenticate": 'Bearer realm="https://auth/token",service="registry",scope="repository:app:pull"'
+                },
+            ),
+            self.response(200),
+        ]
+        token = self.response(200)
+        token.json.return_value = {"token": "abc"}
+        mock_get.return_value = token
+
+        self.assertTrue(self.registry.blob_exists("sha256:aaa"))
+
+        mock_get.assert_called_with(
+            "https://auth/token",
+            params={"service": "registry", "scope": ["repository:app:pull"]},
+            auth=mock.ANY,
+            timeout=mock.ANY,
+        )
+        self.assertEqual(self.registry.session.headers["Authorization"], "Bearer abc")
+        self.registry.session.request.assert_called_with(
+            "HEAD",
+            "http://localhost:5000/v2/app/blobs/sha256:aaa",
+            timeout=mock.ANY,
+        )
+
+    def test_should_not_find_missing_manifest(self):
+        self.registry.session.request.return_value = self.response(404)
+
+        self.assertIsNone(self.registry.find_manifest("latest"))
+
+        with self.assertRaises(SquashError) as cm:
+            self.registry.get_manifest("latest")
+
+        self.assertEqual(
+            str(cm.exception),
+            "Manifest latest not found in the app repository of the localhost:5000 registry",
+        )
+
+    def test_should_upload_blob_to_returned_location(self):
+        self.registry.session.request.side_effect = [
+            self.response(202, {"Location": "/v2/app/blobs/uploads/uuid?_state=x"}),
+            self.response(201),
+        ]
+
+        with mock.patch("builtins.open", mock.mock_open(read_data=b"data")):
+            with mock.patch("os.path.getsize", return_value=4):
+                self.registry.upload_blob("sha256:aaa", "/tmp/blob")
+
+        self.assertEqual(
+            self.registry.session.request.call_args[0],
+            ("PUT", "http://localhost:5000/v2/app/blobs/uploads/uuid?_state=x"),
+        )
+        self.assertEqual(
+            self.registry.session.request.call_args[1]["params"],
+            {"digest": "sha256:aaa"},
+        )
+
+    def test_should_not_leave_blob_with_wrong_digest(self):
+        response = self.response(200)
+        response.iter_content.return_value = [b"data"]
+        self.registry.session.request.return_value = response
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "blobs", "sha256", "aaa")
+
+            with self.assertRaises(SquashError):
+                self.registry.get_blob("sha256:aaa", path)
+
+            self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+            digest = "sha256:%s" % hashlib.sha256(b"data").hexdigest()
+            self.registry.get_blob(digest, path)
+
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"data")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,168 @@
+import asyncio
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
+import os
+import pstats
+import shutil
+import tarfile
+import tempfile
 import unittest
 
 import docker
 import mock
 
-from docker_squash.errors import SquashError
+from docker_squash.errors import SquashError, SquashUnnecessaryError
+from docker_squash.image import Image
 from docker_squash.squash import Squash
+from docker_squash.v2_image import V2Image
+
+
+class ArchiveHelper(object):
+    """
+    Builds images in the 'docker save' format without the Docker daemon.
+
+    Layers are provided as lists of (name, content) tuples, where content
+    is None for directories, or as tar archives.
+    """
+
+    @staticmethod
+    def layer(files):
+        buf = io.BytesIO()
+
+        with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for name, content in files:
+                info = tarfile.TarInfo(name)
+                info.mtime = 1600000000
+
+                if content is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                else:
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+
+        return buf.getvalue()
+
+    @staticmethod
+    def archive(path, layers, tag="test:latest"):
+        files = {}
+        diff_ids = []
+        layer_paths = []
+
+        for layer in layers:
+            # Layers can be provided as already built tar archives
+            data = layer if isinstance(layer, bytes) else ArchiveHelper.layer(layer)
+            diff_id = hashlib.sha256(data).hexdigest()
+            diff_ids.append("sha256:%s" % diff_id)
+            layer_paths.append("%s/layer.tar" % diff_id)
+            files["%s/layer.tar" % diff_id] = data
+            files["%s/json" % diff_id] = json.dumps(
+                {"id": diff_id, "config": {}}
+            ).encode()
+
+        config = json.dumps(
+            {
+                "architecture": "amd64",
+                "config": {"Image": ""},
+                "created": "2020-09-13T12:26:40Z",
+                "history": [
+                    {"created": "2020-09-13T12:26:40Z", "created_by": "layer %s" % i}
+                    for i in range(len(layers))
+                ],
+                "os": "linux",
+                "rootfs": {"type": "layers", "diff_ids": diff_ids},
+            }
+        ).encode()
+        config_name = "%s.json" % hashlib.sha256(config).hexdigest()
+        files[config_name] = config
+        files["manifest.json"] = json.dumps(
+            [{"Config": config_name, "RepoTags": [tag], "Layers": layer_paths}]
+        ).encode()
+
+        with tarfile.open(path, "w") as tar:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+    @staticmethod
+    def oci_layout(path, images):
+        """
+        Writes the multi-platform image as OCI image layout, images are
+        provided as (platform, archive path) tuples.
+        """
+
+        def blob(data, media_type):
+            digest = hashlib.sha256(data).hexdigest()
+            os.makedirs(os.path.join(path, "blobs", "sha256"), exist_ok=True)
+
+            with open(os.path.join(path, "blobs", "sha256", digest), "wb") as f:
+                f.write(data)
+
+            return {
+                "mediaType": media_type,
+                "digest": "sha256:%s" % digest,
+                "size": len(data),
+            }
+
+        manifests = []
+
+        for platform, archive in images:
+            with tarfile.open(archive) as tar:
+                manifest = json.load(tar.extractfile("manifest.json"))[0]
+                config = tar.extractfile(manifest["Config"]).read()
+                layers = [
+                    blob(
+                        tar.extractfile(layer_path).read(),
+                        "application/vnd.oci.image.layer.v1.tar",
+                    )
+                    for layer_path in manifest["Layers"]
+                ]
+
+            descriptor = blob(
+                json.dumps(
+                    {
+                        "schemaVersion": 2,
+                        "config": blob(
+                            config, "application/vnd.oci.image.config.v1+json"
+                        ),
+                        "layers": layers,
+                    }
+                ).encode(),
+                "application/vnd.oci.image.manifest.v1+json",
+            )
+            descriptor["platform"] = platform
+            manifests.append(descriptor)
+
+        with open(os.path.join(path, "oci-layout"), "w") as f:
+            json.dump({"imageLayoutVersion": "1.0.0"}, f)
+
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"schemaVersion": 2, "manifests": manifests}, f)
+
+    @staticmethod
+    def read(path):
+        """Returns the manifest, the config and the layers of the image archive"""
+
+        with tarfile.open(path, "r") as tar:
+            manifest = json.load(tar.extractfile("manifest.json"))[0]
+            config = json.load(tar.extractfile(manifest["Config"]))
+            layers = []
+
+            for layer_path in manifest["Layers"]:
+                with tarfile.open(fileobj=tar.extractfile(layer_path)) as layer:
+                    layers.append(
+                        {
+                            m.name: layer.extractfile(m).read() if m.isfile() else None
+                            for m in layer.getmembers()
+                        }
+                    )
+
+        return manifest, config, layers
 
 
 class TestSquash(unittest.TestCase):
@@ -80,3 +238,1578 @@ class TestSquash(unittest.TestCase):
         self.log.warning.assert_any_call(
             "Could not remove image image: Message, skipping cleanup after squashing"
         )
+
+
+class FakeRegistry(object):
+    """In-memory registry, with the same interface as the registry client"""
+
+    blobs = {}
+    manifests = {}
+
+    def __init__(self, log, registry, repository):
+        self.registry = registry
+        self.repository = repository
+        self.downloaded = []
+        self.mounted = []
+        FakeRegistry.instances.append(self)
+
+    @classmethod
+    def reset(cls, empty_registries=()):
+        cls.blobs = {}
+        cls.manifests = {}
+        cls.instances = []
+        # Registries containing only blobs uploaded to them
+        cls.empty_registries = set(empty_registries)
+        cls.uploaded = []
+
+    @classmethod
+    def push_archive(cls, path, reference):
+        """Stores the image from the archive as gzip compressed layers"""
+
+        with tarfile.open(path) as tar:
+            manifest = json.load(tar.extractfile("manifest.json"))[0]
+            config = tar.extractfile(manifest["Config"]).read()
+            layers = []
+
+            for layer_path in manifest["Layers"]:
+                data = gzip.compress(tar.extractfile(layer_path).read(), mtime=0)
+                layers.append(
+                    cls.blob(data, "application/vnd.oci.image.layer.v1.tar+gzip")
+                )
+
+        cls.manifests[reference] = {
+            "schemaVersion": 2,
+            "config": cls.blob(config, "application/vnd.oci.image.config.v1+json"),
+            "layers": layers,
+        }
+
+        return layers
+
+    @classmethod
+    def blob(cls, data, media_type):
+        digest = "sha256:%s" % hashlib.sha256(data).hexdigest()
+        cls.blobs[digest] = data
+        return {"mediaType": media_type, "digest": digest, "size": len(data)}
+
+    def get_manifest(self, reference):
+        return self.manifests[reference]
+
+    def find_manifest(self, reference):
+        return self.manifests.get(reference)
+
+    def get_blob(self, digest, path):
+        self.downloaded.append(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as f:
+            f.write(self.blobs[digest])
+
+    def blob_exists(self, digest):
+        if self.registry in self.empty_registries:
+            return (self.registry, digest) in self.uploaded
+
+        return digest in self.blobs
+
+    def mount_blob(self, digest, source_repository):
+        self.mounted.append(digest)
+        return self.blob_exists(digest)
+
+    def upload_blob(self, digest, path):
+        with open(path, "rb") as f:
+            self.blobs[digest] = f.read()
+
+        self.uploaded.append((self.registry, digest))
+
+    def put_manifest(self, reference, manifest, media_type):
+        self.manifests[reference] = json.loads(manifest)
+
+
+class TestSquashLocalImage(unittest.TestCase):
+    def setUp(self):
+        self.log = mock.Mock()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.source = os.path.join(self.tmp, "source.tar")
+        self.output = os.path.join(self.tmp, "output.tar")
+
+        ArchiveHelper.archive(
+            self.source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("opt", None), ("opt/file", b"first")],
+                [("opt", None), ("opt/file", b"second"), ("opt/.wh.other", b"")],
+            ],
+        )
+
+    def squash(self, image, **kwargs):
+        kwargs.setdefault("output_path", self.output)
+
+        kwargs.setdefault("load_image", False)
+        kwargs.setdefault("tmp_dir", os.path.join(self.tmp, "work"))
+
+        return Squash(self.log, image, **kwargs).run()
+
+    @mock.patch("docker_squash.squash.common.docker_client")
+    def test_should_squash_docker_archive_without_docker_daemon(self, docker_client):
+        image_id = self.squash("docker-archive:%s" % self.source, from_layer="2")
+
+        docker_client.assert_not_called()
+
+        manifest, config, layers = ArchiveHelper.read(self.output)
+
+        self.assertEqual(manifest["Config"], "%s.json" % image_id)
+        self.assertEqual(len(layers), 2)
+        self.assertEqual(len(config["history"]), 2)
+        self.assertEqual(len(config["rootfs"]["diff_ids"]), 2)
+        self.assertEqual(layers[0], {"etc": None, "etc/base": b"base"})
+        self.assertEqual(layers[1]["opt/file"], b"second")
+        self.assertNotIn("opt/.wh.other", layers[1])
+
+    @mock.patch("docker_squash.squash.common.docker_client")
+    def test_should_squash_oci_layout_without_docker_daemon(self, docker_client):
+        layout = os.path.join(self.tmp, "layout")
+
+        with tarfile.open(self.source) as tar:
+            tar.extractall(layout)
+
+        # Docker 25+ saves images in OCI layout
+        with open(os.path.join(layout, "index.json"), "w") as f:
+            json.dump({"schemaVersion": 2, "manifests": []}, f)
+
+        self.squash("oci:%s" % layout)
+
+        docker_client.assert_not_called()
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        self.assertEqual(len(layers), 1)
+        self.assertEqual(layers[0]["etc/base"], b"base")
+        self.assertEqual(layers[0]["opt/file"], b"second")
+        # Source layout is untouched
+        self.assertTrue(os.path.exists(os.path.join(layout, "manifest.json")))
+
+    def test_should_not_accept_layer_id_for_local_image(self):
+        with self.assertRaises(SquashError) as cm:
+            self.squash("docker-archive:%s" % self.source, from_layer="abcdef")
+
+        self.assertEqual(
+            str(cm.exception),
+            "Only number of layers to squash can be provided for images read from docker-archive transport, provided: abcdef",
+        )
+
+    def test_should_write_oci_layout(self):
+        layout = os.path.join(self.tmp, "layout")
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            from_layer="2",
+            tag="squashed:latest",
+            output_path="oci:%s" % layout,
+        )
+
+        with open(os.path.join(layout, "index.json")) as f:
+            index = json.load(f)
+
+        self.assertEqual(len(index["manifests"]), 1)
+        self.assertEqual(
+            index["manifests"][0]["annotations"]["io.containerd.image.name"],
+            "squashed:latest",
+        )
+
+        def blob(digest):
+            with open(
+                os.path.join(layout, "blobs", digest.replace(":", "/")), "rb"
+            ) as f:
+                data = f.read()
+            self.assertEqual(digest, "sha256:%s" % hashlib.sha256(data).hexdigest())
+            return data
+
+        manifest = json.loads(blob(index["manifests"][0]["digest"]))
+        config = json.loads(blob(manifest["config"]["digest"]))
+
+        self.assertEqual(len(manifest["layers"]), 2)
+        self.assertEqual(
+            [layer["digest"] for layer in manifest["layers"]],
+            config["rootfs"]["diff_ids"],
+        )
+
+        for layer in manifest["layers"]:
+            self.assertEqual(len(blob(layer["digest"])), layer["size"])
+
+        # Squashing again into the same layout replaces the image
+        shutil.rmtree(os.path.join(self.tmp, "work"))
+        self.squash(
+            "docker-archive:%s" % self.source,
+            tag="squashed:latest",
+            output_path="oci:%s" % layout,
+        )
+
+        with open(os.path.join(layout, "index.json")) as f:
+            self.assertEqual(len(json.load(f)["manifests"]), 1)
+
+    @mock.patch("docker_squash.v2_image.registry.Registry")
+    def test_should_push_only_missing_blobs_to_registry(self, registry):
+        client = registry.return_value
+        # Only the base layer is already available in the registry
+        base_layer = ArchiveHelper.read(self.source)[1]["rootfs"]["diff_ids"][0]
+        client.blob_exists.side_effect = lambda digest: digest == base_layer
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            from_layer="2",
+            output_path="docker://localhost:5000/app:squashed",
+        )
+
+        registry.assert_called_with(self.log, "localhost:5000", "app")
+        # Squashed layer and config
+        self.assertEqual(client.upload_blob.call_count, 2)
+
+        manifest = json.loads(client.put_manifest.call_args[0][1])
+
+        self.assertEqual(client.put_manifest.call_args[0][0], "squashed")
+        self.assertEqual(manifest["layers"][0]["digest"], base_layer)
+        self.assertEqual(
+            manifest["layers"][1]["mediaType"],
+            "application/vnd.oci.image.layer.v1.tar+gzip",
+        )
+        self.assertEqual(
+            [c[0][0] for c in client.upload_blob.call_args_list],
+            [manifest["layers"][1]["digest"], manifest["config"]["digest"]],
+        )
+
+    def test_should_keep_moved_layers_of_oci_layout(self):
+        layout = os.path.join(self.tmp, "layout")
+
+        with tarfile.open(self.source) as tar:
+            tar.extractall(layout)
+
+        with open(os.path.join(layout, "index.json"), "w") as f:
+            json.dump({"schemaVersion": 2, "manifests": []}, f)
+
+        self.squash("oci:%s" % layout, from_layer="2")
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        self.assertEqual(len(layers), 2)
+        self.assertEqual(layers[0]["etc/base"], b"base")
+
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_squash_image_from_registry(self):
+        FakeRegistry.reset()
+        base, _, _ = FakeRegistry.push_archive(self.source, "1.0")
+
+        self.squash(
+            "docker://localhost:5000/app:1.0",
+            from_layer="2",
+            output_path="docker://localhost:5000/app:squashed",
+        )
+
+        source, target = FakeRegistry.instances
+        manifest = FakeRegistry.manifests["squashed"]
+
+        # Config and layers to squash only
+        self.assertEqual(len(source.downloaded), 3)
+        self.assertNotIn(base["digest"], source.downloaded)
+        self.assertEqual(manifest["layers"][0], base)
+        self.assertEqual(len(manifest["layers"]), 2)
+
+        with tarfile.open(
+            fileobj=io.BytesIO(FakeRegistry.blobs[manifest["layers"][1]["digest"]])
+        ) as tar:
+            self.assertEqual(tar.extractfile("opt/file").read(), b"second")
+
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_not_push_layers_of_previous_image_again(self):
+        FakeRegistry.reset()
+        # Previous version of the image, compressed differently
+        base = FakeRegistry.push_archive(self.source, "squashed")[0]
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            from_layer="2",
+            output_path="docker://localhost:5000/app:squashed",
+        )
+
+        manifest = FakeRegistry.manifests["squashed"]
+
+        self.assertEqual(manifest["layers"][0], base)
+        # Squashed layer and config only
+        self.assertEqual(len(FakeRegistry.uploaded), 2)
+
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_download_moved_layers_from_registry_when_needed(self):
+        FakeRegistry.reset()
+        base = FakeRegistry.push_archive(self.source, "1.0")[0]
+
+        self.squash("docker://localhost:5000/app:1.0", from_layer="2")
+
+        self.assertIn(base["digest"], FakeRegistry.instances[0].downloaded)
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        self.assertEqual(len(layers), 2)
+        self.assertEqual(layers[0]["etc/base"], b"base")
+        self.assertEqual(layers[1]["opt/file"], b"second")
+
+    def multi_platform_archives(self):
+        """Images of two platforms, sharing the base layer"""
+
+        arm64 = os.path.join(self.tmp, "arm64.tar")
+
+        ArchiveHelper.archive(
+            arm64,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("opt", None), ("opt/file", b"arm64")],
+                [("opt", None), ("opt/file", b"arm64 new")],
+            ],
+        )
+
+        return [
+            ({"architecture": "amd64", "os": "linux"}, self.source),
+            ({"architecture": "arm64", "os": "linux", "variant": "v8"}, arm64),
+            ({"architecture": "unknown", "os": "unknown"}, self.source),
+        ]
+
+    def test_should_squash_all_platforms_of_oci_layout(self):
+        source = os.path.join(self.tmp, "source")
+        layout = os.path.join(self.tmp, "layout")
+
+        ArchiveHelper.oci_layout(source, self.multi_platform_archives())
+
+        image_ids = self.squash(
+            "oci:%s" % source,
+            from_layer="2",
+            tag="squashed:latest",
+            output_path="oci:%s" % layout,
+            all_platforms=True,
+            platform_workers=2,
+        )
+
+        self.assertEqual(len(image_ids), 2)
+
+        def blob(digest):
+            with open(os.path.join(layout, "blobs", digest.replace(":", "/"))) as f:
+                return json.load(f)
+
+        with open(os.path.join(layout, "index.json")) as f:
+            (descriptor,) = json.load(f)["manifests"]
+
+        self.assertEqual(
+            descriptor["mediaType"], "application/vnd.oci.image.index.v1+json"
+        )
+        self.assertEqual(
+            descriptor["annotations"]["io.containerd.image.name"], "squashed:latest"
+        )
+
+        manifests = blob(descriptor["digest"])["manifests"]
+
+        self.assertEqual(
+            [m["platform"]["architecture"] for m in manifests], ["amd64", "arm64"]
+        )
+        self.assertEqual(manifests[1]["platform"]["variant"], "v8")
+
+        amd64, arm64 = [blob(m["digest"]) for m in manifests]
+
+        self.assertEqual(amd64["layers"][0], arm64["layers"][0])
+        self.assertEqual(
+            [blob(m["config"]["digest"])["os"] for m in (amd64, arm64)],
+            ["linux", "linux"],
+        )
+
+        with tarfile.open(
+            os.path.join(
+                layout, "blobs", arm64["layers"][1]["digest"].replace(":", "/")
+            )
+        ) as tar:
+            self.assertEqual(tar.extractfile("opt/file").read(), b"arm64 new")
+
+    @mock.patch("docker_squash.v2_image.registry.Registry", FakeRegistry)
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_squash_all_platforms_from_registry(self):
+        FakeRegistry.reset()
+        manifests = []
+
+        for platform, archive in self.multi_platform_archives():
+            FakeRegistry.push_archive(archive, "platform")
+            descriptor = FakeRegistry.blob(
+                json.dumps(FakeRegistry.manifests.pop("platform")).encode(),
+                "application/vnd.oci.image.manifest.v1+json",
+            )
+            FakeRegistry.manifests[descriptor["digest"]] = json.loads(
+                FakeRegistry.blobs[descriptor["digest"]]
+            )
+            descriptor["platform"] = platform
+            manifests.append(descriptor)
+
+        FakeRegistry.manifests["1.0"] = {"schemaVersion": 2, "manifests": manifests}
+
+        self.squash(
+            "docker://localhost:5000/app:1.0",
+            output_path="docker://localhost:5000/app:squashed",
+            all_platforms=True,
+        )
+
+        index = FakeRegistry.manifests["squashed"]
+        downloaded = [
+            digest
+            for instance in FakeRegistry.instances
+            for digest in instance.downloaded
+        ]
+
+        self.assertEqual(len(index["manifests"]), 2)
+        # Base layer is shared by both platforms and downloaded once
+        self.assertEqual(len(downloaded), len(set(downloaded)))
+
+        for descriptor in index["manifests"]:
+            manifest = FakeRegistry.manifests[descriptor["digest"]]
+
+            self.assertEqual(len(manifest["layers"]), 1)
+            self.assertIn(manifest["layers"][0]["digest"], FakeRegistry.blobs)
+
+    @mock.patch("docker_squash.v2_image.registry.Registry", FakeRegistry)
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_push_all_platforms_to_registry_without_layers(self):
+        FakeRegistry.reset(empty_registries=["registry.example.com"])
+        manifests = []
+
+        for platform, archive in self.multi_platform_archives()[:2]:
+            base = FakeRegistry.push_archive(archive, "platform")[0]
+            descriptor = FakeRegistry.blob(
+                json.dumps(FakeRegistry.manifests.pop("platform")).encode(),
+                "application/vnd.oci.image.manifest.v1+json",
+            )
+            FakeRegistry.manifests[descriptor["digest"]] = json.loads(
+                FakeRegistry.blobs[descriptor["digest"]]
+            )
+            descriptor["platform"] = platform
+            manifests.append(descriptor)
+
+        FakeRegistry.manifests["1.0"] = {"schemaVersion": 2, "manifests": manifests}
+
+        self.squash(
+            "docker://localhost:5000/app:1.0",
+            from_layer="2",
+            output_path="docker://registry.example.com/app:squashed",
+            all_platforms=True,
+        )
+
+        index = FakeRegistry.manifests["squashed"]
+        uploaded = [digest for _, digest in FakeRegistry.uploaded]
+
+        self.assertEqual(len(index["manifests"]), 2)
+        # Shared base layer is already compressed, it is uploaded once
+        self.assertEqual(uploaded.count(base["digest"]), 1)
+        self.assertEqual(len(uploaded), len(set(uploaded)))
+
+        for descriptor in index["manifests"]:
+            manifest = FakeRegistry.manifests[descriptor["digest"]]
+
+            self.assertEqual(manifest["layers"][0], base)
+            self.assertIn(
+                ("registry.example.com", manifest["layers"][1]["digest"]),
+                FakeRegistry.uploaded,
+            )
+
+    def test_should_not_squash_all_platforms_of_docker_archive(self):
+        with self.assertRaises(SquashError) as cm:
+            self.squash(
+                "docker-archive:%s" % self.source,
+                output_path="oci:%s" % os.path.join(self.tmp, "layout"),
+                all_platforms=True,
+            )
+
+        self.assertEqual(
+            str(cm.exception),
+            "All platforms can be squashed only for images read from OCI image layout or from a registry",
+        )
+
+    def test_should_write_stats_and_profile(self):
+        stats_file = os.path.join(self.tmp, "stats.json")
+        profile_file = os.path.join(self.tmp, "merge.prof")
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            from_layer="2",
+            stats=True,
+            stats_file=stats_file,
+            profile_file=profile_file,
+        )
+
+        with open(stats_file) as f:
+            stats = json.load(f)
+
+        self.assertEqual(
+            list(stats.keys()),
+            ["inspect", "save", "index", "merge", "hashing", "archive"],
+        )
+        self.assertGreater(stats["save"]["bytes"], 0)
+        self.assertGreater(stats["merge"]["bytes"], 0)
+        self.assertEqual(stats["hashing"]["bytes"], stats["merge"]["bytes"])
+        self.assertIn(mock.call("Squashing statistics:"), self.log.info.call_args_list)
+
+        # Profile can be read
+        pstats.Stats(profile_file)
+
+    def test_should_write_content_report(self):
+        source = os.path.join(self.tmp, "whiteouts.tar")
+        report_file = os.path.join(self.tmp, "report.json")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [
+                    ("opt", None),
+                    ("opt/file", b"first"),
+                    ("data", None),
+                    ("data/x", b"xx"),
+                ],
+                [
+                    ("opt/file", b"second"),
+                    ("etc/.wh.base", b""),
+                    ("data/.wh..wh..opq", b""),
+                    ("data/y", b"y"),
+                ],
+            ],
+        )
+
+        self.squash(
+            "docker-archive:%s" % source, from_layer="2", report_file=report_file
+        )
+
+        with open(report_file) as f:
+            report = json.load(f)
+
+        first, second = report["layers"]
+
+        self.assertEqual(first["files_kept"], 1)
+        self.assertEqual(first["files_shadowed"], 1)
+        self.assertEqual(first["files_opaque"], 2)
+        self.assertEqual(first["bytes_reclaimed"], 7)
+        self.assertEqual(second["files_kept"], 3)
+        self.assertEqual(second["markers_added"], 1)
+        self.assertEqual(second["bytes_reclaimed"], 0)
+        self.assertEqual(report["total"]["files_kept"], 4)
+        self.assertEqual(report["total"]["bytes_reclaimed"], 7)
+
+    def test_should_trace_decisions(self):
+        source = os.path.join(self.tmp, "whiteouts.tar")
+        report_file = os.path.join(self.tmp, "report.json")
+        trace_file = os.path.join(self.tmp, "trace.jsonl")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("opt", None), ("opt/file", b"first"), ("data", None)],
+                [
+                    ("opt/file", b"second"),
+                    ("etc/.wh.base", b""),
+                    ("data/.wh..wh..opq", b""),
+                    ("data/y", b"y"),
+                ],
+            ],
+        )
+
+        self.squash(
+            "docker-archive:%s" % source,
+            from_layer="2",
+            report_file=report_file,
+            trace_file=trace_file,
+        )
+
+        with open(report_file) as f:
+            first, second = [layer["layer"] for layer in json.load(f)["layers"]]
+
+        with open(trace_file) as f:
+            decisions = [json.loads(line) for line in f]
+
+        self.assertCountEqual(
+            decisions,
+            [
+                [second, "opt/file", "keep", "file"],
+                [second, "data/.wh..wh..opq", "keep", "file"],
+                [second, "data/y", "keep", "file"],
+                [second, "etc/.wh.base", "keep", "marker"],
+                [first, "opt", "keep", "file"],
+                [first, "opt/file", "drop", "shadowed"],
+                [first, "data", "drop", "opaque"],
+            ],
+        )
+
+    def test_should_remove_squashed_layers_while_squashing(self):
+        with mock.patch("docker_squash.image.os.remove", side_effect=os.remove) as rm:
+            self.squash("docker-archive:%s" % self.source, from_layer="2")
+
+        manifest = ArchiveHelper.read(self.source)[0]
+        removed = [os.path.relpath(c[0][0], self.tmp) for c in rm.call_args_list]
+
+        self.assertEqual(
+            sorted(removed),
+            sorted(os.path.join("work", "old", p) for p in manifest["Layers"][1:]),
+        )
+
+    def test_should_stream_image_to_docker_daemon(self):
+        docker_client = mock.Mock()
+        docker_client.version.return_value = {"Version": "25.0", "ApiVersion": "1.44"}
+        loaded = io.BytesIO()
+        docker_client.load_image.side_effect = lambda data: [
+            loaded.write(chunk) for chunk in data
+        ]
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            docker=docker_client,
+            load_image=True,
+            output_path=None,
+        )
+
+        with tarfile.open(fileobj=io.BytesIO(loaded.getvalue())) as tar:
+            self.assertIn("manifest.json", tar.getnames())
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "work", "image.tar")))
+
+    def test_should_squash_small_image_in_memory(self):
+        memory_dir = os.path.join(self.tmp, "shm")
+        os.makedirs(memory_dir)
+
+        with mock.patch(
+            "docker_squash.image.MEMORY_DIR", memory_dir
+        ), mock.patch.object(
+            Image,
+            "_relocate_tmp_directory",
+            autospec=True,
+            side_effect=Image._relocate_tmp_directory,
+        ) as relocate:
+            self.squash("docker-archive:%s" % self.source, tmp_dir=None, in_memory=True)
+
+        relocate.assert_called_once_with(mock.ANY, memory_dir)
+        self.assertEqual(os.listdir(memory_dir), [])
+        self.assertEqual(len(ArchiveHelper.read(self.output)[2]), 1)
+
+    def test_should_squash_large_image_on_disk(self):
+        with mock.patch.object(Image, "_relocate_tmp_directory") as relocate:
+            self.squash(
+                "docker-archive:%s" % self.source,
+                tmp_dir=None,
+                in_memory=True,
+                in_memory_threshold=1024,
+            )
+
+        relocate.assert_not_called()
+
+    def test_should_resume_squashing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.squash(
+                "docker-archive:%s" % self.source,
+                from_layer="2",
+                output_path=os.path.join(self.tmp, "missing", "output.tar"),
+            )
+
+        with mock.patch.object(
+            Image, "_squash_layers"
+        ) as squash_layers, mock.patch.object(Image, "_unpack") as unpack:
+            image_id = self.squash(
+                "docker-archive:%s" % self.source, from_layer="2", resume=True
+            )
+
+        squash_layers.assert_not_called()
+        unpack.assert_not_called()
+
+        manifest, _, layers = ArchiveHelper.read(self.output)
+
+        self.assertEqual(manifest["Config"], "%s.json" % image_id)
+        self.assertEqual(layers[0]["etc/base"], b"base")
+        self.assertEqual(layers[1]["opt/file"], b"second")
+
+        # Squashing the same image again gives the same result
+        self.assertEqual(
+            self.squash("docker-archive:%s" % self.source, from_layer="2", resume=True),
+            image_id,
+        )
+
+    def test_should_resume_squashing_image_from_oci_layout(self):
+        layout = os.path.join(self.tmp, "layout")
+        ArchiveHelper.oci_layout(
+            layout, [({"architecture": "amd64", "os": "linux"}, self.source)]
+        )
+
+        # Layers already squashed are removed when merging is interrupted
+        with mock.patch.object(
+            Image, "_add_hardlinks", side_effect=RuntimeError("Interrupted")
+        ):
+            with self.assertRaises(RuntimeError):
+                self.squash("oci:%s" % layout, from_layer="2")
+
+        self.squash("oci:%s" % layout, from_layer="2", resume=True)
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        self.assertEqual(layers[0]["etc/base"], b"base")
+        self.assertEqual(layers[1]["opt/file"], b"second")
+
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_report_size_of_image_from_registry(self):
+        report_file = os.path.join(self.tmp, "report.json")
+        FakeRegistry.reset()
+        base, _, _ = FakeRegistry.push_archive(self.source, "1.0")
+        manifest = FakeRegistry.manifests["1.0"]
+
+        self.squash(
+            "docker://localhost:5000/app:1.0",
+            from_layer="2",
+            output_path="docker://localhost:5000/app:squashed",
+            report_file=report_file,
+        )
+
+        with open(report_file) as f:
+            report = json.load(f)
+
+        # Layers are counted with their size in the registry, even if these
+        # were never downloaded
+        self.assertEqual(
+            report["size_before"],
+            manifest["config"]["size"]
+            + sum(layer["size"] for layer in manifest["layers"]),
+        )
+        self.assertGreater(report["size_after"], base["size"])
+
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_resume_downloading_layers(self):
+        FakeRegistry.reset()
+        _, first, second = FakeRegistry.push_archive(self.source, "1.0")
+        get_blob = FakeRegistry.get_blob
+
+        def interrupted(registry, digest, path):
+            if digest == second["digest"]:
+                raise ConnectionError("Connection reset by peer")
+
+            get_blob(registry, digest, path)
+
+        with mock.patch.object(FakeRegistry, "get_blob", interrupted):
+            with self.assertRaises(ConnectionError):
+                self.squash("docker://localhost:5000/app:1.0", from_layer="2")
+
+        self.squash("docker://localhost:5000/app:1.0", from_layer="2", resume=True)
+
+        downloaded = FakeRegistry.instances[-1].downloaded
+
+        self.assertNotIn(first["digest"], downloaded)
+        self.assertIn(second["digest"], downloaded)
+        self.assertEqual(ArchiveHelper.read(self.output)[2][1]["opt/file"], b"second")
+
+    def test_should_not_resume_squashing_with_different_parameters(self):
+        self.squash("docker-archive:%s" % self.source, from_layer="2")
+
+        with self.assertRaises(SquashError) as cm:
+            self.squash("docker-archive:%s" % self.source, from_layer="3", resume=True)
+
+        self.assertIn("checkpoint of squashing with different", str(cm.exception))
+
+    def test_should_not_resume_squashing_with_different_layer_order(self):
+        self.squash("docker-archive:%s" % self.source, from_layer="2")
+
+        with self.assertRaises(SquashError) as cm:
+            self.squash(
+                "docker-archive:%s" % self.source,
+                from_layer="2",
+                layer_order="name",
+                resume=True,
+            )
+
+        self.assertIn("checkpoint of squashing with different", str(cm.exception))
+
+    @mock.patch.dict("os.environ", {"SOURCE_DATE_EPOCH": "1500000000"})
+    def test_should_not_resume_squashing_reproducibly(self):
+        self.squash("docker-archive:%s" % self.source, from_layer="2")
+
+        with self.assertRaises(SquashError) as cm:
+            self.squash(
+                "docker-archive:%s" % self.source,
+                from_layer="2",
+                reproducible=True,
+                resume=True,
+            )
+
+        self.assertIn("checkpoint of squashing with different", str(cm.exception))
+
+    @mock.patch.dict("os.environ", {"SOURCE_DATE_EPOCH": "1500000000"})
+    def test_should_squash_reproducibly(self):
+        image_ids = []
+
+        for run in "first", "second":
+            output = os.path.join(self.tmp, "%s.tar" % run)
+            image_ids.append(
+                self.squash(
+                    "docker-archive:%s" % self.source,
+                    reproducible=True,
+                    output_path=output,
+                    tmp_dir=os.path.join(self.tmp, run),
+                )
+            )
+
+        self.assertEqual(image_ids[0], image_ids[1])
+
+        manifest, config, _ = ArchiveHelper.read(output)
+
+        self.assertEqual(config["created"], "2017-07-14T02:40:00Z")
+
+        with tarfile.open(output) as tar:
+            layer = tarfile.open(fileobj=tar.extractfile(manifest["Layers"][0]))
+
+            self.assertEqual(layer.getnames(), sorted(layer.getnames()))
+            self.assertEqual({m.mtime for m in layer.getmembers()}, {1500000000})
+
+    def test_should_order_layer_for_compression(self):
+        source = os.path.join(self.tmp, "files.tar")
+        large = b"\0" * (1024 * 1024)
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("b", None), ("b/big.bin", large), ("b/x.txt", b"x")],
+                [("a", None), ("a/y.txt", b"y"), ("a/z.py", b"z"), ("a/huge", large)],
+            ],
+        )
+
+        self.squash("docker-archive:%s" % source, layer_order="compression")
+
+        manifest = ArchiveHelper.read(self.output)[0]
+
+        with tarfile.open(self.output) as tar:
+            layer = tarfile.open(fileobj=tar.extractfile(manifest["Layers"][0]))
+
+            self.assertEqual(
+                layer.getnames(),
+                ["a", "b", "a/z.py", "a/y.txt", "b/x.txt", "a/huge", "b/big.bin"],
+            )
+
+    def test_should_split_squashed_layer(self):
+        source = os.path.join(self.tmp, "files.tar")
+        large = b"\0" * (1024 * 1024)
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("base", None), ("base/file", b"base")],
+                [("a", None), ("a/big", large), ("b", None), ("b/old", b"old")],
+                [("b", None), ("b/new", large), ("c", None), ("c/small", b"s")],
+            ],
+        )
+
+        self.squash("docker-archive:%s" % source, from_layer="2", split_layers=2)
+
+        manifest, config, layers = ArchiveHelper.read(self.output)
+
+        self.assertEqual(len(layers), 3)
+        self.assertEqual(len(config["rootfs"]["diff_ids"]), 3)
+        self.assertEqual(len(config["history"]), 3)
+        self.assertEqual(layers[0], {"base": None, "base/file": b"base"})
+        self.assertEqual(layers[1], {"a": None, "a/big": large, "b": None})
+        self.assertEqual(
+            layers[2], {"b/new": large, "b/old": b"old", "c": None, "c/small": b"s"}
+        )
+
+        # Squashed layers are placed on top of each other
+        with tarfile.open(self.output) as tar:
+            parents = [
+                json.load(tar.extractfile(layer_path.replace("layer.tar", "json")))
+                for layer_path in manifest["Layers"][1:]
+            ]
+
+        self.assertEqual(parents[0]["parent"], manifest["Layers"][0].split("/")[0])
+        self.assertEqual(parents[1]["parent"], manifest["Layers"][1].split("/")[0])
+
+    def test_should_keep_opaque_directory_below_its_content_when_splitting(self):
+        image = V2Image(self.log, None, "image", None, split_layers=4)
+        image.squashed_dir = os.path.join(self.tmp, "squashed")
+        image.squashed_tar = os.path.join(image.squashed_dir, "layer.tar")
+        os.makedirs(image.squashed_dir)
+
+        with open(image.squashed_tar, "wb") as f:
+            f.write(
+                ArchiveHelper.layer(
+                    [
+                        ("d/z", b"z" * 2048),
+                        ("d/-a", b"a" * 2048),
+                        ("d/.wh..wh..opq", b""),
+                        ("d", None),
+                        ("e", b"e" * 2048),
+                    ]
+                )
+            )
+
+        layer_tars = image._split_squashed_layer()
+        names = []
+
+        for layer_tar in layer_tars:
+            with tarfile.open(layer_tar) as tar:
+                names.append(tar.getnames())
+
+        self.assertEqual(names, [["d", "d/.wh..wh..opq"], ["d/-a"], ["d/z"], ["e"]])
+
+    def test_should_keep_unchanged_files_in_stable_layer(self):
+        outputs = []
+
+        for build in "first", "second", "third":
+            source = os.path.join(self.tmp, "%s-source.tar" % build)
+            output = os.path.join(self.tmp, "%s.tar" % build)
+
+            ArchiveHelper.archive(
+                source,
+                [
+                    [("etc", None), ("etc/base", b"base")],
+                    [("opt", None), ("opt/a", b"a"), ("opt/file", b"old")],
+                    [("opt", None), ("opt/file", build.encode())],
+                ],
+            )
+
+            self.squash(
+                "docker-archive:%s" % source,
+                from_layer="2",
+                output_path=output,
+                tmp_dir=os.path.join(self.tmp, build),
+                previous_image=outputs[-1] if outputs else None,
+            )
+            outputs.append(output)
+
+        first_layers = ArchiveHelper.read(outputs[0])[2]
+        _, second_config, second_layers = ArchiveHelper.read(outputs[1])
+        _, third_config, third_layers = ArchiveHelper.read(outputs[2])
+
+        self.assertEqual(len(first_layers), 2)
+        self.assertEqual(second_layers[1], {"opt": None, "opt/a": b"a"})
+        self.assertEqual(second_layers[2], {"opt/file": b"second"})
+        self.assertEqual(third_layers[2], {"opt/file": b"third"})
+
+        # Only the hot layer differs between builds
+        self.assertEqual(
+            second_config["rootfs"]["diff_ids"][:2],
+            third_config["rootfs"]["diff_ids"][:2],
+        )
+        self.assertNotEqual(
+            second_config["rootfs"]["diff_ids"][2],
+            third_config["rootfs"]["diff_ids"][2],
+        )
+
+    def test_should_not_split_by_size_and_by_churn(self):
+        with self.assertRaises(SquashError) as cm:
+            self.squash(
+                "docker-archive:%s" % self.source,
+                previous_image=self.output,
+                split_layers=2,
+            )
+
+        self.assertIn("previous image is provided", str(cm.exception))
+
+    def test_should_store_duplicate_files_as_hard_links(self):
+        source = os.path.join(self.tmp, "files.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("a", None), ("a/lib.so", b"library"), ("a/other", b"other")],
+                [("b", None), ("b/lib.so", b"library"), ("b/empty", b"")],
+                [("c", None), ("c/lib.so", b"library"), ("c/empty", b"")],
+            ],
+        )
+
+        self.squash("docker-archive:%s" % source, deduplicate=True)
+
+        manifest = ArchiveHelper.read(self.output)[0]
+
+        with tarfile.open(self.output) as tar:
+            layer = tarfile.open(fileobj=tar.extractfile(manifest["Layers"][0]))
+            links = {m.name: m.linkname for m in layer.getmembers() if m.islnk()}
+
+            # Layers are squashed from the newest one
+            self.assertEqual(links, {"b/lib.so": "c/lib.so", "a/lib.so": "c/lib.so"})
+            self.assertEqual(layer.extractfile("c/lib.so").read(), b"library")
+
+    def test_should_not_deduplicate_files_with_different_permissions(self):
+        image = V2Image(self.log, None, "image", None)
+        duplicates = {}
+
+        for name, mode in ("first", 0o644), ("second", 0o755), ("third", 0o644):
+            member = tarfile.TarInfo(name)
+            member.size = 7
+            member.mode = mode
+            member, content = image._deduplicate(
+                member, io.BytesIO(b"content"), duplicates
+            )
+
+        self.assertTrue(member.islnk())
+        self.assertEqual(member.linkname, "first")
+        self.assertEqual(member.size, 0)
+        self.assertIsNone(content)
+        self.assertEqual(sorted(duplicates.values()), [["first", "third"], ["second"]])
+
+    def test_should_exclude_files(self):
+        source = os.path.join(self.tmp, "files.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("app", None), ("app/__pycache__", None), ("app/__pycache__/a", b"a")],
+                [("app", None), ("app/main.py", b"main"), ("app/main.py.orig", b"x")],
+            ],
+        )
+
+        self.squash(
+            "docker-archive:%s" % source,
+            from_layer="2",
+            exclude=["re:\\.orig$"],
+            exclude_presets=["pycache"],
+            report_file=os.path.join(self.tmp, "report.json"),
+        )
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        self.assertEqual(layers[1], {"app": None, "app/main.py": b"main"})
+
+        with open(os.path.join(self.tmp, "report.json")) as f:
+            self.assertEqual(json.load(f)["total"]["files_excluded"], 3)
+
+    def test_should_hide_excluded_files_in_moved_layers(self):
+        source = os.path.join(self.tmp, "files.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [
+                    ("tmp", None),
+                    ("tmp/cache", b"old"),
+                    ("tmp/kept", b"kept"),
+                    ("tmp/build", None),
+                    ("tmp/build/a", b"a"),
+                ],
+                [("tmp", None), ("tmp/cache", b"new"), ("tmp/other", b"other")],
+                [("tmp", None), ("tmp/build", None), ("tmp/build/b", b"b")],
+            ],
+        )
+
+        self.squash(
+            "docker-archive:%s" % source, from_layer="2", exclude_presets=["tmp"]
+        )
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        # Files only in the squashed layers are just dropped, the directory
+        # hides its content in the moved layer too
+        self.assertEqual(
+            layers[1], {"tmp": None, "tmp/.wh.cache": b"", "tmp/.wh.build": b""}
+        )
+
+    def test_should_place_hard_links_after_deduplicated_targets(self):
+        source = os.path.join(self.tmp, "links.tar")
+        buf = io.BytesIO()
+
+        with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for name in "data/first", "zz":
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b"same"))
+
+            # Link to the file which becomes a link to the first copy
+            info = tarfile.TarInfo("aa")
+            info.type = tarfile.LNKTYPE
+            info.linkname = "zz"
+            tar.addfile(info)
+
+        ArchiveHelper.archive(
+            source, [[("etc", None), ("etc/base", b"base")], buf.getvalue()]
+        )
+
+        for layer_order in "compression", "name":
+            output = os.path.join(self.tmp, "%s.tar" % layer_order)
+
+            self.squash(
+                "docker-archive:%s" % source,
+                output_path=output,
+                tmp_dir=os.path.join(self.tmp, layer_order),
+                deduplicate=True,
+                layer_order=layer_order,
+            )
+
+            with tarfile.open(output) as archive:
+                manifest = json.load(archive.extractfile("manifest.json"))[0]
+                layer = archive.extractfile(manifest["Layers"][-1]).read()
+
+            target = os.path.join(self.tmp, "%s-extracted" % layer_order)
+
+            with tarfile.open(fileobj=io.BytesIO(layer)) as tar:
+                tar.extractall(target)
+
+            for name in "data/first", "zz", "aa":
+                with open(os.path.join(target, name), "rb") as f:
+                    self.assertEqual(f.read(), b"same")
+
+    def test_should_keep_files_sparse(self):
+        source = os.path.join(self.tmp, "files.tar")
+        size = 10 * 1024 * 1024
+        buf = io.BytesIO()
+
+        # Sparse file in the PAX 1.0 format, as written by GNU tar
+        with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            sparse_map = b"2\n4096\n5\n%d\n0\n" % size
+            sparse_map += b"\0" * (512 - len(sparse_map))
+            info = tarfile.TarInfo("db/GNUSparseFile.0/data")
+            info.size = len(sparse_map) + 5
+            info.pax_headers = {
+                "GNU.sparse.major": "1",
+                "GNU.sparse.minor": "0",
+                "GNU.sparse.name": "db/data",
+                "GNU.sparse.realsize": str(size),
+            }
+            tar.addfile(info, io.BytesIO(sparse_map + b"hello"))
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("db", None), ("db/data", b"old")],
+                buf.getvalue(),
+            ],
+        )
+
+        self.squash("docker-archive:%s" % source, from_layer="2")
+
+        with tarfile.open(self.output) as tar:
+            manifest = json.load(tar.extractfile("manifest.json"))[0]
+            layer_info = tar.getmember(manifest["Layers"][1])
+            layer = tarfile.open(fileobj=tar.extractfile(layer_info))
+            member = layer.getmember("db/data")
+
+            self.assertLess(layer_info.size, 1024 * 1024)
+            self.assertEqual(member.size, size)
+            self.assertEqual(member.sparse, [(4096, 5), (size, 0)])
+
+            data = layer.extractfile(member)
+            data.seek(4090)
+            self.assertEqual(data.read(11), b"\0" * 6 + b"hello")
+
+    def test_should_keep_content_of_deduplicated_gnu_sparse_files(self):
+        source = os.path.join(self.tmp, "files.tar")
+        layer = b""
+
+        # Sparse files in the old GNU format, with the sparse map in the header
+        for name in "db/first", "db/second":
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.GNUTYPE_SPARSE
+            info.size = 5
+            header = bytearray(info.tobuf(tarfile.GNU_FORMAT))
+            header[386:410] = b"%011o\0%011o\0" % (4096, 5)
+            header[483:495] = b"%011o\0" % 8192
+            header[148:156] = b" " * 8
+            header[148:156] = b"%06o\0 " % sum(header)
+            layer += bytes(header) + b"hello" + b"\0" * 507
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("db", None)],
+                layer + b"\0" * 1024,
+            ],
+        )
+
+        self.squash("docker-archive:%s" % source, from_layer="2", deduplicate=True)
+
+        layers = ArchiveHelper.read(self.output)[2]
+
+        for name in "db/first", "db/second":
+            self.assertEqual(layers[1][name], b"\0" * 4096 + b"hello" + b"\0" * 4091)
+
+    def test_should_squash_range_of_layers(self):
+        source = os.path.join(self.tmp, "layers.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("opt", None), ("opt/file", b"first"), ("opt/tool", b"tool")],
+                [("opt", None), ("opt/file", b"second"), ("opt/.wh.tool", b"")],
+                [("app", None), ("app/main", b"main")],
+            ],
+        )
+
+        self.squash("docker-archive:%s" % source, layers="1:-1")
+
+        manifest, config, layers = ArchiveHelper.read(self.output)
+
+        self.assertEqual(len(layers), 3)
+        self.assertEqual(layers[0], {"etc": None, "etc/base": b"base"})
+        # Whiteout is dropped, the file it hides is squashed too
+        self.assertEqual(layers[1], {"opt": None, "opt/file": b"second"})
+        self.assertEqual(layers[2], {"app": None, "app/main": b"main"})
+        self.assertEqual(
+            [h["created_by"] for h in config["history"] if "created_by" in h],
+            ["layer 0", "layer 3"],
+        )
+
+        with tarfile.open(self.output) as tar:
+            diff_ids = [
+                "sha256:%s" % hashlib.sha256(tar.extractfile(path).read()).hexdigest()
+                for path in manifest["Layers"]
+            ]
+            squashed_id, top_id = [
+                path.split("/")[0] for path in manifest["Layers"][1:]
+            ]
+            top = json.load(tar.extractfile("%s/json" % top_id))
+
+        self.assertEqual(config["rootfs"]["diff_ids"], diff_ids)
+        # Top layer is carried over on top of the squashed layer
+        self.assertEqual(top["id"], top_id)
+        self.assertEqual(top["parent"], squashed_id)
+
+    def test_should_carry_layers_of_oci_layout_over(self):
+        source = os.path.join(self.tmp, "source")
+        layout = os.path.join(self.tmp, "layout")
+
+        ArchiveHelper.oci_layout(
+            source, [({"architecture": "amd64", "os": "linux"}, self.source)]
+        )
+
+        with open(os.path.join(source, "index.json")) as f:
+            source_manifest = self.read_blob(source, json.load(f)["manifests"][0])
+
+        self.squash("oci:%s" % source, layers=":2", output_path="oci:%s" % layout)
+
+        with open(os.path.join(layout, "index.json")) as f:
+            manifest = self.read_blob(layout, json.load(f)["manifests"][0])
+
+        config = self.read_blob(layout, manifest["config"])
+
+        self.assertEqual(len(manifest["layers"]), 2)
+        self.assertEqual(manifest["layers"][1], source_manifest["layers"][2])
+        self.assertEqual(
+            config["rootfs"]["diff_ids"][1], source_manifest["layers"][2]["digest"]
+        )
+        self.assertEqual(config["history"][1]["created_by"], "layer 2")
+
+    def test_should_carry_layer_squashed_in_range_over(self):
+        archive = os.path.join(self.tmp, "repeated.tar")
+        source = os.path.join(self.tmp, "source")
+        layout = os.path.join(self.tmp, "layout")
+        repeated = ArchiveHelper.layer([("opt", None), ("opt/file", b"repeated")])
+
+        ArchiveHelper.archive(
+            archive,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                repeated,
+                [("opt", None), ("opt/file", b"changed")],
+                repeated,
+            ],
+        )
+        ArchiveHelper.oci_layout(
+            source, [({"architecture": "amd64", "os": "linux"}, archive)]
+        )
+
+        self.squash("oci:%s" % source, layers="1:3", output_path="oci:%s" % layout)
+
+        with open(os.path.join(layout, "index.json")) as f:
+            manifest = self.read_blob(layout, json.load(f)["manifests"][0])
+
+        self.assertEqual(len(manifest["layers"]), 3)
+        self.assertEqual(
+            manifest["layers"][2]["digest"],
+            "sha256:%s" % hashlib.sha256(repeated).hexdigest(),
+        )
+
+        with open(
+            os.path.join(
+                layout, "blobs", manifest["layers"][2]["digest"].replace(":", "/")
+            ),
+            "rb",
+        ) as f:
+            self.assertEqual(f.read(), repeated)
+
+    def read_blob(self, layout, descriptor):
+        with open(
+            os.path.join(layout, "blobs", descriptor["digest"].replace(":", "/"))
+        ) as f:
+            return json.load(f)
+
+    def test_should_not_accept_invalid_range_of_layers(self):
+        with self.assertRaises(SquashError) as cm:
+            self.squash("docker-archive:%s" % self.source, layers="1-2")
+
+        self.assertEqual(
+            str(cm.exception),
+            "Provided range of layers to squash: 1-2 is not in the START:END format",
+        )
+
+        with self.assertRaises(SquashError) as cm:
+            self.squash("docker-archive:%s" % self.source, layers="1:", from_layer="2")
+
+        self.assertEqual(
+            str(cm.exception),
+            "Range of layers to squash cannot be used together with the layer to squash from",
+        )
+
+    def auto_archive(self):
+        source = os.path.join(self.tmp, "auto.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("usr", None), ("usr/lib", b"lib")],
+                [("opt", None), ("opt/file", b"first")],
+                [("opt", None), ("opt/file", b"second"), ("usr/.wh.lib", b"")],
+                [("app", None), ("app/main", b"main")],
+            ],
+        )
+
+        return source
+
+    def test_should_select_layers_to_squash_automatically(self):
+        source = self.auto_archive()
+
+        self.squash("docker-archive:%s" % source, from_layer="auto")
+
+        _, config, layers = ArchiveHelper.read(self.output)
+
+        # The library removed in the fourth layer is reclaimed
+        self.assertEqual(len(layers), 2)
+        self.assertEqual(layers[0], {"etc": None, "etc/base": b"base"})
+        self.assertNotIn("usr/lib", layers[1])
+        self.assertEqual(layers[1]["opt/file"], b"second")
+
+    def test_should_not_squash_layers_shared_with_other_images_automatically(self):
+        source = self.auto_archive()
+
+        with tarfile.open(source) as tar:
+            manifest = json.load(tar.extractfile("manifest.json"))[0]
+            diff_ids = json.load(tar.extractfile(manifest["Config"]))["rootfs"][
+                "diff_ids"
+            ]
+
+        docker = mock.Mock()
+        docker.version.return_value = {"Version": "20.10.0", "ApiVersion": "1.41"}
+        docker.images.return_value = [{"Id": "sha256:base"}, {"Id": "sha256:other"}]
+        docker.inspect_image.side_effect = lambda image_id: {
+            "sha256:base": {"RootFS": {"Layers": diff_ids[:2]}},
+            "sha256:other": {"RootFS": {"Layers": diff_ids[:1] + ["sha256:other"]}},
+        }[image_id]
+
+        self.squash("docker-archive:%s" % source, from_layer="auto", docker=docker)
+
+        _, config, layers = ArchiveHelper.read(self.output)
+
+        # Shared base layers are kept, the file overwritten above them is
+        # still reclaimed
+        self.assertEqual(len(layers), 3)
+        self.assertEqual(config["rootfs"]["diff_ids"][:2], diff_ids[:2])
+        self.assertEqual(
+            layers[2],
+            {
+                "opt": None,
+                "opt/file": b"second",
+                "usr/.wh.lib": b"",
+                "app": None,
+                "app/main": b"main",
+            },
+        )
+
+    def test_should_not_squash_automatically_if_no_space_is_reclaimed(self):
+        source = os.path.join(self.tmp, "clean.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base")],
+                [("opt", None), ("opt/file", b"first")],
+            ],
+        )
+
+        with self.assertRaises(SquashUnnecessaryError) as cm:
+            self.squash("docker-archive:%s" % source, from_layer="auto")
+
+        self.assertEqual(
+            str(cm.exception),
+            "No space can be reclaimed by squashing layers not shared with other images, no squashing is required",
+        )
+
+    def test_should_analyze_image(self):
+        source = os.path.join(self.tmp, "wasteful.tar")
+        report_file = os.path.join(self.tmp, "waste.json")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("etc", None), ("etc/base", b"base"), ("etc/copy", b"dupl")],
+                [
+                    ("opt", None),
+                    ("opt/file", b"first"),
+                    ("opt/tool", b"tool"),
+                    ("opt/copy", b"dupl"),
+                ],
+                [("opt", None), ("opt/file", b"second"), ("opt/.wh.tool", b"")],
+            ],
+        )
+
+        report = Squash(
+            self.log,
+            "docker-archive:%s" % source,
+            load_image=False,
+            report_file=report_file,
+        ).analyze()
+
+        self.assertFalse(os.path.exists(self.output))
+        self.assertEqual(report["wasted"], 13)
+        self.assertEqual(
+            [
+                (
+                    layer["layer"],
+                    layer["size"],
+                    layer["overwritten"],
+                    layer["removed"],
+                    layer["duplicate"],
+                    layer["wasted"],
+                )
+                for layer in report["layers"]
+            ],
+            [(0, 8, 0, 0, 0, 0), (1, 13, 5, 4, 4, 13), (2, 6, 0, 0, 0, 0)],
+        )
+        self.assertEqual(
+            [
+                (path["path"], path["layer"], path["reason"], path["size"])
+                for path in report["paths"]
+            ],
+            [
+                ("/opt/file", 1, "overwritten", 5),
+                ("/opt/tool", 1, "removed", 4),
+                ("/opt/copy", 1, "duplicate", 4),
+            ],
+        )
+
+        with open(report_file) as f:
+            self.assertEqual(json.load(f), report)
+
+    @mock.patch("docker_squash.squash.common.docker_client")
+    def test_should_connect_to_docker_daemon_when_running(self, docker_client):
+        docker_client.return_value.version.side_effect = SquashError("Stopped")
+
+        squash = Squash(self.log, "image", load_image=False, output_path=self.output)
+
+        docker_client.assert_not_called()
+
+        with self.assertRaises(SquashError):
+            asyncio.run(squash.run_async())
+
+        docker_client.assert_called_once_with(self.log)
+
+    def test_should_not_squash_asynchronously_in_process_pool(self):
+        squash = Squash(
+            self.log, "docker-archive:%s" % self.source, output_path=self.output
+        )
+
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            with self.assertRaises(SquashError) as cm:
+                asyncio.run(squash.run_async(executor))
+
+        self.assertIn("thread pool executor", str(cm.exception))
+
+    def test_should_squash_asynchronously(self):
+        squashes = [
+            Squash(
+                self.log,
+                "docker-archive:%s" % self.source,
+                from_layer="2",
+                output_path=os.path.join(self.tmp, "%s.tar" % i),
+                load_image=False,
+                tmp_dir=os.path.join(self.tmp, "work-%s" % i),
+            )
+            for i in range(3)
+        ]
+
+        async def squash_all():
+            return await asyncio.gather(*[squash.run_async() for squash in squashes])
+
+        image_ids = asyncio.run(squash_all())
+
+        self.assertEqual(len(image_ids), 3)
+
+        for i, image_id in enumerate(image_ids):
+            manifest, _, layers = ArchiveHelper.read(
+                os.path.join(self.tmp, "%s.tar" % i)
+            )
+
+            self.assertEqual(manifest["Config"], "%s.json" % image_id)
+            self.assertEqual(layers[1]["opt/file"], b"second")
+
+    def test_should_report_progress(self):
+        events = []
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            from_layer="2",
+            progress=lambda *event: events.append(event),
+        )
+
+        phases = []
+
+        for phase, done, total in events:
+            if phase not in phases:
+                phases.append(phase)
+
+            self.assertLessEqual(done, total)
+
+        self.assertEqual(phases, ["merge", "hashing"])
+
+        for phase in phases:
+            last = [event for event in events if event[0] == phase][-1]
+            self.assertEqual(last[1], last[2])
+
+    @mock.patch("docker_squash.lib.registry.Registry", FakeRegistry)
+    def test_should_report_progress_of_merging_compressed_layers(self):
+        events = []
+        source = os.path.join(self.tmp, "compressible.tar")
+
+        ArchiveHelper.archive(
+            source,
+            [
+                [("opt", None), ("opt/first", b"1" * 100000)],
+                [("opt", None), ("opt/second", b"2" * 100000)],
+            ],
+        )
+        FakeRegistry.reset()
+        FakeRegistry.push_archive(source, "1.0")
+
+        self.squash(
+            "docker://localhost:5000/app:1.0",
+            progress=lambda *event: events.append(event),
+        )
+
+        merge = [event for event in events if event[0] == "merge"]
+
+        # Total is the size of compressed layers
+        self.assertLess(merge[-1][2], 100000)
+
+        for _, done, total in merge:
+            self.assertLessEqual(done, total)
+
+        self.assertEqual(merge[-1][1], merge[-1][2])
+
+    def test_should_report_progress_of_loading_image(self):
+        events = []
+        docker_client = mock.Mock()
+        docker_client.version.return_value = {"Version": "25.0", "ApiVersion": "1.44"}
+        docker_client.load_image.side_effect = lambda data: b"".join(data)
+
+        self.squash(
+            "docker-archive:%s" % self.source,
+            docker=docker_client,
+            output_path=None,
+            load_image=True,
+            progress=lambda *event: events.append(event),
+        )
+
+        load = [event for event in events if event[0] == "load"]
+
+        self.assertGreater(len(load), 0)
+        self.assertGreater(load[-1][1], 0)
@@ -433,5 +433,57 @@ class TestPathHierarchy(unittest.TestCase):
         self.assertEqual(expected, list(actual))
 
 
+class TestCheckDiskSpace(unittest.TestCase):
+    def setUp(self):
+        self.docker_client = mock.Mock()
+        self.log = mock.Mock()
+        self.image = "whatever"
+        self.squash = Image(self.log, self.docker_client, self.image, None)
+        self.squash.tmp_dir = "/tmp/docker-squash-abc"
+        self.squash.old_image_size = 100
+        self.squash.old_image_layer_sizes = [60, 30, 10]
+
+    def disk_usage(self, free):
+        return lambda directory: mock.Mock(free=free[directory])
+
+    @mock.patch("docker_squash.image.shutil.disk_usage")
+    def test_should_pass_when_enough_space(self, disk_usage):
+        disk_usage.side_effect = self.disk_usage({"/tmp/docker-squash-abc": 240})
+
+        self.squash._check_disk_space([30, 10])
+
+    @mock.patch("docker_squash.image.shutil.disk_usage")
+    def test_should_fail_when_not_enough_space(self, disk_usage):
+        disk_usage.side_effect = self.disk_usage({"/tmp/docker-squash-abc": 239})
+
+        with self.assertRaises(SquashError) as cm:
+            self.squash._check_disk_space([30, 10])
+
+        self.assertIn("Not enough free space", str(cm.exception))
+
+    @mock.patch.dict("os.environ", {"DOCKER_SQUASH_SCRATCH_DIRS": "/small:/big"})
+    @mock.patch("docker_squash.image.shutil.disk_usage")
+    def test_should_use_scratch_directory(self, disk_usage):
+        disk_usage.side_effect = self.disk_usage(
+            {"/tmp/docker-squash-abc": 10, "/small": 100, "/big": 1000}
+        )
+
+        with mock.patch.object(self.squash, "_relocate_tmp_directory") as relocate:
+            self.squash._check_disk_space([30, 10])
+
+        relocate.assert_called_with("/big")
+
+    @mock.patch.dict("os.environ", {"DOCKER_SQUASH_SCRATCH_DIRS": "/big"})
+    @mock.patch("docker_squash.image.shutil.disk_usage")
+    def test_should_not_relocate_provided_tmp_dir(self, disk_usage):
+        disk_usage.side_effect = self.disk_usage(
+            {"/tmp/docker-squash-abc": 10, "/big": 1000}
+        )
+        self.squash.tmp_dir_provided = True
+
+        with self.assertRaises(SquashError):
+            self.squash._check_disk_space([30, 10])
+
+
 if __name__ == "__main__":
     unittest.main()
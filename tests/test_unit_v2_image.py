@@ -62,7 +62,7 @@ class TestGeneratingMetadata(unittest.TestCase):
             "squashed",
             old_image_manifest,
             layer_paths_to_move,
-            "this_is_layer_path_id",
+            ["this_is_layer_path_id"],
         )
 
         self.assertEqual(len(metadata), 1)
@@ -129,7 +129,7 @@ class TestGeneratingMetadata(unittest.TestCase):
         self.image.old_image_dir = "/tmp/old"
         self.image.squash_id = "squash_id"
         self.image.date = "squashed_date"
-        self.image.diff_ids = ["diffid_1", "diffid_2"]
+        self.image.diff_ids = ["a", "b", "diffid_2"]
         # We want to move 3 layers (including empty)
         self.image.layers_to_move = ["lauer_id_1", "layer_id_2", "layer_id_3"]
         # We want to move 2 layers with content
@@ -234,6 +234,53 @@ class TestGeneratingMetadata(unittest.TestCase):
         )
 
 
+class TestReadingOCIIndex(unittest.TestCase):
+    def setUp(self):
+        self.docker_client = mock.Mock()
+        self.log = mock.Mock()
+        self.image = V2Image(self.log, self.docker_client, "oci:/tmp/layout", None)
+
+    def test_should_convert_oci_manifest(self):
+        files = {
+            "index.json": {
+                "manifests": [
+                    {
+                        "digest": "sha256:aaa",
+                        "annotations": {
+                            "org.opencontainers.image.ref.name": "image:tag"
+                        },
+                    }
+                ]
+            },
+            "blobs/sha256/aaa": {
+                "config": {"digest": "sha256:ccc"},
+                "layers": [{"digest": "sha256:l1"}, {"digest": "sha256:l2"}],
+            },
+        }
+
+        manifest = self.image._manifest_from_oci_index(files.__getitem__)
+
+        self.assertEqual(manifest["Config"], "blobs/sha256/ccc")
+        self.assertEqual(manifest["RepoTags"], ["image:tag"])
+        self.assertEqual(manifest["Layers"], ["blobs/sha256/l1", "blobs/sha256/l2"])
+
+    def test_should_follow_nested_index(self):
+        files = {
+            "index.json": {"manifests": [{"digest": "sha256:index"}]},
+            "blobs/sha256/index": {"manifests": [{"digest": "sha256:aaa"}]},
+            "blobs/sha256/aaa": {
+                "config": {"digest": "sha256:ccc"},
+                "layers": [{"digest": "sha256:l1"}],
+            },
+        }
+
+        manifest = self.image._manifest_from_oci_index(files.__getitem__)
+
+        self.assertEqual(manifest["Config"], "blobs/sha256/ccc")
+        self.assertEqual(manifest["RepoTags"], [])
+        self.assertEqual(manifest["Layers"], ["blobs/sha256/l1"])
+
+
 class TestWritingMetadata(unittest.TestCase):
     def setUp(self):
         self.docker_client = mock.Mock()